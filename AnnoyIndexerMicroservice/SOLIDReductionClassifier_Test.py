@@ -1,10 +1,12 @@
 import os
+import sys
 import requests
-import time
 from tqdm import tqdm
-from urllib.parse import unquote
 from urllib.parse import urlparse, unquote
-import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'IndexClient'))
+from indexClient import IndexClient, IndexClientError  # noqa: E402
+from partMatcher import open_matcher  # noqa: E402
 
 # URL for getting the annoy indexer from
 # SERVER_URI = 'http://127.0.0.1:5000'
@@ -12,49 +14,24 @@ SERVER_URI = 'https://annoy-script-qtoj2wikka-uc.a.run.app'
 UPLOAD_SERVER_URI = 'http://upload-files-ms.eba-rvniqqiy.eu-central-1.elasticbeanstalk.com/'
 FM_SERVER_URI = 'http://slim-feature-map-ms.eba-pibymigp.eu-central-1.elasticbeanstalk.com/'
 
-def download_and_extract_zip(signed_url, destination_dir):
-    """Download a zip file from a signed URL, extract it, and remove the zip file."""
-
-    # Create destination directory if it doesn't exist
-    if not os.path.exists(destination_dir):
-        os.makedirs(destination_dir)
-
-    with requests.get(signed_url, stream=True) as r:
-        try:
-            r.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            return False, f'Request Error: {e}'
-
-        # Extract the filename from the URL path
-        url_path = urlparse(r.url).path
-        filename = os.path.basename(unquote(url_path))
-        destination_path = os.path.join(destination_dir, filename)
-
-        total_size = int(r.headers.get('content-length', 0))
-        block_size = 65536
+def _barProgress(pbar):
+    def progress(done, total):
+        pbar.total = total
+        pbar.update(done - pbar.n)
+    return progress
 
-        with open(destination_path, 'wb') as f, tqdm(
-            desc="Downloading",
-            total=total_size,
-            unit="B",
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as pbar:
-            for chunk in r.iter_content(chunk_size=block_size):
-                f.write(chunk)
-                pbar.update(len(chunk))
-                time.sleep(0.01)
 
-        # Extract the contents of the zip file
-        with zipfile.ZipFile(destination_path, 'r') as zip_ref:
-            zip_ref.extractall(destination_dir)
-
-        # Remove the zip file
-        os.remove(destination_path)
-
-        return True, destination_path
+def download_and_extract_zip(signed_url, destination_dir):
+    """Download a zip file from a signed URL into the versioned index cache below destination_dir, extracting it
+    while it downloads. Unchanged archives are not downloaded again."""
+    identifier = os.path.basename(unquote(urlparse(signed_url).path)).rsplit('.', 1)[0]
+    client = IndexClient(SERVER_URI, destination_dir)
+    try:
+        with tqdm(desc="Downloading", unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+            return True, client.download(identifier, signed_url, progress=_barProgress(pbar))
+    except (requests.exceptions.RequestException, IndexClientError) as e:
+        return False, f'Request Error: {e}'
 
-isRunning = False
 
 def generateIndexer(indexerPath, vendor, category):
     '''
@@ -64,52 +41,15 @@ def generateIndexer(indexerPath, vendor, category):
     return: True, '' on success, False, Error description otherwise
     '''
     indexerPath = os.path.join(indexerPath, 'models')  #, vendor
-    if not os.path.exists(indexerPath):
-        os.makedirs(indexerPath)
-
-    wrote = 0
-    strReq = SERVER_URI + '/annoy-indexer-setup/' + vendor + '/' + category
-
-    strTaskId = None
+    client = IndexClient(SERVER_URI, indexerPath)
     try:
-        with requests.get(strReq, stream=True) as r:
-            r.raise_for_status()
-            if r.status_code == 200:
-                strTaskId = r.json().get('id')
+        with tqdm(desc="Downloading", unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+            download_result = client.fetch_index(vendor, category, downloadProgress=_barProgress(pbar))
     except requests.exceptions.RequestException as e:
         return False, f'Request Error: {e}'
-
-    if strTaskId is None:
-        return False, 'Connection Error: Could not get a valid Task Id from Server.'
-
-    result = True
-    while result:
-        strReq = SERVER_URI + '/get-annoy-indexer/' + strTaskId
-        with requests.get(strReq, stream=True) as r:
-            try:
-                r.raise_for_status()
-                result = r.json().get('result')
-            except requests.exceptions.RequestException as e:
-                return False, f'Request Error: {e}'
-
-            if result == 'running' or result == 'not started yet':
-                time.sleep(1)
-            elif result == 'cancelled':
-                return False, 'Process cancelled by the server.'
-            elif result == 'done':
-                fileUrl = r.json().get('fileUrl')
-                # Download and save the file
-                download_path = os.path.join(indexerPath, vendor, category)
-                success, download_result = download_and_extract_zip(fileUrl, download_path)
-
-                if success:
-                    return True, f'Generated valid indexer file. Downloaded to: {download_result}'
-                else:
-                    return False, f'Error during file download: {download_result}'
-            else:
-                return False, 'Undefined state on Server for the current task.'
-
-    return False, 'Could not start generating indexer.'
+    except IndexClientError as e:
+        return False, f'Error during indexer generation: {e}'
+    return True, f'Generated valid indexer file. Downloaded to: {download_result}'
 
 
 def findmatchingPart(lstVisuals):
@@ -121,6 +61,22 @@ def findmatchingPart(lstVisuals):
             print("No Parts")
         print(parts)
 
+def findmatchingPartsOffline(indexerPath, vendor, category, encryptionKey, lstParts, refresh=False):
+    '''
+    Same histograms as findmatchingPart for many parts, computed against the downloaded index. The matcher is
+    opened once from the local cache (the server is only asked with refresh or if nothing is cached yet).
+    :param lstParts: One list of view feature vectors per part
+    :return: One histogram per part
+    '''
+    client = IndexClient(SERVER_URI, os.path.join(indexerPath, 'models'))
+    matcher = open_matcher(client, vendor, category, encryptionKey, refresh)
+    lstHistograms = matcher.match_parts(lstParts)
+    for parts in lstHistograms:
+        if not parts:
+            print("No Parts")
+        print(parts)
+    return lstHistograms
+
 def _writePresetFile(fileName, binaryItems):
     '''
     Write a pickle file exactly as needed in Houdini by writing the byte content into a Preset file
@@ -1,46 +1,122 @@
-from flask import Flask, request, current_app, abort, jsonify
+from flask import Flask, Blueprint, Response, request, current_app, abort, jsonify, send_file
 from pathlib import Path
 from cryptography.fernet import Fernet as F
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import tqdm
+from concurrent.futures import ThreadPoolExecutor
 import os
-from annoy import AnnoyIndex
 import numpy
 import pymongo
-import pandas
 import json
-import io
 import shutil
 import base64
 import hashlib
-from datetime import datetime, timedelta
+import functools
+from datetime import datetime
 from google.cloud import storage
-from zipfile import ZipFile, ZipInfo
+from zipfile import ZipFile
 from google.api_core.exceptions import NotFound
 import dotenv
+import time
+import fcntl
 import threading
-from threading import Semaphore
 from redis import Redis
+from indexStore import index_store
+import buildManifest
+from vectorCache import vector_cache
+from vectorLoader import VectorMatrixLoader
+from buildScheduler import BuildScheduler, BuildJob
+import indexTuning
+import indexEngines
+import shardedIndex
+import vectorReduction
+import buildPlan
+from buildScheduler import FEATURE_DIMENSION
+from partCache import PartCache
+from blobCache import BlobCache
+from signedUrlCache import SignedUrlCache
+from lazyResource import LazyResource, warm, warm_in_background, readiness
+from jobState import JobStore, JobEvents, STATE_QUEUED, STATE_RUNNING, STATE_FAILED
+from workQueue import WorkQueue, default_worker_id
+import metrics
+import idTable
+from indexArchive import write_zip_archive
+from gcsFetcher import blob_fetcher, configure_connection_pool
 
 dotenv.load_dotenv()
 
 environment = os.getenv('FLASK_ENV', 'development')
 
+# Create all clients on first use instead of at import, so workers start fast
+EAGER_INIT = os.getenv("EAGER_INIT", "0") == "1"
+WARM_ON_START = os.getenv("WARM_ON_START", "1") == "1"
+
+def create_gcs_client():
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    # The client uses a session of ours, pooling connections for all concurrent feature map downloads
+    session = configure_connection_pool(AuthorizedSession(credentials), blob_fetcher.concurrency)
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
 # Set up Google Cloud Storage client
-gcs_client = storage.Client()
+gcs_client = LazyResource('gcs_client', create_gcs_client)
 
 # Your Google Cloud Storage bucket name
 gcs_bucket_name = os.getenv("GOOGLE_CLOUD_BUCKET_ID")
-gcs_bucket = gcs_client.bucket(gcs_bucket_name)
+gcs_bucket = LazyResource('gcs_bucket', lambda: gcs_client.bucket(gcs_bucket_name))
+
+# Local disk cache of images and presets
+blob_cache = BlobCache(gcs_bucket)
+BLOB_CACHE_MAX_AGE_SECONDS = int(os.getenv("BLOB_CACHE_MAX_AGE_SECONDS", 3600))
+
+# Signed URLs are created on the first request and reused until shortly before they expire
+signed_url_cache = SignedUrlCache(gcs_bucket)
+
+redis_client = LazyResource('redis_client', lambda: Redis.from_url(os.getenv("REDIS_URL")))
+
+# Indexing job records shared by all workers and instances
+job_store = JobStore(redis_client)
+# Wakes up long-polls and event streams of a job when its record changes
+job_events = JobEvents(redis_client)
+# Longest wait of a status long-poll (?wait=seconds)
+JOB_WAIT_MAX_SECONDS = float(os.getenv("JOB_WAIT_MAX_SECONDS", 30))
+# Event streams send a comment after this long without a change, so proxies keep the connection open
+JOB_STREAM_HEARTBEAT_SECONDS = float(os.getenv("JOB_STREAM_HEARTBEAT_SECONDS", 15))
+# Event streams are closed after this long, clients reconnect
+JOB_STREAM_MAX_SECONDS = float(os.getenv("JOB_STREAM_MAX_SECONDS", 300))
+# Status results after which a job does not change anymore
+FINAL_RESULTS = ('done', 'failed', 'id unknown')
+
+# Redis counter that invalidates the part caches of all processes
+PART_CACHE_GENERATION_NAME = "part_cache_generation"
+part_cache = PartCache(redis_client, PART_CACHE_GENERATION_NAME)
+PART_LOOKUP_BATCH_SIZE = 5000
+part_indexes_ensured = False
+
+# Lock of the old single node /process, only still deleted by /reset-redis
+INDEXING_LOCK_NAME = "indexing_lock"
+# Vendor/category builds of a /process run, leased by the build worker of every node
+build_queue = WorkQueue(redis_client)
+# Run the build worker in this service instance; a single process per node takes part (see BUILD_NODE_LOCK_PATH)
+BUILD_QUEUE_WORKER = os.getenv("BUILD_QUEUE_WORKER", "1") == "1"
+BUILD_NODE_LOCK_PATH = os.getenv("BUILD_NODE_LOCK_PATH", "/tmp/annoy_build_node.lock")
+BUILD_QUEUE_IDLE_SECONDS = float(os.getenv("BUILD_QUEUE_IDLE_SECONDS", 15))
+# Redis hash with the status and timings of every vendor/category of the current /process run
+INDEXING_STATUS_NAME = "indexing_status"
 
-redis_client = Redis.from_url(os.getenv("REDIS_URL"))
 
-# Global variable to track indexing status
-INDEXING_LOCK_NAME = "indexing_lock"
+# Archives are streamed to and from GCS in chunks of this size (multiple of 256 KB)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+# Blob metadata key of the hash of the content an archive was built from
+CONTENT_HASH_METADATA_KEY = "content-md5"
+# Also list image_file_names in _info.json for clients that do not read the id table yet
+INFO_IMAGE_NAMES = os.getenv("INFO_IMAGE_NAMES", "1") == "1"
+# Names of failed downloads stored with the error of a build
+FAILED_NAMES_REPORTED = 1000
 
 
-# Flask application
-application = Flask(__name__)
+# Routes of the service, registered on the application in create_app
+bp = Blueprint('annoy_indexer', __name__)
 
 
 # Thread executor
@@ -81,38 +157,10 @@ def connect_mongo_questions_db():
     my_client = pymongo.MongoClient(mongo_uri)
     return my_client
 
-def get_zip_file_url(identifier: str):
-    signed_url = generate_signed_url(f'{identifier}.zip')
-    return signed_url
+mongo_client = LazyResource('mongo_client', connect_mongo_questions_db)
 
-# Initialize default values for dictionary of users
-def init_default_value_for_dict_users():
-    global dictUsers
-    
-    # Get folder names from GCS bucket
-    try:
-        blobs = gcs_bucket.list_blobs()
-        folder_names = set()
-
-        for blob in blobs:
-            # Extract the folder name from the object's path
-            folder_name = blob.name.replace(".zip", '')
-            folder_names.add(folder_name)
-
-        # Process folder names and create dictionary entries
-        for folder_name in folder_names:
-            identifier = folder_name
-            dictUsers[identifier] = thread_executor.submit(
-                get_zip_file_url, identifier)
-    
-    except NotFound:
-        # Handle the case where the bucket or objects are not found
-        print("Bucket or objects not found in GCS.")
-
-# Global variables
-dictUsers = {}
-
-mongo_client = connect_mongo_questions_db()
+# Resources warmed in the background and reported by /ready
+LAZY_RESOURCES = [gcs_client, gcs_bucket, redis_client, mongo_client]
 
 # Mongo Global vars
 DB_NAME = "slim-prediction"
@@ -120,9 +168,6 @@ DB_NAME = "slim-prediction"
 COLLECTION_NAME = "JSONInfo"
 AMOUNT_PARTS = 7.0
 
-# Initialize default values
-init_default_value_for_dict_users()
-
 def _checkDBSession(clientDB):
     '''
     Check if the current connection is valid
@@ -144,85 +189,114 @@ def mongoReplace(id, errorMessage):
         collection.replace_one(
             {"id": id}, {"id": id, "error": errorMessage, "timestamp": datetime.now()})
 
-def startIndexing(image_data, indexerPath, vendor, category):
+def startIndexing(vectors, indexerPath, vendor, category, settings, shards=1, shardWorkers=None):
+    '''
+    Build the index of a vendor/category with the engine of its settings
+    :param vectors: (n, dim) float32 matrix, row i becomes item i. May be memory-mapped for out-of-core builds.
+    :param settings: Index settings with the engine, the metric and the engine parameters, see indexTuning.
+                     "on_disk" builds Annoy indexes straight into their file.
+    :param shards: Amount of shards, built in parallel processes if more than one
+    :param shardWorkers: Shards built at the same time
+    :return: (path of the index file, None), or (list of shard file paths, list of shard descriptions)
+    '''
     if not os.path.exists(indexerPath):
         os.makedirs(indexerPath)
 
-    # Length of item vector that will be indexed
-    f = len(image_data['features'][0])
-    t = AnnoyIndex(f, 'euclidean')
-    for i, v in tqdm.tqdm(zip(image_data.index, image_data['features'])):
-        t.add_item(i, v)
-        # print(t, i, v)
-    t.build(100)  # 100 trees
-    t.save(os.path.join(indexerPath, vendor + '_' + category + '_fvecs.ann'))
-
-
-def downloadPackage(args):
-    bucket_name = args[0]
-    package = args[1]
-    sub_task_id = args[2]
-
-    def download_single_object(obj):
-        try:
-            blob = gcs_client.bucket(bucket_name).blob(obj)
-            gcs_bytes = blob.download_as_bytes()
-            arr_numpy = numpy.frombuffer(gcs_bytes, dtype=numpy.float32)
-            return arr_numpy
-        except Exception as e:
-            print(e)
-            return None
+    prefix = vendor + '_' + category + '_fvecs'
+    if shards > 1:
+        return shardedIndex.build_shards(vectors, settings, indexerPath, prefix, shards, shardWorkers)
 
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(download_single_object, obj) for obj in package]
-        results = [future.result() for future in as_completed(futures) if future.result() is not None]
+    indexFilePath = os.path.join(indexerPath, indexEngines.index_file_name(prefix, settings['engine']))
+    indexEngines.get_engine(settings['engine']).build(vectors, settings, indexFilePath)
+    return indexFilePath, None
 
-    feature_len = len(results[0]) if results else 0
 
-    return [results, feature_len, sub_task_id]
+def downloadFeatureMaps(identifier, names, loader, progress=None):
+    '''
+    Download the feature maps of images straight into their rows of the loader through the shared fetcher
+    :param progress: Optional function(done, total)
+    :return: FetchReport with the loaded names and the error of every name that failed
+    '''
+    def handle(name, gcs_bytes):
+        return loader.set(name, numpy.frombuffer(gcs_bytes, dtype=numpy.float32))
+
+    report = blob_fetcher.fetch_many(gcs_bucket, names, handle, buildManifest.feature_map_name, progress)
+    metrics.count_gcs_bytes('in', report.bytes)
+    metrics.count_items('indexer', 'feature_maps_downloaded', len(report.loaded))
+    print(f'{identifier}: downloaded {report.describe()}')
+    if report.failed:
+        metrics.count_failure('indexer', 'download')
+        for name, error in report.failed.items():
+            print(f'{identifier}: failed to download the feature map of {name}: {error}')
+        failedNames = list(report.failed)
+        mongoReplace(identifier, f'{len(failedNames)} feature maps failed to download: '
+                                 f'{failedNames[:FAILED_NAMES_REPORTED]}')
+    return report
+
+def list_feature_map_generations(universalUuids):
+    '''
+    List the feature maps of the given uploads without downloading them
+    :param universalUuids: universal_uuid values of the JSONInfo documents
+    :return: Dictionary of feature map object name -> GCS generation
+    '''
+    generations = {}
+    for universalUuid in universalUuids:
+        for blob in gcs_client.list_blobs(gcs_bucket_name, prefix="featuremap/" + universalUuid):
+            generations[blob.name] = blob.generation
+    return generations
 
 def is_zip_file_exists(object_name:str):
     blob = gcs_bucket.blob(object_name)
     return blob.exists()
 
-def get_remote_zip_file_size(object_name: str):
+def get_remote_content_hash(object_name: str):
+    '''
+    :return: Content hash stored in the metadata of an uploaded archive, None if there is none
+    '''
     try:
-        size_in_bytes = gcs_bucket.get_blob(object_name).size
-        return size_in_bytes
+        blob = gcs_bucket.get_blob(object_name)
+        if blob is None or not blob.metadata:
+            return None
+        return blob.metadata.get(CONTENT_HASH_METADATA_KEY)
     except Exception as e:
-        print(f"Error getting size for GCS object {object_name}: {e}")
+        print(f"Error getting content hash for GCS object {object_name}: {e}")
         return None
 
-def upload_zip_to_gcs(object_name, zip_data):
+def upload_zip_to_gcs(object_name, zip_path, content_hash):
+    '''
+    Upload an archive from disk with a resumable, chunked upload, so it is never held in memory
+    :return: Generation of the uploaded object, None on failure
+    '''
     try:
-        blob = gcs_bucket.blob(object_name)
-        blob.upload_from_file(zip_data, content_type='application/zip')
+        blob = gcs_bucket.blob(object_name, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.metadata = {CONTENT_HASH_METADATA_KEY: content_hash}
+        blob.upload_from_filename(zip_path, content_type='application/zip', checksum='crc32c')
+        metrics.count_gcs_bytes('out', os.path.getsize(zip_path))
+        return blob.generation
     except Exception as e:
         print(f"Error in upload process: {e}")
+        return None
 
+def compute_content_hash(image_file_names, vectors, settings):
+    '''
+    MD5 over everything that goes into an archive. Annoy trees and the Fernet token of the info file
+    differ on every build, so the hash is taken from the inputs instead of the archive bytes.
+    '''
+    hlib = hashlib.md5()
+    hlib.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    hlib.update(json.dumps(image_file_names).encode('utf-8'))
+    hlib.update(numpy.ascontiguousarray(vectors).data)
+    return hlib.hexdigest()
 
-def generate_signed_url(object_name: str):
-    try:
-        blob = gcs_bucket.blob(object_name)
-
-        # Fetch expiration_time from environment variable or use a default value (900 seconds)
-        expiration_time = int(os.getenv("EXPIRATION_TIME_SECONDS", 900))
-
-        expiration = datetime.utcnow() + timedelta(seconds=expiration_time)
-
-        signed_url = blob.generate_signed_url(
-            expiration=expiration,
-            version='v4',
-            method='GET',
-        )
-
-        return signed_url
-
-    except NotFound:
-        # Handle the case where the object is not found
-        return None
+def generateAnnoyIndexerTask(currentPath, vendor, category, progress=None):
+    '''
+    Build, publish and upload the index of a vendor/category
+    :param progress: Optional function(stage, percent) called whenever the build moves on
+    :return: SignedUrl of the archive on success (None if it is missing), (description, status code) otherwise
+    '''
+    progress = progress or (lambda stage, percent: None)
+    progress('query', 0)
 
-def generateAnnoyIndexerTask(currentPath, vendor, category):
     # Init MongoDB
     session = _checkDBSession(mongo_client)
     if not session:
@@ -234,126 +308,204 @@ def generateAnnoyIndexerTask(currentPath, vendor, category):
     # Check MongoDB to see if the JSON files have a Preset File
     mypresetquery = {"preset_file_name": {"$exists": True},
                   "vendor": vendor, 'category': category}
-    mydoc = mycol.find(mypresetquery, {"image_file_names": 1})
-
+    mydoc = mycol.find(mypresetquery, {"image_file_names": 1, "universal_uuid": 1})
 
+    universalUuids = set()
     for x in mydoc:
         temp += x["image_file_names"]
+        universalUuids.add(x["universal_uuid"])
     if len(temp) == 0:
         return "Not Acceptable", 406
 
-    imagesDict = {"image_file_names": temp}
-
-    # Get the feature maps of the specific images
-    featureFiles = ["featuremap/" +
-                    obj.rsplit('.', 1)[0] + ".bin" for obj in temp]
-    arrayParts = []
-    idx = 0
-    fileTuples = []
-    count = 100
-    for idx in range(0, len(featureFiles), count):
-        fileTuples.append((idx, min(idx + count, len(featureFiles))))
-
-    subTaskId = 0
-
-    with ThreadPoolExecutor() as executor:
-        args = []
-        
-        if environment == 'development':
-            for fileChunkIdx in fileTuples[:1]:
-                args.append([gcs_bucket_name, featureFiles[fileChunkIdx[0]: fileChunkIdx[1]], subTaskId])
-                subTaskId += 1
-        else:
-            for fileChunkIdx in fileTuples:
-                args.append([gcs_bucket_name, featureFiles[fileChunkIdx[0]: fileChunkIdx[1]], subTaskId])
-                subTaskId += 1
-
-
-        results = list(executor.map(downloadPackage, args))
-
-        idx = 0
-        for obj in results:
-            arrayParts += obj[0]
-            if idx == 0:
-                imagesDict['length'] = obj[1]
-            idx += 1
-
-    # Create a dataframe and create the indexer
-    df = pandas.DataFrame()
-    df['features'] = arrayParts
+    identifier = f"{vendor}_{category}"
+    zip_file_name = f"{identifier}.zip"
+
+    # Compare the feature maps in GCS with the manifest of the last build
+    progress('manifest', 5)
+    manifest = buildManifest.create_manifest(temp, list_feature_map_generations(universalUuids))
+    previousManifest = index_store.manifest(identifier)
+    if buildManifest.is_unchanged(previousManifest, manifest) and is_zip_file_exists(zip_file_name):
+        print(f'No feature map changes for {identifier} since the last build. Skipping.')
+        return signed_url_cache.get(zip_file_name)
+
+    # New uploads landed, cached part documents may be outdated
+    part_cache.invalidate()
+
+    reusedNames, downloadNames = buildManifest.diff_manifest(previousManifest, manifest)
+    print(f'{identifier}: reusing {len(reusedNames)} feature maps, {len(downloadNames)} added or changed')
+
+    # Check the estimated memory of the build against the ceiling before downloading anything
+    vectorCount = len(manifest['entries'])
+    indexDimension = vectorReduction.REDUCTION_DIMENSION if vectorReduction.REDUCTION_METHOD != 'none' \
+        else FEATURE_DIMENSION
+    plan = buildPlan.plan_build(vectorCount, FEATURE_DIMENSION, indexDimension,
+                                indexEngines.choose_engine(vectorCount, indexDimension))
+    print(f'{identifier}: build plan {plan.describe()}')
+    if not plan.fits:
+        print(f'{identifier}: estimated {plan.estimatedBytes} bytes exceed the build memory ceiling of '
+              f'{plan.ceiling} bytes. Refusing the build.')
+        return "Build exceeds the memory ceiling", 507
+
+    # Out-of-core builds keep their vector matrices in files outside of the archive folder
+    scratchPath = os.path.join(currentPath, 'DownloadFiles', identifier + '_scratch')
+    if plan.onDisk:
+        os.makedirs(scratchPath, exist_ok=True)
+
+    # Every vector is written into its row of one matrix, keyed by the position of its image name
+    loader = VectorMatrixLoader(manifest['entries'].keys(),
+                                backingPath=os.path.join(scratchPath, 'vectors.npy') if plan.onDisk else None)
+
+    # Vectors still valid for their generation are read from the local vector cache
+    cachedNames = vector_cache.load_into(identifier, manifest['entries'], loader)
+
+    # Remaining unchanged images are taken from the last published index
+    reusedNames = [name for name in reusedNames if name not in cachedNames]
+    previous = index_store.get(identifier) if reusedNames else None
+    if previous is not None and (previous.projection is not None or previous.engine == 'hnsw'):
+        # The last index only holds reduced (or, for the graph index, normalised) vectors, the full ones
+        # have to be downloaded again
+        downloadNames += reusedNames
+        reusedNames = []
+    if reusedNames:
+        for name in reusedNames:
+            loader.set(name, previous.item_vector(previous.name_to_id[name]))
+    downloadNames = [name for name in downloadNames if name not in cachedNames]
+    print(f'{identifier}: downloading {len(downloadNames)} feature maps from GCS')
+
+    # Get the feature maps of the added or changed images
+    if environment == 'development':
+        downloadNames = downloadNames[:100]
+
+    progress('download', 10)
+    downloadFeatureMaps(identifier, downloadNames, loader,
+                        lambda done, total: progress('download', 10 + int(60 * done / total)))
+
+    vector_cache.put_many(identifier, [(name, manifest['entries'][name], loader.row(name))
+                                       for name in downloadNames + reusedNames if loader.has(name)])
+
+    missingNames = loader.missing_names()
+    if missingNames:
+        print(f'{identifier}: {len(missingNames)} feature maps could not be loaded and are left out')
+
+    # Annoy item ids follow the manifest order without gaps, so they match the _info.json name list
+    imageNames, vectors = loader.compact()
+    if len(imageNames) == 0:
+        shutil.rmtree(scratchPath, ignore_errors=True)
+        return "Not Acceptable", 406
+    manifest = buildManifest.restrict_manifest(manifest, imageNames)
+    vector_cache.store(identifier).retain(imageNames)
 
     downloadLocation = currentPath + '/DownloadFiles'
     downloadTotalPath = os.path.join(
         currentPath, downloadLocation, vendor + ' ' + category)
-    print('Start Indexing')
+    os.makedirs(downloadTotalPath, exist_ok=True)
+
+    # Optional PCA / random projection, saved next to the index so query vectors can be reduced the same way
+    progress('reduce', 70)
+    projection = vectorReduction.fit_projection(vectors)
+    projectionPath = None
+    indexVectors = vectors
+    if projection is not None:
+        out = numpy.lib.format.open_memmap(os.path.join(scratchPath, 'reduced.npy'), mode='w+', dtype=numpy.float32,
+                                           shape=(vectors.shape[0], projection.dimension)) if plan.onDisk else None
+        indexVectors = projection.transform(vectors, out=out)
+        projectionPath = os.path.join(downloadTotalPath, identifier + vectorReduction.PROJECTION_FILE_SUFFIX)
+        projection.save(projectionPath)
+        manifest['reduction'] = projection.describe()
+        print(f'{identifier}: reduced {projection.input_dimension} to {projection.dimension} dimensions '
+              f'with {projection.method}')
+
+    # Engine, metric and engine parameters: chosen and tuned for this vendor/category or the defaults
+    progress('tune', 70)
+    indexSettings = indexTuning.select_settings((previousManifest or {}).get('index_settings'), indexVectors)
+    manifest['index_settings'] = indexSettings
+    print(f"{identifier}: {indexSettings['engine']} index, {indexEngines.content_settings(indexSettings)}")
+    imagesDict = {"image_file_names": imageNames, "length": indexVectors.shape[1],
+                  "engine": indexSettings['engine'], "metric": indexSettings['metric'],
+                  "search_k": indexSettings['search_k'],
+                  "index_file": indexEngines.index_file_name(identifier + '_fvecs', indexSettings['engine']),
+                  "index_settings": indexEngines.content_settings(indexSettings)}
+    if projection is not None:
+        imagesDict["projection"] = dict(projection.describe(),
+                                        file=identifier + vectorReduction.PROJECTION_FILE_SUFFIX)
+
+    # Very large vendor/categories are split into shards that are built in parallel and queried scatter-gather
+    # (or because the build plan split them to stay within the memory ceiling)
+    shards = min(plan.shards, indexVectors.shape[0])
+    manifest['shards'] = shards
 
-    startIndexing(df, downloadTotalPath, vendor, category)
+    print('Start Indexing')
+    progress('build', 70)
+
+    indexerPath, shardList = startIndexing(indexVectors, downloadTotalPath, vendor, category,
+                                           dict(indexSettings, on_disk=plan.onDisk), shards, plan.shardWorkers)
+    if shardList is not None:
+        print(f'{identifier}: built {len(shardList)} shards')
+        imagesDict["shards"] = shardList
+        del imagesDict["index_file"]
+        with open(os.path.join(downloadTotalPath, identifier + shardedIndex.SHARD_MANIFEST_SUFFIX), 'w') as outfile:
+            json.dump({'engine': indexSettings['engine'], 'dimension': imagesDict['length'],
+                       'metric': indexSettings['metric'], 'shards': shardList}, outfile)
+
+    metrics.count_items('indexer', 'vectors_indexed', indexVectors.shape[0])
+
+    # Serve the new index locally, queries swap to it on their next request
+    progress('publish', 80)
+    index_store.publish(identifier, indexerPath, imageNames,
+                        {'dimension': imagesDict['length'], 'metric': indexSettings['metric'],
+                         'search_k': indexSettings['search_k'], 'projection': imagesDict.get('projection'),
+                         'engine': indexSettings['engine'], 'index_settings': indexSettings,
+                         'shards': shardList},
+                        manifest, projectionPath)
 
-    indexerPath = os.path.join(
-        downloadTotalPath, vendor + '_' + category + '_fvecs.ann')
+    print('Write output')
+    progress('encrypt', 85)
+    # Id -> name table in independently encrypted chunks, clients look up ids without decrypting everything
+    cipher = fernetHandler(os.getenv('ENCRYPTION_KEY'))
+    imagesDict["id_table"] = idTable.write_id_table(
+        os.path.join(downloadTotalPath, identifier + idTable.ID_TABLE_FILE_SUFFIX), imageNames, cipher)
+    if not INFO_IMAGE_NAMES:
+        del imagesDict["image_file_names"]
 
     # Create JSON File
-    json_object = json.dumps(imagesDict, indent=4)
+    json_object = json.dumps(imagesDict, separators=(',', ':'))
     jsonPath = os.path.join(downloadTotalPath, vendor +
                             '_' + category + "_info.json")
 
-    print('Write output')
     with open(jsonPath, "w") as outfile:
         outfile.write(encryptMessage(os.getenv('ENCRYPTION_KEY'), json_object))
 
-    # Download Both
-    # Zip files
-    print('Zip stuff')
-    
-    # Create the zip file in memory
-    archive = io.BytesIO()
-    with ZipFile(archive, 'w') as zip_archive:
-        for file_path in Path(downloadTotalPath).iterdir():
-            with open(file_path, 'rb') as file:
-                zip_entry_name = file_path.name
-                zip_file = ZipInfo(zip_entry_name)
-                zip_archive.writestr(zip_file, file.read())
-
-    archive.seek(0)
-                    
-    # Check if the zip file already exists in GCS
-    zip_file_name = f"{vendor}_{category}.zip"
-    if is_zip_file_exists(zip_file_name):
-        # If it exists, check the size
-        remote_zip_size = get_remote_zip_file_size(zip_file_name)
-
-        if remote_zip_size is not None:
-            # If the size is available, compare with in-memory size
-            in_memory_zip_size = archive.getbuffer().nbytes
-
-            if remote_zip_size == in_memory_zip_size:
-                # Skip upload if sizes match
-                print("Zip file already exists in GCS with the same size. Skipping upload.")
-            else:
-                # Upload the new zip file if sizes don't match
-                upload_zip_to_gcs(zip_file_name, archive)
-        else:
-            # Handle the case where size information is not available
-            print("Warning: Size information for remote zip file is not available.")
-            # Proceed with the upload as a precaution
-            upload_zip_to_gcs(zip_file_name, archive)
+    contentHash = compute_content_hash(imageNames, vectors, dict(indexEngines.content_settings(indexSettings),
+                                                                 reduction=vectorReduction.settings(),
+                                                                 shards=shards,
+                                                                 id_table=idTable.ID_TABLE_CHUNK_SIZE,
+                                                                 info_names=INFO_IMAGE_NAMES))
+
+    # Skip the upload if the archive in GCS was built from the same content
+    uploadedGeneration = None
+    if get_remote_content_hash(zip_file_name) == contentHash:
+        print("Zip file with the same content already exists in GCS. Skipping upload.")
     else:
-        # Upload the zip file if it doesn't exist in GCS
-        upload_zip_to_gcs(zip_file_name, archive)
+        # Zip files on disk and stream them to GCS
+        print('Zip stuff')
+        progress('zip', 88)
+        zipPath = downloadTotalPath + '.zip'
+        try:
+            write_zip_archive(downloadTotalPath, zipPath, UPLOAD_CHUNK_SIZE)
+            progress('upload', 90)
+            uploadedGeneration = upload_zip_to_gcs(zip_file_name, zipPath, contentHash)
+        finally:
+            if os.path.exists(zipPath):
+                os.remove(zipPath)
 
     # Cleanup files
     shutil.rmtree(downloadTotalPath)
+    shutil.rmtree(scratchPath, ignore_errors=True)
 
-    signed_url = generate_signed_url(zip_file_name)
-
-    identifier = f"{vendor}_{category}"
-
-    dictUsers[identifier] = thread_executor.submit(
-                signed_url, identifier)
-
-    return signed_url
+    return signed_url_cache.get(zip_file_name, uploadedGeneration)
 
 
+@functools.lru_cache(maxsize=8)
 def generateFernetKey(passcode):
     assert isinstance(passcode, bytes)
     hlib = hashlib.md5()
@@ -361,20 +513,115 @@ def generateFernetKey(passcode):
     return base64.urlsafe_b64encode(hlib.hexdigest().encode('latin-1'))
 
 
+@functools.lru_cache(maxsize=8)
+def fernetHandler(key):
+    '''
+    Fernet handler of an encryption key, the key is only derived once
+    '''
+    return F(generateFernetKey(key.encode('utf-8')))
+
+
 def encryptMessage(key, msg):
-    encoded_key = generateFernetKey(key.encode('utf-8'))
-    handler = F(encoded_key)
+    handler = fernetHandler(key)
     encoded_msg = msg if isinstance(msg, bytes) else msg.encode()
     treatment = handler.encrypt(encoded_msg)
     return str(treatment, 'utf-8')
 
 
-@application.route("/annoy-indexer-setup/<vendor>/<cat>", methods=['GET'])
+def decryptMessage(key, msg):
+    handler = fernetHandler(key)
+    encoded_msg = msg if isinstance(msg, bytes) else msg.encode()
+    return str(handler.decrypt(encoded_msg), 'utf-8')
+
+
+def sync_index_from_gcs(vendor, category):
+    '''
+    Publish the last uploaded archive of a vendor/category into the local index store, used when this
+    instance did not build the index itself
+    :return: True on success, False otherwise
+    '''
+    identifier = f"{vendor}_{category}"
+    syncPath = os.path.join(current_app.root_path, 'DownloadFiles', identifier + ' sync')
+    os.makedirs(syncPath, exist_ok=True)
+    zipPath = syncPath + '.zip'
+    try:
+        try:
+            gcs_bucket.blob(f"{identifier}.zip", chunk_size=UPLOAD_CHUNK_SIZE).download_to_filename(zipPath)
+        except NotFound:
+            return False
+        with ZipFile(zipPath, 'r') as zip_archive:
+            zip_archive.extractall(syncPath)
+        with open(os.path.join(syncPath, identifier + '_info.json'), 'r') as file:
+            imagesDict = json.loads(decryptMessage(os.getenv('ENCRYPTION_KEY'), file.read()))
+        projection = imagesDict.get('projection')
+        # Archives built before engines were pluggable hold an Annoy index
+        engine = imagesDict.get('engine', 'annoy')
+        shardList = imagesDict.get('shards')
+        if shardList:
+            indexFilePath = [os.path.join(syncPath, shard['file']) for shard in shardList]
+        else:
+            indexFilePath = os.path.join(syncPath, imagesDict.get('index_file', identifier + '_fvecs.ann'))
+        if 'image_file_names' in imagesDict:
+            imageNames = imagesDict['image_file_names']
+        else:
+            imageNames = idTable.IdTable(os.path.join(syncPath, imagesDict['id_table']['file']),
+                                         fernetHandler(os.getenv('ENCRYPTION_KEY'))).all_names()
+        index_store.publish(identifier, indexFilePath, imageNames,
+                            {'dimension': imagesDict['length'], 'metric': imagesDict.get('metric', 'euclidean'),
+                             'search_k': imagesDict.get('search_k', -1), 'projection': projection,
+                             'engine': engine, 'index_settings': imagesDict.get('index_settings'),
+                             'shards': shardList},
+                            projectionPath=os.path.join(syncPath, projection['file']) if projection else None)
+    finally:
+        shutil.rmtree(syncPath, ignore_errors=True)
+        if os.path.exists(zipPath):
+            os.remove(zipPath)
+    return True
+
+
+def trackedAnnoyIndexerTask(currentPath, vendor, cat, lock, heartbeat=None):
+    '''
+    Run a build and record its state, stage, progress and timings in the shared job store
+    and in the stage metrics. The caller must have taken the build lock with job_store.try_acquire.
+    :param heartbeat: Heartbeat of the lock started when the job was queued, started here otherwise
+    '''
+    id = str(vendor + '_' + cat)
+    heartbeat = heartbeat or job_store.heartbeat(id, lock)
+    job_store.start(id)
+    stages = metrics.StageTimer('indexer')
+
+    def progress(stage, percent):
+        stages.enter(stage)
+        job_store.progress(id, stage, percent)
+
+    try:
+        try:
+            result = generateAnnoyIndexerTask(currentPath, vendor, cat, progress)
+        finally:
+            heartbeat.stop()
+    except Exception as error:
+        stages.fail()
+        job_store.fail(id, lock, str(error))
+        raise
+    if isinstance(result, tuple):
+        stages.fail()
+        job_store.fail(id, lock, f'{result[1]} {result[0]}')
+    else:
+        stages.finish()
+        # The generation lets status polls sign the archive URL without looking the object up in GCS
+        job_store.finish(id, lock, result.url if result else None, result.generation if result else None)
+    return result
+
+
+@bp.route("/annoy-indexer-setup/<vendor>/<cat>", methods=['GET'])
 def annoyIndexer(vendor, cat):
     id = str(vendor + '_' + cat)
-    if id not in dictUsers:
-        dictUsers[id] = thread_executor.submit(
-            generateAnnoyIndexerTask, current_app.root_path, vendor, cat)
+    # Only the first request anywhere in the fleet starts a build, the others poll the same job
+    lock = job_store.try_acquire(id)
+    if lock is not None:
+        # The lock is kept alive while the job waits for one of the build threads
+        heartbeat = job_store.heartbeat(id, lock)
+        thread_executor.submit(trackedAnnoyIndexerTask, current_app.root_path, vendor, cat, lock, heartbeat)
     # Init MongoDB
     session = _checkDBSession(mongo_client)
     if not session:
@@ -382,197 +629,474 @@ def annoyIndexer(vendor, cat):
     return json.dumps({'id': id})
 
 
-@application.route("/get-annoy-indexer/<id>", methods=['GET'])
-def getAnnoyIndexer(id):
-    if id not in dictUsers:
-        return json.dumps({'id': id, 'result': 'id unknown'})
-    elif dictUsers[id].running():
-        return json.dumps({'id': id, 'result': 'running'})
-    elif dictUsers[id].cancelled():
-        return json.dumps({'id': id, 'result': 'cancelled'})
-    elif dictUsers[id].done():
-        object_name = f'{id}.zip'
-        signed_url = generate_signed_url(object_name)
-        if signed_url is not None:
-            return json.dumps({'id': id, 'result': 'done', 'fileUrl': signed_url})
-        else:
-            # Return a 404 response for file not found
-            abort(404, 'File not found')
-    else:
-        return json.dumps({'id': id, 'result': 'not started yet'})
-
+def job_status(id):
+    '''
+    Status reply of /get-annoy-indexer, shared by all workers through the job store
+    '''
+    job = job_store.get(id)
+    if job is None:
+        # Archives built earlier or by another worker are looked up lazily instead of at startup
+        signed = signed_url_cache.get(f'{id}.zip')
+        if signed is None:
+            return {'id': id, 'result': 'id unknown'}
+        return {'id': id, 'result': 'done', 'fileUrl': signed.url, 'generation': signed.generation}
+
+    details = {key: job.get(key) for key in ('stage', 'progress', 'timings', 'started_at', 'finished_at',
+                                             'updated_at')}
+    if job['state'] == STATE_QUEUED:
+        return dict(details, id=id, result='not started yet')
+    elif job['state'] == STATE_RUNNING:
+        return dict(details, id=id, result='running')
+    elif job['state'] == STATE_FAILED:
+        return dict(details, id=id, result='failed', error=job.get('error'))
+    signed = signed_url_cache.get(f'{id}.zip', job.get('generation'))
+    if signed is None:
+        return None
+    return dict(details, id=id, result='done', fileUrl=signed.url, generation=signed.generation)
 
-@application.route("/", methods=['GET'])
-def index():
-    return 'Running'
 
-# Acquire the non-blocking lock
-def acquire_indexing_lock():
-    return redis_client.setnx(INDEXING_LOCK_NAME, 1)
+def is_changed(status, since):
+    return status is None or status['result'] in FINAL_RESULTS or status.get('updated_at') != since
 
-# Release the lock
-def release_indexing_lock():
-    redis_client.delete(INDEXING_LOCK_NAME)
 
-# Semaphore for synchronization
-semaphore = Semaphore()
+def wait_for_job_change(id, since, timeout):
+    '''
+    Status of a job once it changed from the version "since" (its updated_at), it finished or the timeout passed.
+    Without "since" the status is returned on its next change. The request blocks on the job events instead of
+    polling Redis; if all waiter slots of this process are taken the current status is returned right away.
+    '''
+    if not job_events.try_enter():
+        return job_status(id)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            marker = job_events.marker(id)
+            status = job_status(id)
+            if since is None and status is not None:
+                since = status.get('updated_at')
+            remaining = deadline - time.monotonic()
+            if is_changed(status, since) or remaining <= 0:
+                return status
+            job_events.wait(id, marker, remaining)
+    finally:
+        job_events.leave()
 
-@application.route("/process", methods=['GET'])
-def process():
 
-     # Acquire the distributed lock
-    lock_acquired = acquire_indexing_lock()
+@bp.route("/get-annoy-indexer/<id>", methods=['GET'])
+def getAnnoyIndexer(id):
+    '''
+    Status of a job. With ?wait=seconds the request is held until the job changed from the version ?since=
+    (the "updated_at" of the last reply), instead of being polled.
+    '''
+    try:
+        wait = min(float(request.args.get('wait', 0)), JOB_WAIT_MAX_SECONDS)
+        since = float(request.args['since']) if 'since' in request.args else None
+    except ValueError:
+        abort(400, 'wait and since must be numbers')
+    status = wait_for_job_change(id, since, wait) if wait > 0 else job_status(id)
+    if status is None:
+        # Return a 404 response for file not found
+        abort(404, 'File not found')
+    return json.dumps(status)
+
+
+@bp.route("/annoy-indexer-events/<id>", methods=['GET'])
+def annoyIndexerEvents(id):
+    '''
+    Server-Sent Events stream of a job: a "status" event with the status reply on every change, until the job
+    is done or failed or JOB_STREAM_MAX_SECONDS passed
+    '''
+    if not job_events.try_enter():
+        return 'Too many waiting requests', 503, {'Retry-After': '1'}
+
+    def stream():
+        deadline = time.monotonic() + JOB_STREAM_MAX_SECONDS
+        sent = False
+        since = None
+        while True:
+            marker = job_events.marker(id)
+            status = job_status(id)
+            if not sent or is_changed(status, since):
+                yield f"event: status\ndata: {json.dumps(status or {'id': id, 'result': 'File not found'})}\n\n"
+                sent = True
+                since = status.get('updated_at') if status else None
+            if status is None or status['result'] in FINAL_RESULTS or time.monotonic() > deadline:
+                return
+            if not job_events.wait(id, marker, JOB_STREAM_HEARTBEAT_SECONDS):
+                yield ': keep-alive\n\n'
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The server closes the response when the stream ended or the client went away
+    response.call_on_close(job_events.leave)
+    return response
+
+
+@bp.route("/query/<vendor>/<cat>", methods=['POST'])
+def queryIndex(vendor, cat):
+    '''
+    Top-k nearest neighbour query against the locally served index of a vendor/category.
+    Body: {"vector": [...]} or {"image_file_name": "..."}, optional "k" (default 10) and "search_k"
+    (default: the tuned search_k of the index)
+    '''
+    content = request.json or {}
+    identifier = f"{vendor}_{cat}"
+    k = int(content.get('k', 10))
+
+    loaded = index_store.get(identifier)
+    if loaded is None and sync_index_from_gcs(vendor, cat):
+        loaded = index_store.get(identifier)
+    if loaded is None:
+        abort(404, 'Index not found')
+    search_k = int(content.get('search_k', loaded.search_k))
+
+    if 'vector' in content:
+        # Full feature vectors are reduced by the projection of the index, reduced ones are used as they are
+        if len(content['vector']) not in (loaded.dimension, loaded.input_dimension):
+            abort(400, f'Vector must have {loaded.input_dimension} dimensions')
+        results = loaded.query_by_vector(content['vector'], k, search_k)
+    elif 'image_file_name' in content:
+        results = loaded.query_by_name(content['image_file_name'], k, search_k)
+        if results is None:
+            abort(404, 'Image file name not in index')
+    else:
+        abort(400, 'Either "vector" or "image_file_name" is required')
 
-    print(f'===lock_acquired=== {lock_acquired}')
+    return jsonify({'id': identifier, 'version': loaded.version, 'results': results})
 
-    if not lock_acquired:
-        return jsonify({'status': False, 'msg': 'Indexing process is already in progress.'})
 
+@bp.route("/", methods=['GET'])
+def index():
+    return 'Running'
 
+@bp.route("/process", methods=['GET'])
+def process():
+    '''
+    Queue a build of every vendor/category. The builds are leased by the build workers of all nodes,
+    a new run is only refused while a task of the previous run is pending or leased by a live node.
+    '''
     try:
-        # Start the background task using a separate thread
-        threading.Thread(target=start_indexing_process).start()
-
-        print("Initiating indexing process...")
-
-        return jsonify({'status': True, 'msg': 'Indexing process has been initiated.'})
-
+        runId = enqueue_indexing_run()
     except Exception as error:
-        release_indexing_lock()
         print(f'Error in process: {error}')
         return jsonify({'status': False, 'msg': 'Error in Indexing Process'})
 
+    if runId is None:
+        return jsonify({'status': False, 'msg': 'Indexing process is already in progress.'})
+
+    print(f"Initiating indexing process {runId}...")
+    return jsonify({'status': True, 'msg': 'Indexing process has been initiated.', 'run_id': runId})
+
 
 def annoyIndexerJob(vendor, cat):
+    '''
+    Build the index of one vendor/category, runs inside a build worker process
+    :return: Dictionary with the id, the status ("done", "skipped" or "failed") and an error description
+    '''
+    id = str(vendor + '_' + cat)
+    # A build requested through /annoy-indexer-setup anywhere in the fleet covers this one
+    lock = job_store.try_acquire(id)
+    if lock is None:
+        return {'id': id, 'status': 'skipped', 'error': 'Build already queued or running'}
     try:
         with application.app_context():
-            id = str(vendor + '_' + cat)
             try:
-                generateAnnoyIndexerTask(current_app.root_path, vendor, cat)
+                result = trackedAnnoyIndexerTask(current_app.root_path, vendor, cat, lock)
                 # Init MongoDB
                 session = _checkDBSession(mongo_client)
                 if not session:
                     mongoReplace(id, 'Error getting the DB for Annoy IDX')
+                if isinstance(result, tuple):
+                    return {'id': id, 'status': 'failed', 'error': f'{result[1]} {result[0]}'}
+                return {'id': id, 'status': 'done'}
             except Exception as e:
                 print(f"An error occurred: {str(e)}")
                 mongoReplace(id, f'An error occurred: {str(e)}')
-            
-            return json.dumps({'id': id})
+                return {'id': id, 'status': 'failed', 'error': str(e)}
     except Exception as err:
         print(f"===Error in annoyIndexerJob: === {err}")
+        return {'id': id, 'status': 'failed', 'error': str(err)}
 
 
-def start_indexing_process():    
+def init_build_worker():
+    '''
+    Runs once in every forked build process. MongoClient and the GCS client are not fork safe,
+    so each build process opens its own connections on first use.
+    '''
+    for resource in LAZY_RESOURCES:
+        resource.reset_after_fork()
+    blob_fetcher.reset_after_fork()
+
+
+def count_vendor_vectors(vendor, category):
+    '''
+    Amount of images of a vendor/category, used to estimate the memory of its build
+    '''
+    session = _checkDBSession(mongo_client)
+    if not session:
+        return 0
+    pipeline = [
+        {"$match": {"preset_file_name": {"$exists": True}, "vendor": vendor, "category": category}},
+        {"$group": {"_id": None, "count": {"$sum": {"$size": "$image_file_names"}}}}
+    ]
+    result = list(session[DB_NAME][COLLECTION_NAME].aggregate(pipeline))
+    return result[0]["count"] if result else 0
+
+
+def report_indexing_status(identifier, status):
     try:
-        # Start the indexing process for each vendor_info sequentially
-        for vendor_info in vendor_information:
-            vendor = vendor_info.vendor
-            category = vendor_info.category
-            print(f'Start task to generate indexer for {vendor} - {category}')
+        redis_client.hset(INDEXING_STATUS_NAME, identifier, json.dumps(status))
+    except Exception as error:
+        print(f'Error reporting indexing status of {identifier}: {error}')
 
-            # Acquire the semaphore before starting the Annoy indexer task
-            semaphore.acquire()
 
-            try:
-                result = annoyIndexerJob(vendor, category)
+def enqueue_indexing_run():
+    '''
+    Queue one task per vendor/category with the memory estimate of its build
+    :return: Run id, None if the previous run is still in progress
+    '''
+    tasks = []
+    for vendor_info in vendor_information:
+        job = BuildJob(vendor_info.vendor, vendor_info.category,
+                       count_vendor_vectors(vendor_info.vendor, vendor_info.category))
+        tasks.append({'id': job.identifier, 'vendor': job.vendor, 'category': job.category,
+                      'estimated_bytes': job.estimatedBytes})
+
+    runId = build_queue.enqueue_run(tasks)
+    if runId is not None:
+        redis_client.delete(INDEXING_STATUS_NAME)
+        for task in tasks:
+            report_indexing_status(task['id'], {'state': 'queued', 'estimated_bytes': task['estimated_bytes']})
+    return runId
+
+
+def start_indexing_process(workerId):
+    '''
+    Build queued vendor/categories on this node until the queue is drained
+    '''
+    # Build several vendor/categories at once, within the memory budget of this machine
+    scheduler = BuildScheduler(annoyIndexerJob, initializer=init_build_worker, report=report_indexing_status)
+    print(f'Node {workerId} takes indexing tasks with a memory budget of {scheduler.memoryBudget} bytes')
+    results = scheduler.run_from_queue(build_queue, workerId)
 
-                if result:
-                    print(f'Task for {vendor} - {category} completed successfully')
-                else:
-                    print(f'Task for {vendor} - {category} failed')
+    for identifier, status in results.items():
+        print(f"Task for {identifier} finished with status {status.get('status')} "
+              f"in {status['duration_seconds']:.1f}s")
 
-            except Exception as error:
-                print(f'Error in annoyIndexerJob: {error}')
 
-            finally:
-                # Release the semaphore after completing the Annoy indexer task or in case of an exception
-                semaphore.release()
+def build_queue_worker():
+    '''
+    Build worker of this node. Every service process runs it, but only the one holding the node lock
+    file leases tasks, so the memory budget of the machine is not handed out several times.
+    '''
+    workerId = default_worker_id()
+    lockFile = open(BUILD_NODE_LOCK_PATH, 'a')
+    while True:
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except OSError:
+            # Another process of this node is the build worker, take over if it exits
+            time.sleep(BUILD_QUEUE_IDLE_SECONDS)
 
-    except Exception as error:
-        print(f'Error in start_indexing_process: {error}')
+    while True:
+        try:
+            if build_queue.peek() is not None:
+                start_indexing_process(workerId)
+        except Exception as error:
+            print(f'Error in build queue worker: {error}')
+        time.sleep(BUILD_QUEUE_IDLE_SECONDS)
 
-    finally:
-        release_indexing_lock()
 
+@bp.route("/indexing-status", methods=['GET'])
+def indexingStatus():
+    statuses = redis_client.hgetall(INDEXING_STATUS_NAME)
+    result = {key.decode(): json.loads(value) for key, value in statuses.items()}
+    queueStatus = build_queue.status()
+    result['_queue'] = {'run': queueStatus['run'], 'pending': queueStatus['pending'], 'leased': queueStatus['leased']}
+    return jsonify(result)
 
 
-@application.route("/find-matching-part", methods=['POST'])
+def ensure_part_indexes(collection):
+    '''
+    Create the multikey index on image_file_names once per process, so the $in lookups never scan
+    '''
+    global part_indexes_ensured
+    if not part_indexes_ensured:
+        collection.create_index("image_file_names")
+        part_indexes_ensured = True
+
+
+def lookup_parts(collection, names):
+    '''
+    Resolve image file names to their part documents, using the part cache and one $in query per batch
+    :return: Dictionary of image name -> part document, unknown names are left out
+    '''
+    partsByName, misses = part_cache.get_many(set(names))
+    for idx in range(0, len(misses), PART_LOOKUP_BATCH_SIZE):
+        batch = misses[idx: idx + PART_LOOKUP_BATCH_SIZE]
+        docs = list(collection.find({"image_file_names": {"$in": batch}}, {"_id": 0}))
+        part_cache.put_documents(docs)
+        for doc in docs:
+            for name in doc["image_file_names"]:
+                partsByName[name] = doc
+    return partsByName
+
+
+def build_part_histogram(views, partsByName):
+    '''
+    Count how many of the views belong to each part, normalised by AMOUNT_PARTS
+    '''
+    dictToReturn = {}
+    for obj in views:
+        res = partsByName.get(obj)
+        if res is None:
+            continue
+        id = res['universal_uuid'] + res['file_name']
+        if id not in dictToReturn:
+            dictToReturn[id] = dict(res, histo=1)
+        else:
+            dictToReturn[id]['histo'] += 1
+    for obj in dictToReturn:
+        dictToReturn[obj]['histo'] = float(dictToReturn[obj]['histo']) / AMOUNT_PARTS
+    return dictToReturn
+
+
+@bp.route("/find-matching-part", methods=['POST'])
 def findMatchingPart():
+    '''
+    Body: {"data": [view names]} returns the histogram of one part,
+    {"parts": [[view names], ...]} returns a list with one histogram per part
+    '''
     content = request.json
     session = _checkDBSession(mongo_client)
-    dictToReturn = {}
+    isBatch = "parts" in content
+    lstViews = content["parts"] if isBatch else [content["data"]]
+    histograms = [{} for _ in lstViews]
     if session:
         mycol = session[DB_NAME][COLLECTION_NAME]
-        # FInds an object using an array. The "in" keyword is used to search for the array values. It doesn't return duplicates.
-        amount = 0
-        try:
-            for obj in content["data"]:
-                res = mycol.find_one({"image_file_names": obj}, {"_id": 0})
-                id = res['universal_uuid'] + res['file_name']
-                if id not in dictToReturn:
-                    res['histo'] = 1
-                    dictToReturn[id] = res
-                else:
-                    dictToReturn[id]['histo'] += 1
-                amount += 1
-        except Exception as error:
-            mongoReplace(id, "Failed to find matching part.")
-            print(error)
         try:
-            for obj in dictToReturn:
-                dictToReturn[obj]['histo'] = float(
-                    dictToReturn[obj]['histo']) / AMOUNT_PARTS
+            ensure_part_indexes(mycol)
+            partsByName = lookup_parts(mycol, [obj for views in lstViews for obj in views])
+            histograms = [build_part_histogram(views, partsByName) for views in lstViews]
         except Exception as error:
-            mongoReplace(id, "Failed to find matching part.")
+            mongoReplace('find-matching-part', "Failed to find matching part.")
             print(error)
 
-    return json.dumps(dictToReturn)
+    return json.dumps(histograms if isBatch else histograms[0])
+
+
+@bp.route("/part-metadata/<vendor>/<cat>", methods=['GET'])
+def partMetadata(vendor, cat):
+    '''
+    Part documents of the parts in the index of a vendor/category, for clients that match parts offline
+    with the same histogram as /find-matching-part. Answers 304 to If-None-Match with the ETag of the last reply.
+    '''
+    session = _checkDBSession(mongo_client)
+    if not session:
+        return 'DB not reachable', 500
+    mycol = session[DB_NAME][COLLECTION_NAME]
+    parts = list(mycol.find({"preset_file_name": {"$exists": True}, "vendor": vendor, "category": cat}, {"_id": 0}))
+    response = Response(json.dumps({'vendor': vendor, 'category': cat, 'parts': parts}), mimetype='application/json')
+    response.set_etag(hashlib.md5(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+
+def send_cached_blob(object_name):
+    '''
+    Stream a GCS object from the local blob cache. For GET requests Range, If-None-Match and 304 replies
+    are handled by send_file.
+    '''
+    for attempt in range(2):
+        try:
+            entry = blob_cache.get(object_name)
+            return send_file(entry.path, mimetype=entry.contentType, etag=entry.etag, conditional=True,
+                             download_name=os.path.basename(object_name), max_age=BLOB_CACHE_MAX_AGE_SECONDS)
+        except NotFound:
+            abort(404, 'File not found')
+        except FileNotFoundError:
+            # Evicted by another worker between the cache lookup and opening it, fetch it again
+            if attempt:
+                raise
 
 
-@application.route("/get-preset-file", methods=['POST'])
+@bp.route("/get-preset-file", methods=['POST'])
 def getPresetFile():
     content = request.json
     request_preset_file = content["data"]
-    request_preset_file_key = f"preset/{request_preset_file}"
+    return send_cached_blob(f"preset/{request_preset_file}")
 
-    try:
-        blob = gcs_client.bucket(gcs_bucket_name).blob(request_preset_file_key)
-        gcs_preset_bytes = blob.download_as_bytes()
-    except Exception as error:
-        print(error)
 
-    return gcs_preset_bytes
+@bp.route("/get-preset-file/<path:name>", methods=['GET'])
+def getPresetFileByName(name):
+    return send_cached_blob(f"preset/{name}")
 
 
-@application.route("/get-img-file", methods=['POST'])
+@bp.route("/get-img-file", methods=['POST'])
 def getImageFile():
     content = request.json
     request_image_file = content["data"]
-    request_image_file_key = f"img/{request_image_file}"
+    return send_cached_blob(f"img/{request_image_file}")
 
-    try:
-        blob = gcs_client.bucket(gcs_bucket_name).blob(request_image_file_key)
-        gcs_image_bytes = blob.download_as_bytes()
-    except Exception as error:
-        print(error)
 
-    return gcs_image_bytes
+@bp.route("/get-img-file/<path:name>", methods=['GET'])
+def getImageFileByName(name):
+    return send_cached_blob(f"img/{name}")
 
 
+@bp.route("/metrics", methods=['GET'])
+def metricsEndpoint():
+    '''
+    Stage timings, failures, GCS bytes and processed items in the Prometheus text format
+    '''
+    return metrics.metrics_response()
 
-@application.route("/is-alive", methods=['GET'])
+
+@bp.route("/is-alive", methods=['GET'])
 def isAlive():
     return json.dumps({'alive': 1})
 
-@application.route("/reset-redis", methods=['GET'])
+@bp.route("/reset-redis", methods=['GET'])
 def resetRedis():
     try:
-        # Delete the indexing lock in Redis
+        # Delete the indexing lock and the build queue in Redis
         redis_client.delete(INDEXING_LOCK_NAME)
+        build_queue.clear()
         return jsonify({'status': True, 'msg': 'Redis reset successful.'})
     except Exception as error:
         return jsonify({'status': False, 'msg': f'Error resetting Redis: {str(error)}'})
 
 
+@bp.route("/ready", methods=['GET'])
+def ready():
+    '''
+    Readiness probe: 200 once all clients exist, 503 while they are still being created in the background
+    '''
+    isReady, states = readiness(LAZY_RESOURCES)
+    if not isReady:
+        warm_in_background(LAZY_RESOURCES)
+    return jsonify({'ready': isReady, 'resources': states}), 200 if isReady else 503
+
+
+def create_app():
+    '''
+    Application factory. Clients are created lazily on first use; EAGER_INIT=1 creates them right away
+    (the old behaviour), WARM_ON_START=1 creates them in a background thread after startup.
+    '''
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    if EAGER_INIT:
+        warm(LAZY_RESOURCES)
+    elif WARM_ON_START:
+        warm_in_background(LAZY_RESOURCES)
+    if BUILD_QUEUE_WORKER:
+        threading.Thread(target=build_queue_worker, daemon=True).start()
+    return app
+
+
+# Flask application
+application = create_app()
+
+
 if __name__ == '__main__':
     application.run(port=int(os.environ.get("PORT", 8080)),host='0.0.0.0',debug=True, threaded=True)
@@ -0,0 +1,118 @@
+import os
+import time
+import hashlib
+import threading
+from google.api_core.exceptions import NotFound
+
+# Local disk cache of GCS objects served by /get-img-file and /get-preset-file
+BLOB_CACHE_PATH = os.getenv("BLOB_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "BlobCache"))
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", 1024 ** 3))
+# Cached objects are checked against the generation in GCS at most once in this interval
+BLOB_CACHE_REVALIDATE_SECONDS = int(os.getenv("BLOB_CACHE_REVALIDATE_SECONDS", 60))
+# Downloads are serialised per object through a fixed number of locks, objects sharing a lock wait for each other
+BLOB_DOWNLOAD_LOCK_STRIPES = 64
+
+
+class CachedBlob:
+    def __init__(self, name, generation, path, contentType):
+        self.name = name
+        self.generation = generation
+        self.path = path
+        self.contentType = contentType
+        self.checkedAt = time.time()
+
+    @property
+    def etag(self):
+        return f"{self.generation}"
+
+
+class BlobCache:
+    '''
+    Size-bounded LRU cache of GCS objects on disk. Files are named after the object name and generation,
+    so a re-uploaded object never serves the old content. Least recently served files are evicted first.
+    '''
+
+    def __init__(self, bucket, rootPath=BLOB_CACHE_PATH, maxBytes=BLOB_CACHE_MAX_BYTES,
+                 revalidateSeconds=BLOB_CACHE_REVALIDATE_SECONDS):
+        self.bucket = bucket
+        self.rootPath = rootPath
+        self.maxBytes = maxBytes
+        self.revalidateSeconds = revalidateSeconds
+        self._entries = {}
+        self._lock = threading.Lock()
+        # A lock per object name would grow with every name ever requested
+        self._downloadLocks = [threading.Lock() for _ in range(BLOB_DOWNLOAD_LOCK_STRIPES)]
+
+    def _file_path(self, name, generation):
+        return os.path.join(self.rootPath, hashlib.sha256(name.encode('utf-8')).hexdigest() + f"-{generation}")
+
+    def _download_lock(self, name):
+        return self._downloadLocks[hash(name) % len(self._downloadLocks)]
+
+    def get(self, name):
+        '''
+        Get a local copy of a GCS object, downloading it if it is missing or outdated
+        :return: CachedBlob, raises google.api_core.exceptions.NotFound if the object does not exist
+        '''
+        entry = self._entries.get(name)
+        if entry is not None and time.time() - entry.checkedAt < self.revalidateSeconds and os.path.exists(entry.path):
+            os.utime(entry.path)
+            return entry
+
+        # Only one thread downloads an object, the others wait and use its result
+        with self._download_lock(name):
+            entry = self._entries.get(name)
+            if entry is not None and time.time() - entry.checkedAt < self.revalidateSeconds and os.path.exists(entry.path):
+                return entry
+
+            blob = self.bucket.get_blob(name)
+            if blob is None:
+                raise NotFound(f'{name} not found')
+
+            path = self._file_path(name, blob.generation)
+            if not os.path.exists(path):
+                os.makedirs(self.rootPath, exist_ok=True)
+                tempPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                # Pin the generation that was just checked, so the file always matches its name
+                self.bucket.blob(name, generation=blob.generation).download_to_filename(tempPath)
+                os.replace(tempPath, path)
+                self.evict()
+            else:
+                os.utime(path)
+
+            if entry is not None and entry.path != path and os.path.exists(entry.path):
+                os.remove(entry.path)
+            entry = CachedBlob(name, blob.generation, path, blob.content_type or 'application/octet-stream')
+            with self._lock:
+                self._entries[name] = entry
+            return entry
+
+    def evict(self):
+        '''
+        Remove the least recently used files until the cache fits into maxBytes again
+        '''
+        files = []
+        removed = set()
+        totalBytes = 0
+        for obj in os.listdir(self.rootPath):
+            if obj.endswith('.tmp'):
+                continue
+            path = os.path.join(self.rootPath, obj)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, path, stat.st_size))
+            totalBytes += stat.st_size
+
+        for _, path, size in sorted(files):
+            if totalBytes <= self.maxBytes:
+                break
+            # Responses still streaming from an evicted file keep their open handle
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            removed.add(path)
+            totalBytes -= size
+
+        with self._lock:
+            for name in [name for name, entry in self._entries.items() if entry.path in removed]:
+                del self._entries[name]
@@ -0,0 +1,76 @@
+import os
+import json
+from datetime import datetime
+
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_FORMAT_VERSION = 1
+
+
+def feature_map_name(image_file_name):
+    '''
+    Name of the GCS feature map object belonging to an image
+    '''
+    return "featuremap/" + image_file_name.rsplit('.', 1)[0] + ".bin"
+
+
+def create_manifest(image_file_names, generations):
+    '''
+    Create the manifest of a build from the image names in MongoDB and the feature map generations in GCS.
+    Images without a feature map in GCS are left out, they are picked up as soon as their feature map exists.
+    :param image_file_names: Image names of the vendor/category in MongoDB order
+    :param generations: Dictionary of feature map object name -> GCS generation
+    :return: Manifest dictionary
+    '''
+    entries = {}
+    for name in image_file_names:
+        generation = generations.get(feature_map_name(name))
+        if generation is not None:
+            entries[name] = generation
+    return {'format': MANIFEST_FORMAT_VERSION, 'entries': entries}
+
+
+def restrict_manifest(manifest, image_file_names):
+    '''
+    Keep only the given images in the manifest, e.g. after some feature maps failed to download
+    '''
+    entries = manifest['entries']
+    return dict(manifest, entries={name: entries[name] for name in image_file_names})
+
+
+def is_unchanged(previousManifest, manifest):
+    if previousManifest is None or previousManifest.get('format') != manifest.get('format'):
+        return False
+    return previousManifest['entries'] == manifest['entries']
+
+
+def diff_manifest(previousManifest, manifest):
+    '''
+    Split the images of a new manifest into the ones that can be reused from the last build and the ones
+    whose feature maps were added or changed. Removed images are simply not part of either list.
+    :return: (reused image names, image names to download)
+    '''
+    previousEntries = previousManifest['entries'] if previousManifest else {}
+    reused = []
+    toDownload = []
+    for name, generation in manifest['entries'].items():
+        if previousEntries.get(name) == generation:
+            reused.append(name)
+        else:
+            toDownload.append(name)
+    return reused, toDownload
+
+
+def load_manifest(folderPath):
+    '''
+    :return: Manifest dictionary, None if the folder has no (readable) manifest
+    '''
+    try:
+        with open(os.path.join(folderPath, MANIFEST_FILE_NAME), 'r') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return None
+
+
+def save_manifest(folderPath, manifest):
+    with open(os.path.join(folderPath, MANIFEST_FILE_NAME), 'w') as outfile:
+        json.dump(dict(manifest, built_at=datetime.utcnow().isoformat()), outfile)
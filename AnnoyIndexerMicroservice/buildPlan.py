@@ -0,0 +1,88 @@
+import os
+from buildScheduler import BUILD_PROCESS_OVERHEAD_BYTES, BUILD_MEMORY_CEILING_BYTES
+import indexEngines
+from indexEngines import ON_DISK_BATCH_SIZE
+import shardedIndex
+
+# "auto": build out of core when the in-memory build would exceed the ceiling, "1": always, "0": never
+ON_DISK_BUILD = os.getenv("ON_DISK_BUILD", "auto")
+# What happens to builds above the ceiling: "shard" splits them until they fit, "refuse" fails them
+BUILD_CEILING_FALLBACK = os.getenv("BUILD_CEILING_FALLBACK", "shard")
+# Annoy index size as a multiple of its raw items (tree nodes come on top)
+ANNOY_SIZE_FACTOR = float(os.getenv("ANNOY_SIZE_FACTOR", 2.0))
+
+MAX_SHARDS = 1024
+
+
+class BuildPlan:
+    def __init__(self, onDisk, shards, shardWorkers, estimatedBytes, ceiling):
+        self.onDisk = onDisk
+        self.shards = shards
+        self.shardWorkers = shardWorkers
+        self.estimatedBytes = estimatedBytes
+        self.ceiling = ceiling
+
+    @property
+    def fits(self):
+        return not self.ceiling or self.estimatedBytes <= self.ceiling
+
+    def describe(self):
+        return {'on_disk': self.onDisk, 'shards': self.shards, 'shard_workers': self.shardWorkers,
+                'estimated_bytes': self.estimatedBytes, 'ceiling_bytes': self.ceiling}
+
+
+def index_bytes(count, dimension, engine, onDisk):
+    '''
+    Memory an engine holds while building an index of count vectors. Out-of-core builds write into a
+    memory-mapped file, its pages are page cache the kernel can write back and drop.
+    '''
+    if engine == 'exact':
+        return 0
+    if engine == 'hnsw':
+        # The graph is always built in memory: vector, 2 * M neighbour links per item and bookkeeping
+        return count * (dimension * 4 + 2 * indexEngines.HNSW_M * 4 + 64)
+    if onDisk:
+        return ON_DISK_BATCH_SIZE * dimension * 4
+    return int(count * (dimension * 4 + 16) * ANNOY_SIZE_FACTOR)
+
+
+def vector_bytes(count, inputDimension, dimension, onDisk):
+    '''
+    Memory of the vector matrix of the build (and of the reduced matrix); out of core both live in files
+    '''
+    if onDisk:
+        return 2 * ON_DISK_BATCH_SIZE * inputDimension * 4
+    reduced = count * dimension * 4 if dimension != inputDimension else 0
+    return count * inputDimension * 4 + reduced
+
+
+def estimate_bytes(count, inputDimension, dimension, engine, onDisk, shards=1, shardWorkers=1):
+    shardCount = -(-count // shards)
+    return BUILD_PROCESS_OVERHEAD_BYTES + vector_bytes(count, inputDimension, dimension, onDisk) + \
+        min(shards, shardWorkers) * index_bytes(shardCount, dimension, engine, onDisk)
+
+
+def plan_build(count, inputDimension, dimension, engine, ceiling=BUILD_MEMORY_CEILING_BYTES):
+    '''
+    Decide how a build runs within the memory ceiling: in memory, out of core, or split into shards
+    (built by as many processes at once as fit). Plans that still exceed the ceiling are returned with
+    fits == False, and with BUILD_CEILING_FALLBACK=refuse every plan above the ceiling is.
+    :param inputDimension: Dimension of the feature vectors
+    :param dimension: Dimension of the indexed vectors, smaller than inputDimension with a reduction
+    '''
+    shards = shardedIndex.shard_count(count)
+    workers = max(1, min(shardedIndex.INDEX_SHARD_WORKERS, shards))
+    inMemory = estimate_bytes(count, inputDimension, dimension, engine, False, shards, workers)
+    onDisk = ON_DISK_BUILD == '1' or (ON_DISK_BUILD == 'auto' and bool(ceiling) and inMemory > ceiling)
+    plan = BuildPlan(onDisk, shards, workers,
+                     estimate_bytes(count, inputDimension, dimension, engine, onDisk, shards, workers), ceiling)
+    if plan.fits or BUILD_CEILING_FALLBACK != 'shard':
+        return plan
+
+    # The fewest shards that fit (each query fans out to all of them), built by as many processes at once as fit
+    for shards in range(max(shards, 2), min(count, MAX_SHARDS) + 1):
+        for workers in range(min(shardedIndex.INDEX_SHARD_WORKERS, shards), 0, -1):
+            estimated = estimate_bytes(count, inputDimension, dimension, engine, onDisk, shards, workers)
+            if estimated <= ceiling:
+                return BuildPlan(onDisk, shards, workers, estimated, ceiling)
+    return plan
@@ -0,0 +1,145 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Vector dimension used for estimates before anything has been downloaded (VGG16 fc1)
+FEATURE_DIMENSION = int(os.getenv("FEATURE_DIMENSION", 4096))
+# Peak build memory as a multiple of the raw float32 vectors (vector matrix, Annoy items and trees, archive)
+BUILD_MEMORY_FACTOR = float(os.getenv("BUILD_MEMORY_FACTOR", 3.0))
+# Fixed memory of one build process (interpreter, libraries, clients)
+BUILD_PROCESS_OVERHEAD_BYTES = int(os.getenv("BUILD_PROCESS_OVERHEAD_BYTES", 256 * 1024 ** 2))
+# Memory a single index build may use, 0 for no ceiling (see buildPlan)
+BUILD_MEMORY_CEILING_BYTES = int(os.getenv("BUILD_MEMORY_CEILING_BYTES", 0))
+BUILD_MAX_WORKERS = int(os.getenv("BUILD_MAX_WORKERS", os.cpu_count() or 1))
+# How often a node looks for new or reclaimed tasks while its builds run
+BUILD_QUEUE_POLL_SECONDS = float(os.getenv("BUILD_QUEUE_POLL_SECONDS", 10))
+
+
+def default_memory_budget():
+    '''
+    BUILD_MEMORY_BUDGET_BYTES if set, three quarters of the physical memory otherwise
+    '''
+    if os.getenv("BUILD_MEMORY_BUDGET_BYTES"):
+        return int(os.getenv("BUILD_MEMORY_BUDGET_BYTES"))
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.75)
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def estimate_build_bytes(vectorCount, dimension=FEATURE_DIMENSION):
+    estimate = int(vectorCount * dimension * 4 * BUILD_MEMORY_FACTOR) + BUILD_PROCESS_OVERHEAD_BYTES
+    # Builds above the ceiling run out of core or sharded within it
+    if BUILD_MEMORY_CEILING_BYTES:
+        return min(estimate, BUILD_MEMORY_CEILING_BYTES)
+    return estimate
+
+
+class BuildJob:
+    def __init__(self, vendor, category, vectorCount, dimension=FEATURE_DIMENSION):
+        self.vendor = vendor
+        self.category = category
+        self.vectorCount = vectorCount
+        self.estimatedBytes = estimate_build_bytes(vectorCount, dimension)
+
+    @property
+    def identifier(self):
+        return f"{self.vendor}_{self.category}"
+
+
+class BuildScheduler:
+    '''
+    Runs several index builds at once in a process pool. Tasks are leased from the work queue largest first
+    (longest processing time first finishes the whole run sooner) and only while the summed memory estimate
+    of the running builds stays within the budget. A task larger than the whole budget runs on its own.
+    '''
+
+    def __init__(self, runJob, initializer=None, report=None, memoryBudget=None, maxWorkers=BUILD_MAX_WORKERS):
+        '''
+        :param runJob: Picklable function(vendor, category) executed in a worker process, returns a dict
+        :param initializer: Function executed once in every worker process, e.g. to reconnect clients
+        :param report: Function(identifier, status dict) called in the scheduling process on every change
+        :param memoryBudget: Bytes all running builds may use together
+        :param maxWorkers: Upper bound of builds running at the same time
+        '''
+        self.runJob = runJob
+        self.initializer = initializer
+        self.report = report or (lambda identifier, status: None)
+        self.memoryBudget = memoryBudget or default_memory_budget()
+        self.maxWorkers = max(1, maxWorkers)
+
+    def run_from_queue(self, queue, workerId, pollSeconds=BUILD_QUEUE_POLL_SECONDS):
+        '''
+        Lease tasks from a shared WorkQueue and build them until the queue is drained. A task is only
+        leased while the estimate of the next pending task fits the memory budget next to the running
+        builds, so nodes with free memory take over the rest of the queue. The leases of all running
+        builds are renewed by one heartbeat thread.
+        :return: Dictionary of identifier -> status dict of the tasks built by this node
+        '''
+        results = {}
+        running = {}
+        runningLock = threading.Lock()
+        usedBytes = 0
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(queue.leaseSeconds / 3):
+                with runningLock:
+                    taskIds = [task['id'] for task, _ in running.values()]
+                for taskId in taskIds:
+                    try:
+                        if not queue.heartbeat(taskId, workerId):
+                            print(f'Lease of {taskId} was lost, another node may build it again')
+                    except Exception as error:
+                        print(f'Error renewing the lease of {taskId}: {error}')
+
+        heartbeatThread = threading.Thread(target=beat, daemon=True)
+        heartbeatThread.start()
+        context = multiprocessing.get_context('fork')
+        try:
+            with ProcessPoolExecutor(max_workers=self.maxWorkers, mp_context=context,
+                                     initializer=self.initializer) as executor:
+                while True:
+                    while len(running) < self.maxWorkers:
+                        nextTask = queue.peek()
+                        if nextTask is None:
+                            break
+                        if running and usedBytes + nextTask['estimated_bytes'] > self.memoryBudget:
+                            break
+                        task = queue.lease(workerId)
+                        if task is None:
+                            break
+                        usedBytes += task['estimated_bytes']
+                        future = executor.submit(self.runJob, task['vendor'], task['category'])
+                        with runningLock:
+                            running[future] = (task, time.time())
+                        self.report(task['id'], {'state': 'running', 'estimated_bytes': task['estimated_bytes'],
+                                                 'started_at': time.time(), 'node': workerId,
+                                                 'attempt': task['attempts'] + 1})
+
+                    if not running:
+                        break
+
+                    done, _ = wait(running, timeout=pollSeconds, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        with runningLock:
+                            task, startedAt = running.pop(future)
+                        usedBytes -= task['estimated_bytes']
+                        try:
+                            status = dict(future.result())
+                        except Exception as error:
+                            status = {'status': 'failed', 'error': str(error)}
+                        status.update({'state': 'finished', 'estimated_bytes': task['estimated_bytes'],
+                                       'started_at': startedAt, 'finished_at': time.time(),
+                                       'duration_seconds': time.time() - startedAt, 'node': workerId,
+                                       'attempt': task['attempts'] + 1})
+                        if queue.complete(task['id'], workerId, status) == 2:
+                            status['state'] = 'queued'
+                        results[task['id']] = status
+                        self.report(task['id'], status)
+        finally:
+            stopped.set()
+            heartbeatThread.join()
+        return results
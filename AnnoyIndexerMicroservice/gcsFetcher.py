@@ -0,0 +1,169 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from buildScheduler import BUILD_MAX_WORKERS
+
+# Downloads running at the same time on a node. Builds run in up to BUILD_MAX_WORKERS forked processes with a
+# fetcher each, so every process gets an even share of it (see process_concurrency)
+GCS_FETCH_CONCURRENCY = int(os.getenv("GCS_FETCH_CONCURRENCY", 32))
+# Attempts per object, the first one included
+GCS_FETCH_ATTEMPTS = int(os.getenv("GCS_FETCH_ATTEMPTS", 5))
+# Exponential backoff with full jitter: a retry waits a random time up to min(max, base * 2 ^ attempt)
+GCS_FETCH_BACKOFF_SECONDS = float(os.getenv("GCS_FETCH_BACKOFF_SECONDS", 0.2))
+GCS_FETCH_BACKOFF_MAX_SECONDS = float(os.getenv("GCS_FETCH_BACKOFF_MAX_SECONDS", 10))
+GCS_FETCH_TIMEOUT_SECONDS = float(os.getenv("GCS_FETCH_TIMEOUT_SECONDS", 60))
+
+# Throttling, timeouts and server errors are retried, any other HTTP status is final
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def status_code(error):
+    '''
+    HTTP status of an error raised by the GCS client (google.api_core or google-resumable-media), None if it has none
+    '''
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def is_retryable(error):
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS_CODES
+    # Connection resets and timeouts (requests' exceptions are OSErrors as well)
+    return isinstance(error, OSError)
+
+
+def process_concurrency(concurrency=GCS_FETCH_CONCURRENCY, processes=BUILD_MAX_WORKERS):
+    '''
+    Downloads of one process, so the build processes of a node together stay within the node limit
+    '''
+    return max(1, concurrency // max(1, processes))
+
+
+def configure_connection_pool(session, size):
+    '''
+    Let an HTTP session (e.g. the AuthorizedSession a GCS client is created with) keep as many connections
+    as downloads run at once. The default pool of 10 connections makes every further concurrent download open
+    and close a connection of its own.
+    '''
+    import requests.adapters
+    adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class FetchReport:
+    '''
+    Outcome of fetch_many: the names that were handled, and for every failed name why it failed
+    '''
+
+    def __init__(self):
+        self.loaded = []
+        self.failed = {}
+        self.bytes = 0
+        self.retries = 0
+        self.seconds = 0.0
+
+    def describe(self):
+        return {'loaded': len(self.loaded), 'failed': len(self.failed), 'bytes': self.bytes,
+                'retries': self.retries, 'seconds': self.seconds}
+
+
+class BlobFetcher:
+    '''
+    One download engine per process: a bounded thread pool, so concurrent builds share the downloads of the
+    process instead of multiplying threads and sockets, with retries and exponential backoff with jitter.
+    '''
+
+    def __init__(self, concurrency=None, attempts=GCS_FETCH_ATTEMPTS,
+                 backoff=GCS_FETCH_BACKOFF_SECONDS, backoffMax=GCS_FETCH_BACKOFF_MAX_SECONDS,
+                 timeout=GCS_FETCH_TIMEOUT_SECONDS, sleep=time.sleep):
+        self.concurrency = max(1, concurrency or process_concurrency())
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.backoffMax = backoffMax
+        self.timeout = timeout
+        self.sleep = sleep
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='gcs-fetch')
+            return self._executor
+
+    def reset_after_fork(self):
+        '''
+        Threads do not survive a fork, a forked process starts its own pool on first use
+        '''
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def backoff_seconds(self, attempt):
+        return random.uniform(0, min(self.backoffMax, self.backoff * 2 ** attempt))
+
+    def fetch(self, bucket, objectName):
+        '''
+        Download one object, retrying transient errors
+        :return: (bytes, retries)
+        '''
+        for attempt in range(self.attempts):
+            try:
+                return bucket.blob(objectName).download_as_bytes(timeout=self.timeout), attempt
+            except Exception as error:
+                if attempt + 1 >= self.attempts or not is_retryable(error):
+                    raise
+                self.sleep(self.backoff_seconds(attempt))
+
+    def fetch_many(self, bucket, names, handle, objectName=lambda name: name, progress=None):
+        '''
+        Download the objects of all names and pass every one to handle. At most concurrency * 2 downloads are
+        queued at a time, so the memory of a fetch does not grow with the amount of names.
+        :param handle: Function(name, bytes) returning False if the content is unusable
+        :param objectName: Function mapping a name to its object name in the bucket
+        :param progress: Optional function(done, total) called after every percent of the objects
+        :return: FetchReport
+        '''
+        report = FetchReport()
+        start = time.perf_counter()
+        executor = self._get_executor()
+        pending = {}
+        names = list(names)
+        nextIdx = 0
+        progressStep = max(1, len(names) // 100)
+
+        def run(name):
+            data, retries = self.fetch(bucket, objectName(name))
+            return data, retries, handle(name, data)
+
+        while nextIdx < len(names) or pending:
+            while nextIdx < len(names) and len(pending) < self.concurrency * 2:
+                pending[executor.submit(run, names[nextIdx])] = names[nextIdx]
+                nextIdx += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    data, retries, usable = future.result()
+                    report.bytes += len(data)
+                    report.retries += retries
+                    if usable is False:
+                        report.failed[name] = 'Unusable content'
+                    else:
+                        report.loaded.append(name)
+                except Exception as error:
+                    report.failed[name] = f'{type(error).__name__}: {error}'
+                finished = len(report.loaded) + len(report.failed)
+                if progress and (finished % progressStep == 0 or finished == len(names)):
+                    progress(finished, len(names))
+        report.seconds = time.perf_counter() - start
+        return report
+
+
+blob_fetcher = BlobFetcher()
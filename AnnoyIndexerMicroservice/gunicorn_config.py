@@ -7,4 +7,14 @@ graceful_timeout = 120
 timeout = 120
 keepalive = 5
 threads = 3
-bind = "0.0.0.0:8080"
\ No newline at end of file
+bind = "0.0.0.0:8080"
+
+def on_starting(server):
+    # Samples of the previous run must not be summed up into /metrics
+    import metrics
+    metrics.prepare_multiprocess_dir()
+
+def child_exit(server, worker):
+    # Drop the live gauges of an exited worker from /metrics
+    import metrics
+    metrics.mark_process_dead(worker.pid)
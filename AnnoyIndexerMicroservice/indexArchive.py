@@ -0,0 +1,21 @@
+import os
+import shutil
+from pathlib import Path
+from zipfile import ZipFile, ZipInfo
+
+# Bytes copied into the archive at once
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def write_zip_archive(folderPath, zipPath, chunkSize=COPY_CHUNK_SIZE):
+    '''
+    Zip all files of a folder into zipPath, copying them in chunks
+    '''
+    with ZipFile(zipPath, 'w') as zip_archive:
+        for file_path in Path(folderPath).iterdir():
+            # ZipInfo without a date keeps the entries independent of file modification times
+            zinfo = ZipInfo(file_path.name)
+            # The size decides whether the entry gets zip64 headers, without it entries over 2 GiB fail
+            zinfo.file_size = os.path.getsize(file_path)
+            with open(file_path, 'rb') as file, zip_archive.open(zinfo, 'w') as zip_entry:
+                shutil.copyfileobj(file, zip_entry, chunkSize)
@@ -0,0 +1,243 @@
+import os
+import importlib.util
+import tqdm
+import numpy
+from annoy import AnnoyIndex
+
+# Search engine of the indexes: "annoy", "exact", "hnsw" or "auto" (chosen per vendor/category)
+INDEX_ENGINE = os.getenv("INDEX_ENGINE", "annoy")
+# Query latency an exact scan may take before "auto" switches to an approximate engine
+INDEX_TARGET_LATENCY_MS = float(os.getenv("INDEX_TARGET_LATENCY_MS", 5))
+# Floats an exact scan reads per millisecond, the scan is bound by memory bandwidth (~4 GB/s)
+EXACT_SCAN_FLOATS_PER_MS = float(os.getenv("EXACT_SCAN_FLOATS_PER_MS", 1e6))
+# From this many vectors on "auto" prefers the graph index over Annoy, if hnswlib is installed
+HNSW_MIN_VECTORS = int(os.getenv("HNSW_MIN_VECTORS", 100000))
+
+# Threads used by AnnoyIndex.build, -1 uses all cores
+ANNOY_BUILD_JOBS = int(os.getenv("ANNOY_BUILD_JOBS", -1))
+
+# Rows added to an index at once when building out of core from a memory-mapped vector file
+ON_DISK_BATCH_SIZE = int(os.getenv("ON_DISK_BATCH_SIZE", 4096))
+
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF = int(os.getenv("HNSW_EF", 64))
+HNSW_BUILD_THREADS = int(os.getenv("HNSW_BUILD_THREADS", -1))
+
+# Settings that decide the content of an index, volatile tuning measurements are left out
+CONTENT_SETTING_KEYS = ['engine', 'metric', 'trees', 'search_k', 'M', 'ef_construction', 'ef']
+
+
+def iterate_batches(vectors, batchSize=ON_DISK_BATCH_SIZE):
+    '''
+    Read a (possibly memory-mapped) matrix in bounded batches of rows
+    :return: Generator of (first row, float32 batch)
+    '''
+    for start in range(0, vectors.shape[0], batchSize):
+        yield start, numpy.ascontiguousarray(vectors[start:start + batchSize], dtype=numpy.float32)
+
+
+class AnnoySearcher:
+    def __init__(self, index):
+        self.index = index
+
+    def query(self, vector, k, search_k=-1):
+        return self.index.get_nns_by_vector(vector, k, search_k=search_k, include_distances=True)
+
+    def query_item(self, item_id, k, search_k=-1):
+        return self.index.get_nns_by_item(item_id, k, search_k=search_k, include_distances=True)
+
+    def item_vector(self, item_id):
+        return self.index.get_item_vector(item_id)
+
+    def unload(self):
+        self.index.unload()
+
+
+class AnnoyEngine:
+    '''
+    Random projection forest, memory-mapped by every worker
+    '''
+    name = 'annoy'
+    extension = 'ann'
+
+    def build(self, vectors, settings, path):
+        index = AnnoyIndex(vectors.shape[1], settings['metric'])
+        onDisk = settings.get('on_disk', False)
+        if onDisk:
+            # Items and trees are written into the memory-mapped index file instead of the heap
+            index.on_disk_build(path)
+        with tqdm.tqdm(total=vectors.shape[0]) as bar:
+            for start, batch in iterate_batches(vectors):
+                for i, vector in enumerate(batch):
+                    index.add_item(start + i, vector)
+                bar.update(len(batch))
+        index.build(settings['trees'], n_jobs=settings.get('build_jobs', ANNOY_BUILD_JOBS))
+        if not onDisk:
+            index.save(path)
+        index.unload()
+
+    def load(self, path, dimension, settings):
+        index = AnnoyIndex(dimension, settings.get('metric', 'euclidean'))
+        # AnnoyIndex.load mmaps the file, all gunicorn workers share the same pages in the page cache
+        index.load(path, prefault=False)
+        return AnnoySearcher(index)
+
+
+class ExactSearcher:
+    '''
+    Brute force search with one matrix-vector product over all vectors. Distances are reported the way
+    Annoy reports them for the same metric.
+    '''
+
+    def __init__(self, vectors, metric):
+        self.vectors = vectors
+        self.metric = metric
+        self.squaredNorms = numpy.einsum('ij,ij->i', vectors, vectors)
+
+    def _scores(self, vector):
+        '''
+        :return: (scores where lower is closer, distances as Annoy reports them)
+        '''
+        products = self.vectors @ vector
+        if self.metric == 'dot':
+            return -products, products
+        if self.metric == 'angular':
+            cosines = products / numpy.maximum(numpy.sqrt(self.squaredNorms) * numpy.linalg.norm(vector), 1e-12)
+            distances = numpy.sqrt(numpy.maximum(2.0 - 2.0 * cosines, 0))
+            return distances, distances
+        distances = numpy.sqrt(numpy.maximum(self.squaredNorms - 2.0 * products + vector @ vector, 0))
+        return distances, distances
+
+    def query(self, vector, k, search_k=-1):
+        scores, distances = self._scores(numpy.asarray(vector, dtype=numpy.float32))
+        k = min(k, len(scores))
+        if k <= 0:
+            return [], []
+        top = numpy.argpartition(scores, k - 1)[:k]
+        top = top[numpy.argsort(scores[top])]
+        return top.tolist(), distances[top].tolist()
+
+    def query_item(self, item_id, k, search_k=-1):
+        return self.query(self.vectors[item_id], k)
+
+    def item_vector(self, item_id):
+        return self.vectors[item_id].tolist()
+
+    def unload(self):
+        self.vectors = None
+
+
+class ExactEngine:
+    '''
+    The vectors themselves as .npy file, exact and fastest for small vendor/categories
+    '''
+    name = 'exact'
+    extension = 'npy'
+
+    def build(self, vectors, settings, path):
+        with open(path, 'wb') as outfile:
+            numpy.save(outfile, numpy.ascontiguousarray(vectors, dtype=numpy.float32))
+
+    def load(self, path, dimension, settings):
+        return ExactSearcher(numpy.load(path, mmap_mode='r'), settings.get('metric', 'euclidean'))
+
+
+class HnswSearcher:
+    def __init__(self, index, metric):
+        self.index = index
+        self.metric = metric
+
+    def _to_distances(self, distances):
+        # hnswlib reports squared L2, 1 - cosine and 1 - dot, convert to what Annoy reports
+        if self.metric == 'dot':
+            return (1.0 - distances).tolist()
+        if self.metric == 'angular':
+            return numpy.sqrt(numpy.maximum(2.0 * distances, 0)).tolist()
+        return numpy.sqrt(numpy.maximum(distances, 0)).tolist()
+
+    def query(self, vector, k, search_k=-1):
+        k = min(k, self.index.get_current_count())
+        if k <= 0:
+            return [], []
+        labels, distances = self.index.knn_query(numpy.asarray(vector, dtype=numpy.float32), k=k)
+        return labels[0].tolist(), self._to_distances(distances[0])
+
+    def query_item(self, item_id, k, search_k=-1):
+        return self.query(self.item_vector(item_id), k)
+
+    def item_vector(self, item_id):
+        return list(self.index.get_items([item_id])[0])
+
+    def unload(self):
+        self.index = None
+
+
+class HnswEngine:
+    '''
+    Hierarchical navigable small world graph (hnswlib). Better recall per millisecond than Annoy on large
+    vendor/categories, but loaded into the memory of every worker instead of memory-mapped.
+    '''
+    name = 'hnsw'
+    extension = 'hnsw'
+    spaces = {'euclidean': 'l2', 'angular': 'cosine', 'dot': 'ip'}
+
+    def build(self, vectors, settings, path):
+        import hnswlib
+        index = hnswlib.Index(space=self.spaces[settings['metric']], dim=vectors.shape[1])
+        index.init_index(max_elements=vectors.shape[0], ef_construction=settings['ef_construction'], M=settings['M'])
+        # The graph itself is always held in memory, batches only bound the reads from a memory-mapped matrix
+        for start, batch in iterate_batches(vectors):
+            index.add_items(batch, numpy.arange(start, start + len(batch)),
+                            num_threads=settings.get('build_jobs', HNSW_BUILD_THREADS))
+        index.save_index(path)
+
+    def load(self, path, dimension, settings):
+        import hnswlib
+        metric = settings.get('metric', 'euclidean')
+        index = hnswlib.Index(space=self.spaces[metric], dim=dimension)
+        index.load_index(path)
+        index.set_ef(settings.get('ef', HNSW_EF))
+        return HnswSearcher(index, metric)
+
+
+ENGINES = {engine.name: engine for engine in [AnnoyEngine(), ExactEngine(), HnswEngine()]}
+
+
+def get_engine(name):
+    if name not in ENGINES:
+        raise ValueError(f'Unknown index engine {name}')
+    return ENGINES[name]
+
+
+def hnsw_available():
+    return importlib.util.find_spec('hnswlib') is not None
+
+
+def estimate_exact_latency_ms(vectorCount, dimension):
+    return vectorCount * dimension / EXACT_SCAN_FLOATS_PER_MS
+
+
+def choose_engine(vectorCount, dimension, engine=INDEX_ENGINE):
+    '''
+    Engine of a vendor/category. With "auto": exact while a full scan meets INDEX_TARGET_LATENCY_MS,
+    the graph index for very large vendor/categories, Annoy in between.
+    '''
+    if engine != 'auto':
+        return engine
+    if estimate_exact_latency_ms(vectorCount, dimension) <= INDEX_TARGET_LATENCY_MS:
+        return 'exact'
+    if vectorCount >= HNSW_MIN_VECTORS and hnsw_available():
+        return 'hnsw'
+    return 'annoy'
+
+
+def index_file_name(prefix, engineName):
+    '''
+    :param prefix: e.g. "{vendor}_{category}_fvecs"
+    '''
+    return f"{prefix}.{get_engine(engineName).extension}"
+
+
+def content_settings(settings):
+    return {key: settings[key] for key in CONTENT_SETTING_KEYS if key in settings}
@@ -0,0 +1,201 @@
+import os
+import json
+import shutil
+import threading
+from datetime import datetime
+import buildManifest
+import indexEngines
+import shardedIndex
+from vectorReduction import load_projection
+
+# Root folder of the local versioned index store. Every vendor/category gets its own folder with a
+# "versions" sub folder and a "current" symlink that points at the version being served.
+INDEX_STORE_PATH = os.getenv("INDEX_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "IndexStore"))
+# Amount of old versions kept on disk next to the current one
+INDEX_STORE_KEEP_VERSIONS = int(os.getenv("INDEX_STORE_KEEP_VERSIONS", 2))
+
+CURRENT_LINK_NAME = "current"
+VERSIONS_FOLDER_NAME = "versions"
+META_FILE_NAME = "meta.json"
+NAMES_FILE_NAME = "names.json"
+INDEX_FILE_PREFIX = "fvecs"
+PROJECTION_FILE_NAME = "projection.npz"
+
+
+class LoadedIndex:
+    '''
+    A single published index version, opened with the engine recorded in its meta. Instances are immutable,
+    so a query that still holds a reference keeps working even if a newer version is swapped in meanwhile.
+    '''
+
+    def __init__(self, version, versionPath):
+        self.version = version
+        with open(os.path.join(versionPath, META_FILE_NAME), 'r') as file:
+            self.meta = json.load(file)
+        with open(os.path.join(versionPath, NAMES_FILE_NAME), 'r') as file:
+            self.image_file_names = json.load(file)
+        self.name_to_id = {name: idx for idx, name in enumerate(self.image_file_names)}
+
+        self.dimension = self.meta['dimension']
+        self.metric = self.meta.get('metric', 'euclidean')
+        self.search_k = self.meta.get('search_k', -1)
+        # Query vectors of the feature extractor are reduced the same way as the indexed vectors
+        self.projection = None
+        if self.meta.get('projection'):
+            self.projection = load_projection(os.path.join(versionPath, PROJECTION_FILE_NAME))
+        # Versions published before engines were pluggable are Annoy indexes
+        self.engine = self.meta.get('engine', 'annoy')
+        settings = dict(self.meta.get('index_settings') or {}, metric=self.metric)
+        if self.meta.get('shards'):
+            self.searcher = shardedIndex.load_shards(versionPath, self.meta['shards'], self.engine,
+                                                     self.dimension, settings)
+        else:
+            self.searcher = indexEngines.get_engine(self.engine).load(
+                os.path.join(versionPath, indexEngines.index_file_name(INDEX_FILE_PREFIX, self.engine)),
+                self.dimension, settings)
+
+    @property
+    def input_dimension(self):
+        return self.projection.input_dimension if self.projection is not None else self.dimension
+
+    def query_by_vector(self, vector, k, search_k=-1):
+        if self.projection is not None and len(vector) == self.projection.input_dimension:
+            vector = self.projection.transform(vector)
+        ids, distances = self.searcher.query(vector, k, search_k)
+        return self._to_results(ids, distances)
+
+    def query_by_name(self, image_file_name, k, search_k=-1):
+        '''
+        Query the neighbours of an image that is part of the index. The image itself is not returned.
+        :return: list of results, None if the image name is unknown
+        '''
+        item_id = self.name_to_id.get(image_file_name)
+        if item_id is None:
+            return None
+        ids, distances = self.searcher.query_item(item_id, k + 1, search_k)
+        return [obj for obj in self._to_results(ids, distances) if obj['image_file_name'] != image_file_name][:k]
+
+    def item_vector(self, item_id):
+        return self.searcher.item_vector(item_id)
+
+    def _to_results(self, ids, distances):
+        return [{'image_file_name': self.image_file_names[i], 'distance': d} for i, d in zip(ids, distances)]
+
+
+class IndexStore:
+    '''
+    Local versioned index directory. Builds publish new versions, query workers pick them up on the
+    next request by comparing the target of the "current" symlink with the version they have loaded.
+    '''
+
+    def __init__(self, rootPath=INDEX_STORE_PATH):
+        self.rootPath = rootPath
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def _identifier_path(self, identifier):
+        return os.path.join(self.rootPath, identifier)
+
+    def current_version(self, identifier):
+        try:
+            target = os.readlink(os.path.join(self._identifier_path(identifier), CURRENT_LINK_NAME))
+        except OSError:
+            return None
+        return os.path.basename(target)
+
+    def version_path(self, identifier, version):
+        return os.path.join(self._identifier_path(identifier), VERSIONS_FOLDER_NAME, version)
+
+    def get(self, identifier):
+        '''
+        Get the currently published index of a vendor/category, reloading it if a new version was swapped in
+        :param identifier: {vendor}_{category}
+        :return: LoadedIndex, None if nothing has been published yet
+        '''
+        version = self.current_version(identifier)
+        if version is None:
+            return None
+
+        loaded = self._loaded.get(identifier)
+        if loaded is not None and loaded.version == version:
+            return loaded
+
+        with self._lock:
+            loaded = self._loaded.get(identifier)
+            if loaded is None or loaded.version != version:
+                loaded = LoadedIndex(version, self.version_path(identifier, version))
+                # Replacing the reference is atomic, queries running on the old version finish on it
+                self._loaded[identifier] = loaded
+        return loaded
+
+    def manifest(self, identifier):
+        '''
+        :return: Build manifest of the currently published version, None if there is none
+        '''
+        version = self.current_version(identifier)
+        if version is None:
+            return None
+        return buildManifest.load_manifest(self.version_path(identifier, version))
+
+    def publish(self, identifier, indexFilePath, image_file_names, meta, manifest=None, projectionPath=None):
+        '''
+        Copy a freshly built index into a new version folder and atomically point "current" at it
+        :param identifier: {vendor}_{category}
+        :param indexFilePath: Path of the built index file of the engine in meta["engine"], or the list of
+                              shard file paths if meta["shards"] describes a sharded index
+        :param image_file_names: Image names in Annoy item id order
+        :param meta: Dictionary with at least the vector dimension, the metric and the engine
+        :param manifest: Build manifest stored with the version for incremental builds
+        :param projectionPath: Saved Projection of the vectors, if they were reduced before indexing
+        :return: The new version
+        '''
+        versionsPath = os.path.join(self._identifier_path(identifier), VERSIONS_FOLDER_NAME)
+        os.makedirs(versionsPath, exist_ok=True)
+
+        version = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        stagingPath = os.path.join(versionsPath, '.staging-' + version)
+        os.makedirs(stagingPath)
+
+        engineName = meta.get('engine', 'annoy')
+        if meta.get('shards'):
+            meta = dict(meta, shards=[dict(shard, file=shardedIndex.shard_file_name(INDEX_FILE_PREFIX, engineName, i))
+                                      for i, shard in enumerate(meta['shards'])])
+            files = zip(indexFilePath, [shard['file'] for shard in meta['shards']])
+        else:
+            files = [(indexFilePath, indexEngines.index_file_name(INDEX_FILE_PREFIX, engineName))]
+        for sourcePath, fileName in files:
+            try:
+                os.link(sourcePath, os.path.join(stagingPath, fileName))
+            except OSError:
+                shutil.copyfile(sourcePath, os.path.join(stagingPath, fileName))
+        if projectionPath is not None:
+            shutil.copyfile(projectionPath, os.path.join(stagingPath, PROJECTION_FILE_NAME))
+        with open(os.path.join(stagingPath, NAMES_FILE_NAME), 'w') as outfile:
+            json.dump(image_file_names, outfile)
+        with open(os.path.join(stagingPath, META_FILE_NAME), 'w') as outfile:
+            json.dump(dict(meta, version=version, count=len(image_file_names)), outfile)
+        if manifest is not None:
+            buildManifest.save_manifest(stagingPath, manifest)
+
+        os.rename(stagingPath, os.path.join(versionsPath, version))
+
+        # Create the new link next to the old one and rename it over it, so readers never see a missing link
+        currentLink = os.path.join(self._identifier_path(identifier), CURRENT_LINK_NAME)
+        tempLink = currentLink + '.' + version
+        os.symlink(os.path.join(VERSIONS_FOLDER_NAME, version), tempLink)
+        os.replace(tempLink, currentLink)
+
+        self._prune(identifier)
+        return version
+
+    def _prune(self, identifier):
+        # Removing files that are still mmapped by other workers is safe, the pages stay valid until they unload
+        versionsPath = os.path.join(self._identifier_path(identifier), VERSIONS_FOLDER_NAME)
+        current = self.current_version(identifier)
+        versions = sorted(obj for obj in os.listdir(versionsPath) if not obj.startswith('.'))
+        old = [obj for obj in versions if obj != current]
+        for obj in old[:max(len(old) - INDEX_STORE_KEEP_VERSIONS, 0)]:
+            shutil.rmtree(os.path.join(versionsPath, obj), ignore_errors=True)
+
+
+index_store = IndexStore()
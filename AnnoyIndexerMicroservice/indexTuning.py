@@ -0,0 +1,240 @@
+import os
+import time
+import tempfile
+import numpy
+from annoy import AnnoyIndex
+import indexEngines
+from indexEngines import ANNOY_BUILD_JOBS
+
+# Index settings used when a vendor/category was never tuned
+ANNOY_METRIC = os.getenv("ANNOY_METRIC", "euclidean")
+ANNOY_TREES = int(os.getenv("ANNOY_TREES", 100))
+ANNOY_SEARCH_K = int(os.getenv("ANNOY_SEARCH_K", -1))
+
+# Auto-tuning of trees, search_k and metric (ef for the graph index) during builds
+ANNOY_AUTO_TUNE = os.getenv("ANNOY_AUTO_TUNE", "0") == "1"
+ANNOY_TARGET_RECALL = float(os.getenv("ANNOY_TARGET_RECALL", 0.95))
+ANNOY_TUNE_K = int(os.getenv("ANNOY_TUNE_K", 10))
+# Vectors the candidate indexes are built from and queries the recall is measured with
+ANNOY_TUNE_SAMPLE_SIZE = int(os.getenv("ANNOY_TUNE_SAMPLE_SIZE", 20000))
+ANNOY_TUNE_QUERIES = int(os.getenv("ANNOY_TUNE_QUERIES", 200))
+# A tuned configuration is kept until the vector count grew or shrank by more than this factor
+ANNOY_RETUNE_FACTOR = float(os.getenv("ANNOY_RETUNE_FACTOR", 2.0))
+
+METRICS = ['euclidean', 'angular', 'dot']
+TREE_CANDIDATES = [5, 10, 20, 50, 100]
+# Multiples of trees * k, the Annoy default search_k is trees * k
+SEARCH_K_FACTORS = [1, 2, 4, 8, 16, 32]
+EF_CANDIDATES = [16, 32, 64, 128, 256, 512]
+
+
+def default_settings(engine='annoy'):
+    settings = {'engine': engine, 'metric': ANNOY_METRIC, 'search_k': -1, 'tuned': False}
+    if engine == 'annoy':
+        settings.update(trees=ANNOY_TREES, search_k=ANNOY_SEARCH_K)
+    elif engine == 'hnsw':
+        settings.update(M=indexEngines.HNSW_M, ef_construction=indexEngines.HNSW_EF_CONSTRUCTION,
+                        ef=indexEngines.HNSW_EF)
+    return settings
+
+
+def is_normalised(vectors, tolerance=1e-3):
+    '''
+    True if all vectors have unit length. Euclidean, angular and dot product then rank neighbours the same.
+    '''
+    norms = numpy.linalg.norm(vectors, axis=1)
+    return bool(numpy.all(numpy.abs(norms - 1.0) <= tolerance))
+
+
+def build_annoy_index(vectors, metric, trees, nJobs=ANNOY_BUILD_JOBS):
+    '''
+    :param vectors: (n, dim) float32 matrix, row i becomes Annoy item i
+    '''
+    index = AnnoyIndex(vectors.shape[1], metric)
+    for i in range(vectors.shape[0]):
+        index.add_item(i, vectors[i])
+    index.build(trees, n_jobs=nJobs)
+    return index
+
+
+def exact_neighbours(vectors, queries, k, chunkSize=256):
+    '''
+    Brute force euclidean top k of every query, the ground truth recall is measured against
+    :return: (len(queries), k) matrix of row numbers
+    '''
+    squaredNorms = numpy.einsum('ij,ij->i', vectors, vectors)
+    result = numpy.empty((len(queries), k), dtype=numpy.int64)
+    for start in range(0, len(queries), chunkSize):
+        chunk = queries[start:start + chunkSize]
+        # |a - b|^2 = |a|^2 - 2ab + |b|^2, the |a|^2 term does not change the ranking of a query
+        distances = squaredNorms[None, :] - 2.0 * chunk @ vectors.T
+        top = numpy.argpartition(distances, k - 1, axis=1)[:, :k]
+        order = numpy.take_along_axis(distances, top, axis=1).argsort(axis=1)
+        result[start:start + chunkSize] = numpy.take_along_axis(top, order, axis=1)
+    return result
+
+
+def measure_queries(search, queries, truth, k):
+    '''
+    :param search: Function(query vector, k) returning the ids of the neighbours
+    :return: Dictionary with recall@k and query latency percentiles in milliseconds
+    '''
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = search(query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(int(i) for i in found) & set(expected.tolist()))
+    return {'recall': hits / float(len(queries) * k),
+            'p50_ms': float(numpy.percentile(latencies, 50)),
+            'p95_ms': float(numpy.percentile(latencies, 95)),
+            'p99_ms': float(numpy.percentile(latencies, 99))}
+
+
+def sample_queries(vectors, count, seed=0):
+    '''
+    Pick query vectors from the data, with a little noise so a query is not simply its own nearest item
+    '''
+    rng = numpy.random.default_rng(seed)
+    rows = rng.choice(vectors.shape[0], size=min(count, vectors.shape[0]), replace=False)
+    queries = vectors[rows] + rng.normal(0, 0.01, size=(len(rows), vectors.shape[1])).astype(numpy.float32)
+    if is_normalised(vectors):
+        queries /= numpy.linalg.norm(queries, axis=1, keepdims=True)
+    return queries.astype(numpy.float32)
+
+
+def build_and_load(vectors, settings, folderPath):
+    '''
+    Build an index with its engine into a folder and open it the way the service does
+    :return: (searcher, build seconds, index bytes)
+    '''
+    engine = indexEngines.get_engine(settings['engine'])
+    path = os.path.join(folderPath, indexEngines.index_file_name('fvecs', engine.name))
+    start = time.perf_counter()
+    engine.build(vectors, settings, path)
+    buildSeconds = time.perf_counter() - start
+    return engine.load(path, vectors.shape[1], settings), buildSeconds, os.path.getsize(path)
+
+
+def benchmark(vectors, queries, k, metrics=METRICS, trees=TREE_CANDIDATES, searchKFactors=SEARCH_K_FACTORS,
+              buildJobs=(ANNOY_BUILD_JOBS,), truth=None):
+    '''
+    Build an Annoy index for every metric, tree count and build thread count and query it with every search_k
+    :return: List of result dictionaries, one per configuration
+    '''
+    if truth is None:
+        truth = exact_neighbours(vectors, queries, k)
+    results = []
+    with tempfile.TemporaryDirectory() as tempDir:
+        for metric in metrics:
+            for treeCount in trees:
+                for nJobs in buildJobs:
+                    settings = {'engine': 'annoy', 'metric': metric, 'trees': treeCount, 'build_jobs': nJobs}
+                    searcher, buildSeconds, size = build_and_load(vectors, settings, tempDir)
+                    for factor in searchKFactors:
+                        search_k = factor * treeCount * k
+                        result = {'metric': metric, 'trees': treeCount, 'search_k': search_k, 'build_jobs': nJobs,
+                                  'build_seconds': buildSeconds, 'index_bytes': size}
+                        result.update(measure_queries(lambda query, count: searcher.query(query, count, search_k)[0],
+                                                      queries, truth, k))
+                        results.append(result)
+                    searcher.unload()
+    return results
+
+
+def _prepare_sample(vectors, k, sampleSize, queryCount, seed):
+    rng = numpy.random.default_rng(seed)
+    if vectors.shape[0] > sampleSize:
+        vectors = vectors[numpy.sort(rng.choice(vectors.shape[0], size=sampleSize, replace=False))]
+    vectors = numpy.ascontiguousarray(vectors, dtype=numpy.float32)
+    k = min(k, vectors.shape[0])
+    queries = sample_queries(vectors, queryCount, seed)
+    return vectors, k, queries, exact_neighbours(vectors, queries, k)
+
+
+def auto_tune(vectors, targetRecall=ANNOY_TARGET_RECALL, k=ANNOY_TUNE_K, sampleSize=ANNOY_TUNE_SAMPLE_SIZE,
+              queryCount=ANNOY_TUNE_QUERIES, seed=0):
+    '''
+    Pick the cheapest Annoy configuration (lowest p95 query latency, then fewest trees) whose recall@k on a
+    sample meets the target. Metrics other than euclidean are only tried for unit length vectors, where they
+    return the same neighbours. If no configuration reaches the target the one with the best recall is returned.
+    :return: Settings dictionary for the build, with the measured recall and latency
+    '''
+    vectors, k, queries, truth = _prepare_sample(vectors, k, sampleSize, queryCount, seed)
+    metrics = METRICS if is_normalised(vectors) else ['euclidean']
+
+    best = None
+    for metric in metrics:
+        for treeCount in TREE_CANDIDATES:
+            index = build_annoy_index(vectors, metric, treeCount)
+            for factor in SEARCH_K_FACTORS:
+                search_k = factor * treeCount * k
+                measured = measure_queries(lambda query, count: index.get_nns_by_vector(query, count, search_k),
+                                           queries, truth, k)
+                candidate = dict(measured, metric=metric, trees=treeCount, search_k=search_k)
+                if best is None or _is_better(candidate, best, targetRecall):
+                    best = candidate
+                # A larger search_k only costs more once the target is met
+                if measured['recall'] >= targetRecall:
+                    break
+            index.unload()
+
+    return {'engine': 'annoy', 'metric': best['metric'], 'trees': best['trees'], 'search_k': best['search_k'],
+            'tuned': True, 'target_recall': targetRecall, 'k': k, 'recall': best['recall'],
+            'p95_ms': best['p95_ms'], 'sample_size': int(vectors.shape[0]), 'tuned_at': time.time()}
+
+
+def auto_tune_hnsw(vectors, targetRecall=ANNOY_TARGET_RECALL, k=ANNOY_TUNE_K, sampleSize=ANNOY_TUNE_SAMPLE_SIZE,
+                   queryCount=ANNOY_TUNE_QUERIES, seed=0):
+    '''
+    Pick the smallest ef of the graph index whose recall@k on a sample meets the target
+    '''
+    vectors, k, queries, truth = _prepare_sample(vectors, k, sampleSize, queryCount, seed)
+    settings = default_settings('hnsw')
+    best = None
+    with tempfile.TemporaryDirectory() as tempDir:
+        searcher, _, _ = build_and_load(vectors, settings, tempDir)
+        for ef in EF_CANDIDATES:
+            searcher.index.set_ef(ef)
+            measured = measure_queries(lambda query, count: searcher.query(query, count)[0], queries, truth, k)
+            if best is None or measured['recall'] > best['recall'] or measured['recall'] >= targetRecall:
+                best = dict(measured, ef=ef)
+            if measured['recall'] >= targetRecall:
+                break
+        searcher.unload()
+
+    settings.update(ef=best['ef'], tuned=True, target_recall=targetRecall, k=k, recall=best['recall'],
+                    p95_ms=best['p95_ms'], sample_size=int(vectors.shape[0]), tuned_at=time.time())
+    return settings
+
+
+def _is_better(candidate, best, targetRecall):
+    candidateMeets = candidate['recall'] >= targetRecall
+    bestMeets = best['recall'] >= targetRecall
+    if candidateMeets != bestMeets:
+        return candidateMeets
+    if not candidateMeets:
+        return candidate['recall'] > best['recall']
+    return (candidate['p95_ms'], candidate['trees']) < (best['p95_ms'], best['trees'])
+
+
+def select_settings(previousSettings, vectors):
+    '''
+    Settings of a build. The engine is chosen from the vector count (see indexEngines.choose_engine). Tuned
+    settings of the last manifest are kept while the engine and dimension stayed the same and the vector
+    count about the same, with ANNOY_AUTO_TUNE the engine is tuned again otherwise, defaults are used if not.
+    :param previousSettings: "index_settings" of the last manifest, None if there is none
+    '''
+    count, dimension = vectors.shape
+    engine = indexEngines.choose_engine(count, dimension)
+    if previousSettings and previousSettings.get('tuned') and previousSettings.get('dimension') == dimension \
+            and previousSettings.get('engine', 'annoy') == engine:
+        previousCount = previousSettings.get('vector_count') or 0
+        if previousCount and previousCount / ANNOY_RETUNE_FACTOR <= count <= previousCount * ANNOY_RETUNE_FACTOR:
+            return previousSettings
+    if ANNOY_AUTO_TUNE and engine in ('annoy', 'hnsw'):
+        settings = auto_tune(vectors) if engine == 'annoy' else auto_tune_hnsw(vectors)
+        settings.update(vector_count=int(count), dimension=int(dimension))
+        return settings
+    return default_settings(engine)
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+
+# Build lock of a vendor/category, refreshed by a heartbeat while the build waits for a thread and runs
+JOB_LOCK_TTL_SECONDS = int(os.getenv("JOB_LOCK_TTL_SECONDS", 120))
+# Finished job records are kept this long for status polls
+JOB_RECORD_TTL_SECONDS = int(os.getenv("JOB_RECORD_TTL_SECONDS", 24 * 3600))
+# Requests of a process that may block on job changes at once (long-polls and event streams), each holds a
+# worker thread; further ones are answered right away
+JOB_MAX_WAITERS = int(os.getenv("JOB_MAX_WAITERS", 2))
+
+JOB_KEY_PREFIX = "annoy_job:"
+JOB_LOCK_KEY_PREFIX = "annoy_job_lock:"
+# Pub/sub channel of a job, every change of its record is published there
+JOB_EVENTS_CHANNEL_PREFIX = "annoy_job_events:"
+
+STATE_QUEUED = "queued"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+class JobStore:
+    '''
+    Indexing job records in Redis, so every worker and instance can answer status polls. A job holds a
+    lock while it is queued or running, requests for the same vendor/category anywhere in the fleet
+    are merged into that one build.
+    '''
+
+    def __init__(self, redisClient):
+        self.redisClient = redisClient
+
+    def _key(self, id):
+        return JOB_KEY_PREFIX + id
+
+    def _lock(self, id):
+        # Not thread local, the lock is taken by the request thread and released by the build thread
+        return self.redisClient.lock(JOB_LOCK_KEY_PREFIX + id, timeout=JOB_LOCK_TTL_SECONDS, thread_local=False)
+
+    def try_acquire(self, id):
+        '''
+        Take the build lock of a job
+        :return: Lock object if this caller has to run the build, None if it is already queued or running
+        '''
+        lock = self._lock(id)
+        if not lock.acquire(blocking=False):
+            return None
+        now = time.time()
+        self.redisClient.delete(self._key(id))
+        self._write(id, {'state': STATE_QUEUED, 'stage': 'queued', 'progress': 0, 'timings': {},
+                         'queued_at': now, 'updated_at': now})
+        return lock
+
+    def is_locked(self, id):
+        return bool(self.redisClient.exists(JOB_LOCK_KEY_PREFIX + id))
+
+    def _write(self, id, fields):
+        self.redisClient.hset(self._key(id), mapping={key: json.dumps(value) for key, value in fields.items()})
+        self.redisClient.expire(self._key(id), JOB_RECORD_TTL_SECONDS)
+        self.redisClient.publish(JOB_EVENTS_CHANNEL_PREFIX + id, json.dumps(fields.get('updated_at')))
+
+    def get(self, id):
+        '''
+        :return: Dictionary of the job record, None if the job is unknown
+        '''
+        record = self.redisClient.hgetall(self._key(id))
+        if not record:
+            return None
+        job = {key.decode(): json.loads(value) for key, value in record.items()}
+        # A queued or running job whose lock expired belongs to a worker that died
+        if job['state'] in (STATE_QUEUED, STATE_RUNNING) and not self.is_locked(id):
+            job.update({'state': STATE_FAILED, 'error': 'Build abandoned by its worker'})
+        return job
+
+    def start(self, id):
+        now = time.time()
+        self._write(id, {'state': STATE_RUNNING, 'stage': 'starting', 'started_at': now,
+                         'stage_started_at': now, 'updated_at': now})
+
+    def progress(self, id, stage, percent):
+        '''
+        Record the current stage and progress, and the duration of the stage that just ended
+        '''
+        job = self.get(id) or {}
+        now = time.time()
+        fields = {'progress': percent, 'updated_at': now}
+        if stage != job.get('stage'):
+            timings = job.get('timings', {})
+            if job.get('stage') and job.get('stage_started_at'):
+                timings[job['stage']] = now - job['stage_started_at']
+            fields.update({'stage': stage, 'stage_started_at': now, 'timings': timings})
+        self._write(id, fields)
+
+    def finish(self, id, lock, fileUrl=None, generation=None):
+        self._end(id, lock, {'state': STATE_DONE, 'progress': 100, 'fileUrl': fileUrl, 'generation': generation})
+
+    def fail(self, id, lock, error):
+        self._end(id, lock, {'state': STATE_FAILED, 'error': error})
+
+    def _end(self, id, lock, fields):
+        job = self.get(id) or {}
+        now = time.time()
+        timings = job.get('timings', {})
+        if job.get('stage') and job.get('stage_started_at'):
+            timings[job['stage']] = now - job['stage_started_at']
+        fields.update({'stage': fields['state'], 'finished_at': now, 'updated_at': now, 'timings': timings,
+                       'duration_seconds': now - job.get('started_at', now)})
+        self._write(id, fields)
+        try:
+            lock.release()
+        except Exception as error:
+            print(f'Error releasing the build lock of {id}: {error}')
+
+    def heartbeat(self, id, lock):
+        '''
+        Keep the build lock alive from now on until the returned heartbeat is stopped, so only dead workers
+        lose it. Start it when the lock is taken, a job may wait for a free build thread for longer than the TTL.
+        '''
+        return Heartbeat(id, lock)
+
+
+class Heartbeat:
+    '''
+    Refreshes a build lock from a background thread
+    '''
+
+    def __init__(self, id, lock):
+        self.id = id
+        self.lock = lock
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._beat, daemon=True)
+        self.thread.start()
+
+    def _beat(self):
+        while not self.stopped.wait(JOB_LOCK_TTL_SECONDS / 3):
+            try:
+                self.lock.reacquire()
+            except Exception as error:
+                print(f'Error refreshing the build lock of {self.id}: {error}')
+
+    def stop(self):
+        '''
+        Stop refreshing, before the lock is released
+        '''
+        self.stopped.set()
+        self.thread.join()
+
+
+class JobEvents:
+    '''
+    Wakes up requests waiting for a job to change. One thread per process listens to the job event channels in
+    Redis and notifies the waiters through a condition variable, so a waiting request makes no Redis calls
+    until its job changed.
+    '''
+
+    def __init__(self, redisClient, maxWaiters=JOB_MAX_WAITERS):
+        self.redisClient = redisClient
+        self.condition = threading.Condition()
+        # Events seen per job, and a counter bumped when the listener reconnects and may have missed events
+        self.counters = {}
+        self.epoch = 0
+        self.slots = threading.BoundedSemaphore(max(1, maxWaiters))
+        self._thread = None
+        self._subscribed = threading.Event()
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._subscribed.clear()
+                self._thread = threading.Thread(target=self._listen, daemon=True, name='job-events')
+                self._thread.start()
+        self._subscribed.wait(timeout=1)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redisClient.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(JOB_EVENTS_CHANNEL_PREFIX + '*')
+                self._subscribed.set()
+                for message in pubsub.listen():
+                    id = message['channel'].decode()[len(JOB_EVENTS_CHANNEL_PREFIX):]
+                    with self.condition:
+                        self.counters[id] = self.counters.get(id, 0) + 1
+                        self.condition.notify_all()
+            except Exception as error:
+                print(f'Error listening for job events: {error}')
+                with self.condition:
+                    self.epoch += 1
+                    self.condition.notify_all()
+                time.sleep(1)
+
+    def try_enter(self):
+        '''
+        Take one of the waiter slots of this process
+        :return: False if all are taken, the request should answer right away
+        '''
+        return self.slots.acquire(blocking=False)
+
+    def leave(self):
+        self.slots.release()
+
+    def marker(self, id):
+        '''
+        Take before reading the job, then wait with it: a change between the read and the wait is not missed
+        '''
+        self._ensure_listener()
+        with self.condition:
+            return self.epoch, self.counters.get(id, 0)
+
+    def wait(self, id, marker, timeout):
+        '''
+        Block until the job changed after the marker was taken or the timeout passed
+        :return: True if the job changed
+        '''
+        with self.condition:
+            return self.condition.wait_for(lambda: (self.epoch, self.counters.get(id, 0)) != marker, timeout)
@@ -0,0 +1,81 @@
+import threading
+
+
+class LazyResource:
+    '''
+    Creates a client or model on first use and shares it between threads. Attribute and item access
+    is forwarded, so a LazyResource can be used wherever the object it creates was used before.
+    Attributes of the proxy itself hide the ones of the wrapped object, so their names must not occur on
+    any wrapped client (e.g. Redis.get, Bucket.name): instance, resourceName, ready and reset_after_fork.
+    '''
+
+    def __init__(self, name, factory):
+        self.resourceName = name
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    def instance(self):
+        '''
+        :return: The wrapped object, created on the first call
+        '''
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+                value = self._value
+        return value
+
+    @property
+    def ready(self):
+        return self._value is not None
+
+    def reset_after_fork(self):
+        '''
+        Drop the object in a forked child process, e.g. because the client is not fork safe.
+        The lock is replaced as well, it may have been held by another thread at fork time.
+        '''
+        self._lock = threading.Lock()
+        self._value = None
+
+    def __getattr__(self, item):
+        return getattr(self.instance(), item)
+
+    def __getitem__(self, key):
+        return self.instance()[key]
+
+
+_warmingLock = threading.Lock()
+_warmingThread = None
+
+
+def warm(resources):
+    '''
+    Create all resources that do not exist yet, failures are printed and retried on first use
+    '''
+    for resource in resources:
+        try:
+            resource.instance()
+        except Exception as error:
+            print(f'Error warming {resource.resourceName}: {error}')
+
+
+def warm_in_background(resources):
+    '''
+    Warm the resources in a daemon thread, at most one warming thread runs at a time
+    '''
+    global _warmingThread
+    with _warmingLock:
+        if _warmingThread is not None and _warmingThread.is_alive():
+            return
+        _warmingThread = threading.Thread(target=warm, args=(list(resources),), daemon=True)
+        _warmingThread.start()
+
+
+def readiness(resources):
+    '''
+    :return: (True if every resource exists, dictionary of resource name -> ready)
+    '''
+    states = {resource.resourceName: resource.ready for resource in resources}
+    return all(states.values()), states
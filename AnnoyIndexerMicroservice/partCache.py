@@ -0,0 +1,65 @@
+import os
+import threading
+from cachetools import TTLCache
+
+PART_CACHE_SIZE = int(os.getenv("PART_CACHE_SIZE", 100000))
+PART_CACHE_TTL_SECONDS = int(os.getenv("PART_CACHE_TTL_SECONDS", 600))
+
+
+class PartCache:
+    '''
+    In-process LRU/TTL cache of image file name -> JSONInfo part document. A generation counter kept in
+    Redis is bumped whenever new uploads land, every process clears its cache when it sees a new value.
+    '''
+
+    def __init__(self, redisClient, generationKey, maxSize=PART_CACHE_SIZE, ttl=PART_CACHE_TTL_SECONDS):
+        self.redisClient = redisClient
+        self.generationKey = generationKey
+        self._cache = TTLCache(maxsize=maxSize, ttl=ttl)
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def _check_generation(self):
+        try:
+            generation = self.redisClient.get(self.generationKey)
+        except Exception as error:
+            print(f'Error reading the part cache generation: {error}')
+            return
+        if generation != self._generation:
+            with self._lock:
+                self._cache.clear()
+                self._generation = generation
+
+    def get_many(self, names):
+        '''
+        :return: (Dictionary of image name -> part document for every hit, list of missed names)
+        '''
+        self._check_generation()
+        hits = {}
+        misses = []
+        with self._lock:
+            for name in names:
+                doc = self._cache.get(name)
+                if doc is None:
+                    misses.append(name)
+                else:
+                    hits[name] = doc
+        return hits, misses
+
+    def put_documents(self, docs):
+        # A part is cached under all of its views, so looking up one view warms the others
+        with self._lock:
+            for doc in docs:
+                for name in doc.get('image_file_names', []):
+                    self._cache[name] = doc
+
+    def invalidate(self):
+        '''
+        Clear the cache of every process
+        '''
+        try:
+            self.redisClient.incr(self.generationKey)
+        except Exception as error:
+            print(f'Error invalidating the part cache: {error}')
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,135 @@
+import os
+import math
+import heapq
+import bisect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import indexEngines
+
+# Split vendor/categories with more vectors than this into shards, 0 disables sharding
+INDEX_SHARD_MAX_VECTORS = int(os.getenv("INDEX_SHARD_MAX_VECTORS", 0))
+# Fixed amount of shards for every vendor/category, overrides INDEX_SHARD_MAX_VECTORS if set
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", 0))
+# Shards built at the same time, each in its own process
+INDEX_SHARD_WORKERS = int(os.getenv("INDEX_SHARD_WORKERS", os.cpu_count() or 1))
+# Threads a query fans out to the shards with, shared by all sharded indexes of a process
+INDEX_SHARD_QUERY_THREADS = int(os.getenv("INDEX_SHARD_QUERY_THREADS", 8))
+
+SHARD_MANIFEST_SUFFIX = "_shards.json"
+
+_queryExecutor = None
+# Vectors and settings of the running sharded build, inherited by the forked shard processes
+_buildState = None
+
+
+def shard_count(vectorCount, shards=None):
+    if shards:
+        return max(1, min(shards, vectorCount))
+    if INDEX_SHARDS > 0:
+        return max(1, min(INDEX_SHARDS, vectorCount))
+    if INDEX_SHARD_MAX_VECTORS > 0 and vectorCount > INDEX_SHARD_MAX_VECTORS:
+        return math.ceil(vectorCount / INDEX_SHARD_MAX_VECTORS)
+    return 1
+
+
+def plan_shards(vectorCount, count):
+    '''
+    Split the item ids into contiguous ranges of about equal size
+    :return: List of (offset, count)
+    '''
+    size = math.ceil(vectorCount / count)
+    return [(offset, min(size, vectorCount - offset)) for offset in range(0, vectorCount, size)]
+
+
+def shard_file_name(prefix, engineName, shard):
+    '''
+    :param prefix: e.g. "{vendor}_{category}_fvecs"
+    '''
+    return indexEngines.index_file_name(f"{prefix}_shard{shard}", engineName)
+
+
+def _build_shard(shard):
+    vectors, settings, paths, bounds = _buildState
+    offset, count = bounds[shard]
+    indexEngines.get_engine(settings['engine']).build(vectors[offset:offset + count], settings, paths[shard])
+    return shard
+
+
+def build_shards(vectors, settings, folderPath, prefix, shards, workers=None):
+    '''
+    Build one index per contiguous range of rows in parallel processes. Shard i holds the rows
+    offset_i .. offset_i + count_i - 1, its local item id j is the global item id offset_i + j.
+    :param workers: Shards built at the same time, INDEX_SHARD_WORKERS by default
+    :return: (list of shard file paths, list of {"file", "offset", "count"} dictionaries)
+    '''
+    global _buildState
+    bounds = plan_shards(vectors.shape[0], shards)
+    paths = [os.path.join(folderPath, shard_file_name(prefix, settings['engine'], i)) for i in range(len(bounds))]
+    workers = max(1, min(workers or INDEX_SHARD_WORKERS, len(bounds)))
+    # Each shard process gets its part of the cores for the multi-threaded engine builds
+    settings = dict(settings, build_jobs=max(1, (os.cpu_count() or 1) // workers))
+    _buildState = (vectors, settings, paths, bounds)
+    try:
+        # Forked processes read the vectors from the parent's memory instead of getting a pickled copy
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            list(executor.map(_build_shard, range(len(bounds))))
+    finally:
+        _buildState = None
+    return paths, [{'file': os.path.basename(path), 'offset': offset, 'count': count}
+                   for path, (offset, count) in zip(paths, bounds)]
+
+
+def _query_executor():
+    global _queryExecutor
+    if _queryExecutor is None:
+        _queryExecutor = ThreadPoolExecutor(max_workers=INDEX_SHARD_QUERY_THREADS)
+    return _queryExecutor
+
+
+class ShardedSearcher:
+    '''
+    Scatter-gather over the shards of one index: a query runs on every shard (the engines release the GIL
+    while searching) and the per-shard top k are merged by distance into global item ids.
+    '''
+
+    def __init__(self, searchers, offsets, metric):
+        self.searchers = searchers
+        self.offsets = offsets
+        # Annoy reports the dot product itself for "dot", larger is closer
+        self.sign = -1.0 if metric == 'dot' else 1.0
+
+    def query(self, vector, k, search_k=-1):
+        def search(shard):
+            ids, distances = self.searchers[shard].query(vector, k, search_k)
+            return [(self.sign * distance, self.offsets[shard] + i, distance) for i, distance in zip(ids, distances)]
+
+        candidates = []
+        for result in _query_executor().map(search, range(len(self.searchers))):
+            candidates.extend(result)
+        top = heapq.nsmallest(k, candidates)
+        return [obj[1] for obj in top], [obj[2] for obj in top]
+
+    def _locate(self, item_id):
+        shard = bisect.bisect_right(self.offsets, item_id) - 1
+        return shard, item_id - self.offsets[shard]
+
+    def query_item(self, item_id, k, search_k=-1):
+        return self.query(self.item_vector(item_id), k, search_k)
+
+    def item_vector(self, item_id):
+        shard, local_id = self._locate(item_id)
+        return self.searchers[shard].item_vector(local_id)
+
+    def unload(self):
+        for searcher in self.searchers:
+            searcher.unload()
+
+
+def load_shards(folderPath, shards, engineName, dimension, settings):
+    '''
+    Open the shards of an index
+    :param shards: List of {"file", "offset", "count"} dictionaries, as returned by build_shards
+    '''
+    engine = indexEngines.get_engine(engineName)
+    searchers = [engine.load(os.path.join(folderPath, shard['file']), dimension, settings) for shard in shards]
+    return ShardedSearcher(searchers, [shard['offset'] for shard in shards], settings.get('metric', 'euclidean'))
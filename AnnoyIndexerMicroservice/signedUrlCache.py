@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+
+# Fetch expiration_time from environment variable or use a default value (900 seconds)
+EXPIRATION_TIME_SECONDS = int(os.getenv("EXPIRATION_TIME_SECONDS", 900))
+# A cached URL is re-signed once less than this many seconds of its lifetime are left
+SIGNED_URL_SAFETY_MARGIN_SECONDS = int(os.getenv("SIGNED_URL_SAFETY_MARGIN_SECONDS", 120))
+# Seconds a generation looked up in GCS is trusted before it is looked up again
+SIGNED_URL_GENERATION_TTL_SECONDS = float(os.getenv("SIGNED_URL_GENERATION_TTL_SECONDS", 10))
+
+
+class SignedUrl:
+    def __init__(self, url, generation, expiresAt):
+        self.url = url
+        self.generation = generation
+        self.expiresAt = expiresAt
+
+
+class SignedUrlCache:
+    '''
+    Signed GET URLs keyed by object name and generation. A URL is reused until it is within the safety
+    margin of its expiration, and nothing is signed before the first request for an object. Objects are
+    re-uploaded by build processes and other nodes, so without a given generation the current one is
+    looked up in GCS (a metadata request) and only trusted for generationTtlSeconds.
+    '''
+
+    def __init__(self, bucket, expirationSeconds=EXPIRATION_TIME_SECONDS,
+                 safetyMarginSeconds=SIGNED_URL_SAFETY_MARGIN_SECONDS,
+                 generationTtlSeconds=SIGNED_URL_GENERATION_TTL_SECONDS):
+        self.bucket = bucket
+        self.expirationSeconds = expirationSeconds
+        # The margin can never use up the whole lifetime, otherwise nothing would be reused
+        self.safetyMarginSeconds = min(safetyMarginSeconds, expirationSeconds // 2)
+        self.generationTtlSeconds = generationTtlSeconds
+        self._urls = {}
+        # Object name -> (generation, time.monotonic() of the lookup)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, object_name, generation=None):
+        '''
+        Get a signed URL of an object
+        :param object_name: GCS object name
+        :param generation: Generation of the object if known, e.g. recorded with the job that uploaded it.
+                           Otherwise the current generation is looked up in GCS.
+        :return: SignedUrl, None if the object does not exist
+        '''
+        if generation is None:
+            generation = self._current_generation(object_name)
+            if generation is None:
+                return None
+
+        now = datetime.utcnow()
+        with self._lock:
+            cached = self._urls.get((object_name, generation))
+            if cached is not None and now < cached.expiresAt - timedelta(seconds=self.safetyMarginSeconds):
+                return cached
+
+        expiration = now + timedelta(seconds=self.expirationSeconds)
+        url = self.bucket.blob(object_name).generate_signed_url(
+            expiration=expiration,
+            version='v4',
+            method='GET',
+        )
+        signed = SignedUrl(url, generation, expiration)
+        with self._lock:
+            # Older generations of the object are never handed out again
+            for key in [key for key in self._urls if key[0] == object_name and key[1] != generation]:
+                del self._urls[key]
+            self._urls[(object_name, generation)] = signed
+        return signed
+
+    def _current_generation(self, object_name):
+        with self._lock:
+            cached = self._generations.get(object_name)
+        if cached is not None and time.monotonic() - cached[1] < self.generationTtlSeconds:
+            return cached[0]
+        blob = self.bucket.get_blob(object_name)
+        if blob is None:
+            self.invalidate(object_name)
+            return None
+        with self._lock:
+            self._generations[object_name] = (blob.generation, time.monotonic())
+        return blob.generation
+
+    def invalidate(self, object_name):
+        with self._lock:
+            self._generations.pop(object_name, None)
+            for key in [key for key in self._urls if key[0] == object_name]:
+                del self._urls[key]
@@ -0,0 +1,79 @@
+import os
+import sys
+import struct
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from indexArchive import write_zip_archive  # noqa: E402
+
+ZIP64_EXTRA_ID = 0x0001
+
+
+def local_extra(zipPath, zinfo):
+    '''
+    Extra field of the local header of an entry, where zipfile puts the zip64 sizes
+    '''
+    with open(zipPath, 'rb') as file:
+        file.seek(zinfo.header_offset)
+        header = file.read(30)
+        nameLength, extraLength = struct.unpack('<HH', header[26:30])
+        file.seek(nameLength, os.SEEK_CUR)
+        return header, file.read(extraLength)
+
+
+class WriteZipArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.directory.name, 'index')
+        os.makedirs(self.folder)
+        self.zipPath = os.path.join(self.directory.name, 'index.zip')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.folder, name), 'wb') as file:
+            file.write(data)
+
+    def test_entries_carry_their_size(self):
+        self.write('index.ann', os.urandom(100000))
+        self.write('info.json', b'{}')
+        write_zip_archive(self.folder, self.zipPath, chunkSize=4096)
+        with zipfile.ZipFile(self.zipPath) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual({zinfo.filename: zinfo.file_size for zinfo in archive.infolist()},
+                             {'index.ann': 100000, 'info.json': 2})
+            for zinfo in archive.infolist():
+                self.assertEqual(zinfo.date_time, (1980, 1, 1, 0, 0, 0))
+
+    def test_entries_over_the_zip64_limit_get_zip64_headers(self):
+        # Copying an entry of more than 4 GiB takes minutes, lowering the limit takes the same code path
+        data = os.urandom(5000)
+        self.write('index.ann', data)
+        with mock.patch.object(zipfile, 'ZIP64_LIMIT', 4096):
+            write_zip_archive(self.folder, self.zipPath, chunkSize=1024)
+        with zipfile.ZipFile(self.zipPath) as archive:
+            zinfo = archive.getinfo('index.ann')
+            self.assertEqual(zinfo.file_size, len(data))
+            self.assertEqual(archive.read('index.ann'), data)
+        header, extra = local_extra(self.zipPath, zinfo)
+        self.assertEqual(struct.unpack('<II', header[18:26]), (0xFFFFFFFF, 0xFFFFFFFF))
+        headerId, size, fileSize, compressedSize = struct.unpack_from('<HHQQ', extra)
+        self.assertEqual((headerId, size, fileSize, compressedSize), (ZIP64_EXTRA_ID, 16, len(data), len(data)))
+
+    def test_entries_over_the_zip64_limit_without_a_size_fail(self):
+        # The entry size is what keeps zipfile from rejecting large entries once they are written
+        data = os.urandom(5000)
+        self.write('index.ann', data)
+        with mock.patch.object(zipfile, 'ZIP64_LIMIT', 4096), \
+                mock.patch.object(os.path, 'getsize', return_value=0):
+            with self.assertRaises(RuntimeError):
+                write_zip_archive(self.folder, self.zipPath, chunkSize=1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lazyResource import LazyResource, readiness  # noqa: E402
+
+
+class FakeRedis:
+    '''
+    Stands in for redis.Redis, whose get(key) and name-like attributes must reach the client through the proxy
+    '''
+
+    def __init__(self):
+        self.values = {b'part_cache_generation': b'3'}
+
+    def get(self, key):
+        return self.values.get(key.encode() if isinstance(key, str) else key)
+
+
+class FakeBucket:
+    name = 'bucket-id'
+
+
+class LazyResourceTest(unittest.TestCase):
+
+    def test_get_is_forwarded_to_the_client(self):
+        redis_client = LazyResource('redis_client', FakeRedis)
+        self.assertEqual(redis_client.get('part_cache_generation'), b'3')
+        self.assertIsNone(redis_client.get('missing'))
+
+    def test_name_is_forwarded_to_the_client(self):
+        gcs_bucket = LazyResource('gcs_bucket', FakeBucket)
+        self.assertEqual(gcs_bucket.name, 'bucket-id')
+        self.assertEqual(gcs_bucket.resourceName, 'gcs_bucket')
+
+    def test_created_once_and_reported_ready(self):
+        created = []
+        resource = LazyResource('client', lambda: created.append(1) or FakeRedis())
+        self.assertEqual(readiness([resource]), (False, {'client': False}))
+        self.assertIs(resource.instance(), resource.instance())
+        self.assertEqual(len(created), 1)
+        self.assertEqual(readiness([resource]), (True, {'client': True}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+import os
+import json
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+import numpy
+from numpy.lib.format import open_memmap
+
+# Local on-disk feature vector store, one contiguous float32 matrix per vendor/category
+VECTOR_CACHE_PATH = os.getenv("VECTOR_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "VectorCache"))
+# Upper bound of the whole cache folder, least recently used vendor/category stores are evicted first
+VECTOR_CACHE_MAX_BYTES = int(os.getenv("VECTOR_CACHE_MAX_BYTES", 4 * 1024 ** 3))
+
+MATRIX_FILE_NAME = "vectors.npy"
+INDEX_FILE_NAME = "index.json"
+LOCK_FILE_NAME = ".lock"
+MIN_CAPACITY = 1024
+
+
+class VectorStore:
+    '''
+    Vectors of one vendor/category. Rows live in a memory-mapped .npy matrix, the name -> (row, generation)
+    table in a JSON file next to it. Writers from several processes are serialized with a file lock,
+    readers pick up changes by checking the modification time of the index file.
+    '''
+
+    def __init__(self, storePath):
+        self.storePath = storePath
+        self.rows = {}
+        self.dimension = None
+        self.size = 0
+        self._matrix = None
+        self._indexMTime = None
+        self._lock = threading.Lock()
+
+    @property
+    def matrixPath(self):
+        return os.path.join(self.storePath, MATRIX_FILE_NAME)
+
+    @property
+    def indexPath(self):
+        return os.path.join(self.storePath, INDEX_FILE_NAME)
+
+    @contextmanager
+    def _file_lock(self, exclusive):
+        os.makedirs(self.storePath, exist_ok=True)
+        with open(os.path.join(self.storePath, LOCK_FILE_NAME), 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.indexPath).st_mtime_ns
+        except OSError:
+            self.rows, self.dimension, self.size, self._matrix, self._indexMTime = {}, None, 0, None, None
+            return
+        if mtime == self._indexMTime:
+            return
+        with open(self.indexPath, 'r') as file:
+            index = json.load(file)
+        self.rows = {name: tuple(value) for name, value in index['rows'].items()}
+        self.dimension = index['dimension']
+        self.size = index['size']
+        self._matrix = open_memmap(self.matrixPath, mode='r+')
+        self._indexMTime = mtime
+
+    def _save_index(self):
+        tempPath = self.indexPath + '.tmp'
+        with open(tempPath, 'w') as outfile:
+            json.dump({'dimension': self.dimension, 'size': self.size, 'rows': self.rows}, outfile)
+        os.replace(tempPath, self.indexPath)
+        self._indexMTime = os.stat(self.indexPath).st_mtime_ns
+
+    def _ensure_capacity(self, rowsNeeded, dimension):
+        if self._matrix is not None and self._matrix.shape[0] >= rowsNeeded:
+            return
+        capacity = max(MIN_CAPACITY, rowsNeeded, 2 * (self._matrix.shape[0] if self._matrix is not None else 0))
+        tempPath = self.matrixPath + '.tmp'
+        matrix = open_memmap(tempPath, mode='w+', dtype=numpy.float32, shape=(capacity, dimension))
+        if self._matrix is not None:
+            matrix[:self.size] = self._matrix[:self.size]
+        matrix.flush()
+        del matrix
+        os.replace(tempPath, self.matrixPath)
+        self._matrix = open_memmap(self.matrixPath, mode='r+')
+
+    def touch(self):
+        os.makedirs(self.storePath, exist_ok=True)
+        os.utime(self.storePath)
+
+    def get_many(self, generations):
+        '''
+        Read cached vectors that are still up to date
+        :param generations: Dictionary of image name -> expected GCS generation of its feature map
+        :return: Dictionary of image name -> float32 vector for every hit
+        '''
+        with self._lock, self._file_lock(False):
+            self._refresh()
+            hits = {}
+            for name, generation in generations.items():
+                entry = self.rows.get(name)
+                # A different generation means the feature map was uploaded again, the row is stale
+                if entry is not None and entry[1] == generation:
+                    hits[name] = numpy.array(self._matrix[entry[0]])
+        if hits:
+            self.touch()
+        return hits
+
+    def load_into(self, generations, loader):
+        '''
+        Copy up to date cached vectors straight into the rows of a VectorMatrixLoader
+        :param generations: Dictionary of image name -> expected GCS generation of its feature map
+        :return: Set of image names that were served from the cache
+        '''
+        with self._lock, self._file_lock(False):
+            self._refresh()
+            hits = set()
+            for name, generation in generations.items():
+                entry = self.rows.get(name)
+                if entry is not None and entry[1] == generation and loader.set(name, self._matrix[entry[0]]):
+                    hits.add(name)
+        if hits:
+            self.touch()
+        return hits
+
+    def put_many(self, items):
+        '''
+        Store vectors, replacing stale rows of the same image in place
+        :param items: Iterable of (image name, generation, vector)
+        '''
+        items = list(items)
+        if not items:
+            return
+        with self._lock, self._file_lock(True):
+            self._refresh()
+            dimension = self.dimension or len(items[0][2])
+            newNames = {name for name, _, _ in items if name not in self.rows}
+            self._ensure_capacity(self.size + len(newNames), dimension)
+            self.dimension = dimension
+            for name, generation, vector in items:
+                if len(vector) != dimension:
+                    print(f'Skipping vector of {name} with {len(vector)} instead of {dimension} dimensions')
+                    continue
+                if name in self.rows:
+                    row = self.rows[name][0]
+                else:
+                    row = self.size
+                    self.size += 1
+                self._matrix[row] = vector
+                self.rows[name] = (row, generation)
+            self._matrix.flush()
+            self._save_index()
+        self.touch()
+
+    def retain(self, names):
+        '''
+        Drop every image that is not in names and compact the matrix if more than half of it is unused
+        '''
+        names = set(names)
+        with self._lock, self._file_lock(True):
+            self._refresh()
+            if all(name in names for name in self.rows):
+                return
+            self.rows = {name: value for name, value in self.rows.items() if name in names}
+            if self._matrix is not None and len(self.rows) * 2 < self.size:
+                self._compact()
+            self._save_index()
+
+    def _compact(self):
+        tempPath = self.matrixPath + '.tmp'
+        capacity = max(MIN_CAPACITY, len(self.rows))
+        matrix = open_memmap(tempPath, mode='w+', dtype=numpy.float32, shape=(capacity, self.dimension))
+        newRows = {}
+        for newRow, (name, (row, generation)) in enumerate(self.rows.items()):
+            matrix[newRow] = self._matrix[row]
+            newRows[name] = (newRow, generation)
+        matrix.flush()
+        del matrix
+        os.replace(tempPath, self.matrixPath)
+        self._matrix = open_memmap(self.matrixPath, mode='r+')
+        self.rows = newRows
+        self.size = len(newRows)
+
+
+class VectorCache:
+    '''
+    Folder of VectorStores with a size bound over all of them
+    '''
+
+    def __init__(self, rootPath=VECTOR_CACHE_PATH, maxBytes=VECTOR_CACHE_MAX_BYTES):
+        self.rootPath = rootPath
+        self.maxBytes = maxBytes
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def store(self, identifier):
+        with self._lock:
+            if identifier not in self._stores:
+                self._stores[identifier] = VectorStore(os.path.join(self.rootPath, identifier))
+            return self._stores[identifier]
+
+    def get_many(self, identifier, generations):
+        return self.store(identifier).get_many(generations)
+
+    def load_into(self, identifier, generations, loader):
+        return self.store(identifier).load_into(generations, loader)
+
+    def put_many(self, identifier, items):
+        self.store(identifier).put_many(items)
+        self.evict(keep=identifier)
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used stores until the cache fits into maxBytes again
+        :param keep: Identifier of a store that must not be evicted, e.g. the one currently written
+        '''
+        if not os.path.isdir(self.rootPath):
+            return
+        stores = []
+        totalBytes = 0
+        for identifier in os.listdir(self.rootPath):
+            storePath = os.path.join(self.rootPath, identifier)
+            if not os.path.isdir(storePath):
+                continue
+            storeBytes = sum(os.path.getsize(os.path.join(storePath, obj)) for obj in os.listdir(storePath))
+            stores.append((os.stat(storePath).st_mtime, identifier, storeBytes))
+            totalBytes += storeBytes
+
+        for _, identifier, storeBytes in sorted(stores):
+            if totalBytes <= self.maxBytes:
+                break
+            if identifier == keep:
+                continue
+            print(f'Evicting {identifier} from the vector cache')
+            shutil.rmtree(os.path.join(self.rootPath, identifier), ignore_errors=True)
+            with self._lock:
+                self._stores.pop(identifier, None)
+            totalBytes -= storeBytes
+
+
+vector_cache = VectorCache()
@@ -0,0 +1,76 @@
+import threading
+import numpy
+
+
+class VectorMatrixLoader:
+    '''
+    Collects the feature vectors of a build into one preallocated (n, dim) float32 matrix. Row i always
+    belongs to image_file_names[i], no matter in which order downloads finish, and rows that never
+    arrive are tracked in the present mask instead of shifting the following rows.
+    With a backing path the matrix is a memory-mapped .npy file, so builds larger than the memory only
+    keep the pages in use resident.
+    '''
+
+    def __init__(self, image_file_names, dimension=None, backingPath=None):
+        self.image_file_names = list(image_file_names)
+        self.positions = {name: idx for idx, name in enumerate(self.image_file_names)}
+        self.present = numpy.zeros(len(self.image_file_names), dtype=bool)
+        self.matrix = None
+        self.dimension = None
+        self.backingPath = backingPath
+        self._lock = threading.Lock()
+        if dimension is not None:
+            self._allocate(dimension)
+
+    def _allocate(self, dimension):
+        self.dimension = dimension
+        shape = (len(self.image_file_names), dimension)
+        if self.backingPath:
+            self.matrix = numpy.lib.format.open_memmap(self.backingPath, mode='w+', dtype=numpy.float32, shape=shape)
+        else:
+            self.matrix = numpy.empty(shape, dtype=numpy.float32)
+
+    def set(self, name, vector):
+        '''
+        Copy a vector into the row of its image
+        :return: True on success, False if the image is unknown or the dimension does not match
+        '''
+        position = self.positions.get(name)
+        if position is None:
+            return False
+        if self.matrix is None:
+            with self._lock:
+                if self.matrix is None:
+                    self._allocate(len(vector))
+        if len(vector) != self.dimension:
+            print(f'Skipping vector of {name} with {len(vector)} instead of {self.dimension} dimensions')
+            return False
+        self.matrix[position] = vector
+        self.present[position] = True
+        return True
+
+    def row(self, name):
+        return self.matrix[self.positions[name]]
+
+    def has(self, name):
+        position = self.positions.get(name)
+        return position is not None and bool(self.present[position])
+
+    def missing_names(self):
+        return [self.image_file_names[idx] for idx in numpy.flatnonzero(~self.present)]
+
+    def compact(self):
+        '''
+        Move the present rows to the front of the matrix in place, so that Annoy item ids are contiguous.
+        The loader must not be written to afterwards.
+        :return: (image names in row order, matrix view with one row per name)
+        '''
+        if self.matrix is None:
+            return [], numpy.empty((0, 0), dtype=numpy.float32)
+        presentIdx = numpy.flatnonzero(self.present)
+        # Rows only move towards the front, so the in place copy never overwrites a row still to be moved
+        for newIdx, oldIdx in enumerate(presentIdx):
+            if newIdx != oldIdx:
+                self.matrix[newIdx] = self.matrix[oldIdx]
+        names = [self.image_file_names[idx] for idx in presentIdx]
+        return names, self.matrix[:len(names)]
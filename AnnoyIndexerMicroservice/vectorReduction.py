@@ -0,0 +1,121 @@
+import os
+import numpy
+from indexTuning import is_normalised
+
+# Reduction of the feature vectors before indexing: "none", "pca" or "random" (seeded Gaussian projection)
+REDUCTION_METHOD = os.getenv("REDUCTION_METHOD", "none")
+REDUCTION_DIMENSION = int(os.getenv("REDUCTION_DIMENSION", 256))
+# Vectors a PCA is fitted on, per vendor/category
+REDUCTION_SAMPLE_SIZE = int(os.getenv("REDUCTION_SAMPLE_SIZE", 20000))
+# Rows projected at once, bounds the temporary memory of the projection
+REDUCTION_BATCH_SIZE = int(os.getenv("REDUCTION_BATCH_SIZE", 4096))
+REDUCTION_SEED = int(os.getenv("REDUCTION_SEED", 0))
+
+PROJECTION_FILE_SUFFIX = "_projection.npz"
+
+
+class Projection:
+    '''
+    Linear map from the feature vectors to the indexed vectors: (vector - mean) @ components. Unit length
+    inputs give unit length outputs again, so euclidean and angular distances keep ranking alike.
+    '''
+
+    def __init__(self, method, mean, components, normalise):
+        self.method = method
+        self.mean = numpy.asarray(mean, dtype=numpy.float32)
+        self.components = numpy.ascontiguousarray(components, dtype=numpy.float32)
+        self.normalise = bool(normalise)
+
+    @property
+    def input_dimension(self):
+        return self.components.shape[0]
+
+    @property
+    def dimension(self):
+        return self.components.shape[1]
+
+    def transform(self, vectors, batchSize=REDUCTION_BATCH_SIZE, out=None):
+        '''
+        Project vectors, row by row for a matrix or a single vector (e.g. a query)
+        :param out: Optional (n, dimension) float32 matrix the result is written into, e.g. a memory-mapped file
+        :return: float32 matrix (or vector) of the reduced dimension
+        '''
+        vectors = numpy.asarray(vectors, dtype=numpy.float32)
+        if vectors.ndim == 1:
+            return self.transform(vectors[None, :], batchSize)[0]
+        result = out if out is not None else numpy.empty((vectors.shape[0], self.dimension), dtype=numpy.float32)
+        for start in range(0, vectors.shape[0], batchSize):
+            batch = (vectors[start:start + batchSize] - self.mean) @ self.components
+            if self.normalise:
+                batch /= numpy.maximum(numpy.linalg.norm(batch, axis=1, keepdims=True), 1e-12)
+            result[start:start + batchSize] = batch
+        return result
+
+    def describe(self):
+        return {'method': self.method, 'input_dimension': self.input_dimension, 'dimension': self.dimension,
+                'normalise': self.normalise}
+
+    def save(self, path):
+        with open(path, 'wb') as outfile:
+            numpy.savez(outfile, method=self.method, mean=self.mean, components=self.components,
+                        normalise=self.normalise)
+
+
+def load_projection(path):
+    with numpy.load(path) as data:
+        return Projection(str(data['method']), data['mean'], data['components'], bool(data['normalise']))
+
+
+def _sample(vectors, sampleSize, seed):
+    if vectors.shape[0] <= sampleSize:
+        return vectors
+    rows = numpy.sort(numpy.random.default_rng(seed).choice(vectors.shape[0], size=sampleSize, replace=False))
+    return vectors[rows]
+
+
+def fit_pca(vectors, dimension, sampleSize=REDUCTION_SAMPLE_SIZE, seed=REDUCTION_SEED, batchSize=REDUCTION_BATCH_SIZE):
+    '''
+    Fit a PCA on a sample of the vectors. The covariance is accumulated in batches, so only a
+    dim x dim matrix is held besides the sample.
+    '''
+    sample = _sample(vectors, sampleSize, seed)
+    mean = sample.mean(axis=0, dtype=numpy.float64)
+    covariance = numpy.zeros((sample.shape[1], sample.shape[1]), dtype=numpy.float64)
+    for start in range(0, sample.shape[0], batchSize):
+        batch = sample[start:start + batchSize] - mean
+        covariance += batch.T @ batch
+    eigenvalues, eigenvectors = numpy.linalg.eigh(covariance)
+    # eigh returns ascending eigenvalues, keep the largest
+    components = eigenvectors[:, ::-1][:, :min(dimension, sample.shape[1])]
+    return Projection('pca', mean, components, is_normalised(sample))
+
+
+def fit_random(vectors, dimension, seed=REDUCTION_SEED):
+    '''
+    Seeded Gaussian random projection, no fitting needed and the same matrix for every build with the same seed
+    '''
+    rng = numpy.random.default_rng(seed)
+    components = rng.normal(0, 1.0 / numpy.sqrt(dimension), size=(vectors.shape[1], dimension))
+    return Projection('random', numpy.zeros(vectors.shape[1]), components, is_normalised(_sample(vectors, 1000, seed)))
+
+
+def fit_projection(vectors, method=REDUCTION_METHOD, dimension=REDUCTION_DIMENSION):
+    '''
+    :return: Projection for the configured method, None if no reduction is configured or the vectors are
+             not larger than the target dimension
+    '''
+    if method == 'none' or vectors.shape[1] <= dimension:
+        return None
+    if method == 'pca':
+        return fit_pca(vectors, dimension)
+    if method == 'random':
+        return fit_random(vectors, dimension)
+    raise ValueError(f'Unknown reduction method {method}')
+
+
+def settings():
+    '''
+    Reduction settings that decide the content of an index, part of its content hash
+    '''
+    return {'method': REDUCTION_METHOD, 'dimension': REDUCTION_DIMENSION, 'sample_size': REDUCTION_SAMPLE_SIZE,
+            'seed': REDUCTION_SEED}
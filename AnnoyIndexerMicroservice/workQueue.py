@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import uuid
+import socket
+
+# A leased task that is not heartbeated for this long is handed to another node
+BUILD_LEASE_SECONDS = int(os.getenv("BUILD_LEASE_SECONDS", 120))
+# Failed or abandoned tasks are retried until they were tried this often
+BUILD_MAX_ATTEMPTS = int(os.getenv("BUILD_MAX_ATTEMPTS", 3))
+
+QUEUE_PENDING_NAME = "build_queue:pending"
+QUEUE_LEASES_NAME = "build_queue:leases"
+QUEUE_TASKS_NAME = "build_queue:tasks"
+QUEUE_RESULTS_NAME = "build_queue:results"
+QUEUE_RUN_NAME = "build_queue:run"
+
+# Requeue (or give up on) tasks whose lease expired. Shared by the lease and peek scripts, so
+# abandoned tasks show up in the queue as soon as any node looks at it.
+RECLAIM_SCRIPT = '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], id)
+    local raw = redis.call('HGET', KEYS[3], id)
+    if raw then
+        local task = cjson.decode(raw)
+        task['attempts'] = task['attempts'] + 1
+        task['last_error'] = 'Lease of ' .. tostring(task['owner']) .. ' expired'
+        task['owner'] = false
+        if task['attempts'] < tonumber(ARGV[4]) then
+            redis.call('HSET', KEYS[3], id, cjson.encode(task))
+            redis.call('LPUSH', KEYS[1], id)
+        else
+            redis.call('HDEL', KEYS[3], id)
+            redis.call('HSET', KEYS[4], id, cjson.encode({status='failed', error=task['last_error'], attempts=task['attempts']}))
+        end
+    end
+end
+'''
+
+# Lease the next pending task
+LEASE_SCRIPT = RECLAIM_SCRIPT + '''
+local id = redis.call('LPOP', KEYS[1])
+if not id then
+    return false
+end
+local raw = redis.call('HGET', KEYS[3], id)
+if not raw then
+    return false
+end
+local task = cjson.decode(raw)
+task['owner'] = ARGV[3]
+redis.call('HSET', KEYS[3], id, cjson.encode(task))
+redis.call('ZADD', KEYS[2], tonumber(ARGV[1]) + tonumber(ARGV[2]), id)
+return cjson.encode(task)
+'''
+
+# Return the next pending task without leasing it
+PEEK_SCRIPT = RECLAIM_SCRIPT + '''
+local id = redis.call('LINDEX', KEYS[1], 0)
+if not id then
+    return false
+end
+return redis.call('HGET', KEYS[3], id)
+'''
+
+# Extend the lease of a task, only for the worker that owns it
+HEARTBEAT_SCRIPT = '''
+local task = redis.call('HGET', KEYS[2], ARGV[1])
+if not task or cjson.decode(task)['owner'] ~= ARGV[2] or not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+'''
+
+# Finish a task. Failed tasks go back to the end of the queue until they reach the attempt limit.
+COMPLETE_SCRIPT = '''
+local task = redis.call('HGET', KEYS[3], ARGV[1])
+if not task then
+    return 0
+end
+task = cjson.decode(task)
+if task['owner'] ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+local result = cjson.decode(ARGV[3])
+if result['status'] == 'failed' and task['attempts'] + 1 < tonumber(ARGV[4]) then
+    task['attempts'] = task['attempts'] + 1
+    task['last_error'] = result['error']
+    task['owner'] = false
+    redis.call('HSET', KEYS[3], ARGV[1], cjson.encode(task))
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+    return 2
+end
+result['attempts'] = task['attempts'] + 1
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HSET', KEYS[4], ARGV[1], cjson.encode(result))
+return 1
+'''
+
+# Start a new run only if no task of the previous one is pending or holds a live lease
+ENQUEUE_SCRIPT = '''
+if redis.call('LLEN', KEYS[1]) > 0 or redis.call('ZCOUNT', KEYS[2], ARGV[1], '+inf') > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+redis.call('HSET', KEYS[5], 'run_id', ARGV[2], 'started_at', ARGV[1], 'total', (#ARGV - 2) / 2)
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+return 1
+'''
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    '''
+    Redis-backed queue of vendor/category builds shared by all indexer nodes. Nodes lease tasks, keep
+    the lease alive with heartbeats and report completion. Tasks of a dead node are leased again once
+    their lease expires, failed tasks are retried up to BUILD_MAX_ATTEMPTS times.
+    '''
+
+    def __init__(self, redisClient, leaseSeconds=BUILD_LEASE_SECONDS, maxAttempts=BUILD_MAX_ATTEMPTS):
+        self.redisClient = redisClient
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+
+    def enqueue_run(self, tasks):
+        '''
+        Queue the tasks of a new run, largest first
+        :param tasks: List of dictionaries with at least "id", "vendor", "category" and "estimated_bytes"
+        :return: Run id, None if the previous run is still in progress
+        '''
+        runId = str(uuid.uuid4())
+        args = [time.time(), runId]
+        for task in sorted(tasks, key=lambda obj: obj['estimated_bytes'], reverse=True):
+            args += [task['id'], json.dumps(dict(task, attempts=0, owner=False, run_id=runId))]
+        keys = [QUEUE_PENDING_NAME, QUEUE_LEASES_NAME, QUEUE_TASKS_NAME, QUEUE_RESULTS_NAME, QUEUE_RUN_NAME]
+        if not self.redisClient.eval(ENQUEUE_SCRIPT, len(keys), *keys, *args):
+            return None
+        return runId
+
+    def peek(self):
+        '''
+        :return: Next pending task without leasing it, None if the queue is empty
+        '''
+        keys = [QUEUE_PENDING_NAME, QUEUE_LEASES_NAME, QUEUE_TASKS_NAME, QUEUE_RESULTS_NAME]
+        task = self.redisClient.eval(PEEK_SCRIPT, len(keys), *keys, time.time(), self.leaseSeconds, '', self.maxAttempts)
+        return json.loads(task) if task else None
+
+    def lease(self, workerId):
+        '''
+        :return: Leased task dictionary, None if nothing is pending
+        '''
+        keys = [QUEUE_PENDING_NAME, QUEUE_LEASES_NAME, QUEUE_TASKS_NAME, QUEUE_RESULTS_NAME]
+        task = self.redisClient.eval(LEASE_SCRIPT, len(keys), *keys,
+                                     time.time(), self.leaseSeconds, workerId, self.maxAttempts)
+        return json.loads(task) if task else None
+
+    def heartbeat(self, taskId, workerId):
+        '''
+        :return: False if the lease was lost, e.g. because it expired and the task went to another node
+        '''
+        return bool(self.redisClient.eval(HEARTBEAT_SCRIPT, 2, QUEUE_LEASES_NAME, QUEUE_TASKS_NAME,
+                                          taskId, workerId, time.time() + self.leaseSeconds))
+
+    def complete(self, taskId, workerId, result):
+        '''
+        Report the result of a leased task
+        :param result: Dictionary with at least "status", "failed" results are retried
+        :return: 1 if finished, 2 if queued again for a retry, 0 if the lease was lost
+        '''
+        keys = [QUEUE_PENDING_NAME, QUEUE_LEASES_NAME, QUEUE_TASKS_NAME, QUEUE_RESULTS_NAME]
+        return self.redisClient.eval(COMPLETE_SCRIPT, len(keys), *keys,
+                                     taskId, workerId, json.dumps(result), self.maxAttempts)
+
+    def status(self):
+        run = {key.decode(): value.decode() for key, value in self.redisClient.hgetall(QUEUE_RUN_NAME).items()}
+        results = {key.decode(): json.loads(value) for key, value in self.redisClient.hgetall(QUEUE_RESULTS_NAME).items()}
+        return {'run': run,
+                'pending': self.redisClient.llen(QUEUE_PENDING_NAME),
+                'leased': self.redisClient.zcard(QUEUE_LEASES_NAME),
+                'results': results}
+
+    def clear(self):
+        self.redisClient.delete(QUEUE_PENDING_NAME, QUEUE_LEASES_NAME, QUEUE_TASKS_NAME,
+                                QUEUE_RESULTS_NAME, QUEUE_RUN_NAME)
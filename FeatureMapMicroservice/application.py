@@ -1,16 +1,19 @@
 import shutil
 
-from flask import Flask, request
+from flask import Flask, Blueprint, Response, request, jsonify
 import os
 import io
 import pymongo
 import time
 import json
-from featureMap import Index
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import fileOperations
 from google.cloud import storage
+from redis import Redis
+from lazyResource import LazyResource, warm, warm_in_background, readiness
+import metrics
 
 from dotenv import load_dotenv
 load_dotenv(dotenv_path='../dot.env')
@@ -19,17 +22,62 @@ def connectMongoQuestionsDB():
     myclient = pymongo.MongoClient(mongoURI)
     return myclient
 
+def createFeatureIndex():
+    # TensorFlow and the VGG16 weights are only loaded when the first feature map is generated
+    if INFERENCE_POOL:
+        from inferencePool import InferencePool
+        return InferencePool()
+    from featureMap import Index
+    return Index()
+
+# Create clients and the model on first use instead of at import, so workers start fast
+EAGER_INIT = os.getenv("EAGER_INIT", "0") == "1"
+WARM_ON_START = os.getenv("WARM_ON_START", "1") == "1"
+# Run the model in a pool of worker processes (see inferencePool.py), otherwise in the service process
+INFERENCE_POOL = os.getenv("INFERENCE_POOL", "1") == "1"
+# Packages of images downloaded, extracted and uploaded at once; the model runs on as many as there are
+# inference workers, the others download and upload meanwhile
+FEATURE_MAP_PACKAGE_THREADS = int(os.getenv("FEATURE_MAP_PACKAGE_THREADS", 8))
+
 threadExecutor = ThreadPoolExecutor(1)
 dictUsers = {}
-application = Flask(__name__)
-mongoClient = connectMongoQuestionsDB()
+# Stage and progress of the uploads of this process; long-polls and event streams wait on jobChanged
+jobStages = {}
+jobChanged = threading.Condition()
+# Progress of an upload when each of its stages starts, the feature maps report their own progress up to 99
+UPLOAD_STAGE_PROGRESS = {'decrypt': 0, 'unzip': 5, 'mongo_insert': 10, 'image_upload': 15, 'preset_upload': 45,
+                         'feature_maps': 50}
+# Longest wait of a /get-result long-poll (?wait=seconds)
+RESULT_WAIT_MAX_SECONDS = float(os.getenv("RESULT_WAIT_MAX_SECONDS", 30))
+# Requests that may block on uploads at once, each holds a worker thread; further ones are answered right away
+RESULT_MAX_WAITERS = int(os.getenv("RESULT_MAX_WAITERS", 4))
+resultWaiters = threading.BoundedSemaphore(max(1, RESULT_MAX_WAITERS))
+# Event streams send a comment after this long without a change and are closed after the maximum
+RESULT_STREAM_HEARTBEAT_SECONDS = float(os.getenv("RESULT_STREAM_HEARTBEAT_SECONDS", 15))
+RESULT_STREAM_MAX_SECONDS = float(os.getenv("RESULT_STREAM_MAX_SECONDS", 300))
+# Result codes after which an upload does not change anymore: done, id unknown, cancelled
+FINAL_RESULTS = (0, 2, 3)
+# Routes of the service, registered on the application in create_app
+bp = Blueprint('feature_map', __name__)
+mongoClient = LazyResource('mongo_client', connectMongoQuestionsDB)
 
 # Set up Google Cloud Storage client
-gcs_client = storage.Client()
+gcs_client = LazyResource('gcs_client', storage.Client)
 
 # Your Google Cloud Storage bucket name
 gcs_bucket_name = os.getenv("GOOGLE_CLOUD_BUCKET_ID")
-gcs_bucket = gcs_client.bucket(gcs_bucket_name)
+gcs_bucket = LazyResource('gcs_bucket', lambda: gcs_client.bucket(gcs_bucket_name))
+
+# One feature extractor (or inference pool) shared by all threads
+featureIndex = LazyResource('feature_index', createFeatureIndex)
+
+# Redis of the indexer service; bumping its part cache generation clears the part documents cached by its workers
+REDIS_URL = os.getenv("REDIS_URL")
+PART_CACHE_GENERATION_NAME = "part_cache_generation"
+redis_client = LazyResource('redis_client', lambda: Redis.from_url(REDIS_URL)) if REDIS_URL else None
+
+# Resources warmed in the background and reported by /ready
+LAZY_RESOURCES = [mongoClient, gcs_client, gcs_bucket, featureIndex] + ([redis_client] if redis_client else [])
 
 processing_complete = False
 
@@ -67,7 +115,8 @@ COLLECTION_NAME = "JSONInfo"#"Testing"
 
 def generateFeatureMapCreationTask(bucketName, id):
     '''
-    Create as many threads as possible on this machine parallelizing the processing of an image into feature maps
+    Extract the feature maps of all images of an upload in packages of 100 on FEATURE_MAP_PACKAGE_THREADS threads,
+    the model runs in the inference pool (or the service process)
     :param bucketName: GCS Bucket Name
     :param id: UUID coming from the Go Server
     :return:
@@ -88,14 +137,15 @@ def generateFeatureMapCreationTask(bucketName, id):
         for idx in range(0, len(lstGCSObjects), count):
             fileTuples.append((idx, min(idx + count, len(lstGCSObjects))))
 
-        with ThreadPoolExecutor() as executor:
+        with ThreadPoolExecutor(FEATURE_MAP_PACKAGE_THREADS) as executor:
             args = []
             for fileChunkIdx in fileTuples:
                 chunk = lstGCSObjects[fileChunkIdx[0]: fileChunkIdx[1]]
                 blob_list = [blob for blob in chunk] 
                 args.append([bucketName, blob_list, id])
 
-            results = executor.map(generateFeatureMap, args)
+            for done, _ in enumerate(executor.map(generateFeatureMap, args), 1):
+                report_stage(id, 'feature_maps', 50 + 49 * done // len(args))
 
     except Exception as err:
         print(f"Error in generateFeatureMapCreationTask process: {err}")
@@ -109,7 +159,7 @@ def generateFeatureMap(args):
     :return: True on Success, False otherwise
     '''
     # Gets the information in bytes
-    indexer = Index()
+    indexer = featureIndex.instance()
 
     bucketName = args[0]
     package = args[1]
@@ -127,95 +177,226 @@ def generateFeatureMap(args):
             time.sleep(0.5)
             pass
 
+    lstImageBytes = []
     for obj in package:
         try:
-            gcsImageBytes = obj.download_as_bytes()
+            with metrics.timed('feature_map', 'image_download'):
+                gcsImageBytes = obj.download_as_bytes()
+            metrics.count_gcs_bytes('in', len(gcsImageBytes))
+            lstImageBytes.append(gcsImageBytes)
         except Exception as error:
             mongoReplace(id, "Failed to get the Body of the GCS object.")
             print(error)
             return False  # Return False on failure
 
-        try:
-            gcsImageBytesFeatures = indexer.extract_single_feature(gcsImageBytes, True)
-        except Exception as error:
-            mongoReplace(id, "Failed to extract the single feature.")
-            print(error)
-            return False  # Return False on failure
-
+    # The images of the package are decoded in parallel and run through the model in batches
+    try:
+        with metrics.timed('feature_map', 'inference'):
+            lstFeatures = indexer.extract_features(lstImageBytes, True)
+    except Exception as error:
+        mongoReplace(id, "Failed to extract the features.")
+        print(error)
+        return False  # Return False on failure
+
+    for obj, gcsImageBytesFeatures in zip(package, lstFeatures):
         fileName = obj.name.replace("img/", "featuremap/").rsplit('.', 1)[0] + ".bin"
         try:
-            bucket = gcs_client.get_bucket(bucketName)
-            blob = bucket.blob(fileName)
-            blob.upload_from_file(io.BytesIO(gcsImageBytesFeatures.tobytes()), content_type="application/octet-stream")
+            featureBytes = gcsImageBytesFeatures.tobytes()
+            with metrics.timed('feature_map', 'feature_upload'):
+                bucket = gcs_client.get_bucket(bucketName)
+                blob = bucket.blob(fileName)
+                blob.upload_from_file(io.BytesIO(featureBytes), content_type="application/octet-stream")
+            metrics.count_gcs_bytes('out', len(featureBytes))
         except Exception as error:
             mongoReplace(id, "Failed to upload feature map to GCS.")
             print(error)
             return False  # Return False on failure
+        metrics.count_items('feature_map', 'images')
 
     return True
 
 
 
 
-@application.route("/get-result/<id>", methods=['GET'])
+def report_stage(id, stage, progress):
+    '''
+    Record the stage of an upload and wake up the requests waiting for it
+    '''
+    with jobChanged:
+        jobStages[id] = {'stage': stage, 'progress': progress, 'updated_at': time.time()}
+        jobChanged.notify_all()
+
+
+def upload_finished(id, future):
+    with jobChanged:
+        # Not recorded again if the result was already reported and forgotten
+        if id in dictUsers:
+            stage = 'cancelled' if future.cancelled() else 'failed' if future.exception() else 'done'
+            jobStages[id] = {'stage': stage, 'progress': 100, 'updated_at': time.time()}
+        jobChanged.notify_all()
+
+
+def result_status(id):
+    '''
+    State of an upload with its stage, progress and "updated_at", the version of the reply
+    '''
+    future = dictUsers.get(id)
+    if future is None:
+        return {'id': id, 'result': 2, 'desc': 'id unknown'}
+    details = jobStages.get(id, {})
+    if future.running():
+        return dict(details, id=id, result=1, desc='running')
+    elif future.cancelled():
+        return dict(details, id=id, result=3, desc='cancelled')
+    elif future.done():
+        return dict(details, id=id, result=0, desc='done')
+    else:
+        return dict(details, id=id, result=-1, desc='not started yet')
+
+
+def forget_finished(status):
+    # Finished uploads are only reported once
+    if status['result'] == 0:
+        with jobChanged:
+            dictUsers.pop(status['id'], None)
+            jobStages.pop(status['id'], None)
+    return status
+
+
+def is_result_changed(status, since):
+    return status['result'] in FINAL_RESULTS or status.get('updated_at') != since
+
+
+def wait_for_result_change(id, since, timeout):
+    '''
+    State of an upload once it changed from the version "since", it finished or the timeout passed. Without
+    "since" the state is returned on its next change. If all waiter slots are taken it is returned right away.
+    '''
+    if not resultWaiters.acquire(blocking=False):
+        return result_status(id)
+    try:
+        with jobChanged:
+            if since is None:
+                since = result_status(id).get('updated_at')
+            jobChanged.wait_for(lambda: is_result_changed(result_status(id), since), timeout)
+            return result_status(id)
+    finally:
+        resultWaiters.release()
+
+
+@bp.route("/get-result/<id>", methods=['GET'])
 def getResult(id):
     '''
-    Get the Result from an S3 upload
+    Get the Result from an S3 upload. With ?wait=seconds the request is held until the state changed from the
+    version ?since= (the "updated_at" of the last reply) instead of being polled.
     :param id: uuid of current task
     :return: JSON of the current state
     '''
-    if id not in dictUsers:
-        return json.dumps({'id': id, 'result': 2, 'desc': 'id unknown'})
-    if dictUsers[id].running():
-        return json.dumps({'id': id, 'result': 1, 'desc': 'running'})
-    elif dictUsers[id].cancelled():
-        return json.dumps({'id': id, 'result': 3, 'desc': 'cancelled'})
-    elif dictUsers[id].done():
-        del (dictUsers[id])
-        return json.dumps({'id': id, 'result': 0, 'desc': 'done'})
-    else:
-        return json.dumps({'id': id, 'result': -1, 'desc': 'not started yet'})
+    try:
+        wait = min(float(request.args.get('wait', 0)), RESULT_WAIT_MAX_SECONDS)
+        since = float(request.args['since']) if 'since' in request.args else None
+    except ValueError:
+        return 'wait and since must be numbers', 400
+    status = wait_for_result_change(id, since, wait) if wait > 0 else result_status(id)
+    return json.dumps(forget_finished(status))
+
+
+@bp.route("/result-events/<id>", methods=['GET'])
+def resultEvents(id):
+    '''
+    Server-Sent Events stream of an upload: a "status" event with the /get-result reply on every change, until
+    the upload finished or RESULT_STREAM_MAX_SECONDS passed
+    '''
+    if not resultWaiters.acquire(blocking=False):
+        return 'Too many waiting requests', 503, {'Retry-After': '1'}
+
+    def stream():
+        deadline = time.monotonic() + RESULT_STREAM_MAX_SECONDS
+        status = result_status(id)
+        yield f"event: status\ndata: {json.dumps(forget_finished(status))}\n\n"
+        while status['result'] not in FINAL_RESULTS and time.monotonic() < deadline:
+            since = status.get('updated_at')
+            # The condition is released before yielding, a slow client must not block report_stage
+            with jobChanged:
+                changed = jobChanged.wait_for(lambda: is_result_changed(result_status(id), since),
+                                              RESULT_STREAM_HEARTBEAT_SECONDS)
+                status = result_status(id)
+            if changed:
+                yield f"event: status\ndata: {json.dumps(forget_finished(status))}\n\n"
+            else:
+                yield ': keep-alive\n\n'
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The server closes the response when the stream ended or the client went away
+    response.call_on_close(resultWaiters.release)
+    return response
+
+def invalidate_part_caches():
+    '''
+    New part documents are in MongoDB, make the indexer service drop the ones it cached
+    '''
+    if redis_client is None:
+        print('REDIS_URL not set, cached part documents of the indexer expire with their TTL')
+        return
+    try:
+        redis_client.incr(PART_CACHE_GENERATION_NAME)
+    except Exception as error:
+        print(f'Error invalidating the part cache: {error}')
 
 # TODO: Add additional functions that either only upload the images or the presets or the DB entries, if something needs
 # to updated
 def process_file(filename, additionalInfo, fileId):
     # Perform your long-running file processing task here
-    destPath = fileOperations.decrypt_file(filename, fileId)
-    additionalInfo = json.loads(additionalInfo)
-    additionalInfo['uuid'] = fileId
-    print('-2')
-    if destPath:
-        destZipPath = fileOperations.unzip_file(destPath)
-        print('-1')
-        if destZipPath:
-            jsonFiles = [obj for obj in os.listdir(destZipPath) if obj.endswith('.json')]
-            jsonPath = os.path.join(destZipPath, jsonFiles[0])
-            print(jsonPath)
-            additionalInfo['parent_package_name'] = os.path.basename(destZipPath)
-            print('0')
-            dictPresets = fileOperations.addJsonToMongo(jsonPath, additionalInfo, mongoClient, DB_NAME, COLLECTION_NAME)
-            print('1')
-
-            # GCS Bucket and Blob setup
-            bucket = os.environ['GOOGLE_CLOUD_BUCKET_ID']
-            storage_client = storage.Client()
-            bucket = storage_client.bucket(bucket)
-
-            print('2')
-            fileOperations.uploadFileType(destZipPath, 'img', bucket, storage_client, fileId)
-            print('3')
-            fileOperations.uploadFileType(destZipPath, 'preset', bucket, storage_client, fileId, dictPresets)
-            print('4')
-            generateFeatureMapCreationTask(gcs_bucket_name, fileId)
-            print('5')
+    # Every step is timed as a stage of the "upload" pipeline, see /metrics
+    stages = metrics.StageTimer('upload')
+
+    def enter(stage):
+        stages.enter(stage)
+        report_stage(fileId, stage, UPLOAD_STAGE_PROGRESS[stage])
+
+    try:
+        enter('decrypt')
+        destPath = fileOperations.decrypt_file(filename, fileId)
+        additionalInfo = json.loads(additionalInfo)
+        additionalInfo['uuid'] = fileId
+        if destPath:
+            enter('unzip')
+            destZipPath = fileOperations.unzip_file(destPath)
+            if destZipPath:
+                jsonFiles = [obj for obj in os.listdir(destZipPath) if obj.endswith('.json')]
+                jsonPath = os.path.join(destZipPath, jsonFiles[0])
+                print(jsonPath)
+                additionalInfo['parent_package_name'] = os.path.basename(destZipPath)
+                enter('mongo_insert')
+                dictPresets = fileOperations.addJsonToMongo(jsonPath, additionalInfo, mongoClient, DB_NAME, COLLECTION_NAME)
+                invalidate_part_caches()
+
+                # GCS Bucket and Blob setup
+                bucket = os.environ['GOOGLE_CLOUD_BUCKET_ID']
+                storage_client = storage.Client()
+                bucket = storage_client.bucket(bucket)
+
+                enter('image_upload')
+                fileOperations.uploadFileType(destZipPath, 'img', bucket, storage_client, fileId)
+                enter('preset_upload')
+                fileOperations.uploadFileType(destZipPath, 'preset', bucket, storage_client, fileId, dictPresets)
+                enter('feature_maps')
+                generateFeatureMapCreationTask(gcs_bucket_name, fileId)
+                stages.finish()
+            else:
+                stages.fail()
+                print('Path not valid')
         else:
+            stages.fail()
             print('Path not valid')
-    else:
-        print('Path not valid')
-
-    shutil.rmtree('static/upload/' + fileId)
+    except Exception:
+        stages.fail()
+        raise
+    finally:
+        shutil.rmtree('static/upload/' + fileId)
 
-@application.route('/uploadFile', methods=['POST'])
+@bp.route('/uploadFile', methods=['POST'])
 def upload_file():
     file = request.files['file']
     data = request.form.get('json_data')
@@ -231,6 +412,7 @@ def upload_file():
     file.save(filePath)
 
     dictUsers[fileId] = threadExecutor.submit(process_file, filePath, data, fileId)
+    dictUsers[fileId].add_done_callback(lambda future: upload_finished(fileId, future))
     session = _checkDBSession(mongoClient)
     if not session:
         mongoReplace(fileId, 'Error getting the Feature Map MS DB.')
@@ -244,15 +426,49 @@ def upload_file():
     #return 'File uploaded successfully.'
 
 # Create an endpoint to check the processing status
-@application.route('/status', methods=['GET'])
+@bp.route('/status', methods=['GET'])
 def check_status():
     global processing_complete
     return 'Processing complete' if processing_complete else 'Processing in progress'
 
 
-@ application.route("/", methods=['GET'])
+@bp.route("/", methods=['GET'])
 def index():
     return 'Running'
 
+@bp.route("/metrics", methods=['GET'])
+def metricsEndpoint():
+    '''
+    Stage timings, failures, GCS bytes and processed images in the Prometheus text format
+    '''
+    return metrics.metrics_response()
+
+@bp.route("/ready", methods=['GET'])
+def ready():
+    '''
+    Readiness probe: 200 once the clients and the model exist, 503 while they are still being created
+    '''
+    isReady, states = readiness(LAZY_RESOURCES)
+    if not isReady:
+        warm_in_background(LAZY_RESOURCES)
+    return jsonify({'ready': isReady, 'resources': states}), 200 if isReady else 503
+
+
+def create_app():
+    '''
+    Application factory. Clients and the model are created lazily on first use; EAGER_INIT=1 creates them
+    right away, WARM_ON_START=1 creates them in a background thread after startup.
+    '''
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    if EAGER_INIT:
+        warm(LAZY_RESOURCES)
+    elif WARM_ON_START:
+        warm_in_background(LAZY_RESOURCES)
+    return app
+
+
+application = create_app()
+
 if __name__ == '__main__':
     application.run(debug=True, threaded=True)
@@ -8,20 +8,49 @@ from tqdm import tqdm
 import numpy
 import os
 import io
+from concurrent.futures import ThreadPoolExecutor
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 tf.config.set_visible_devices([], 'GPU')
 
+# Images run through the model at once
+FEATURE_BATCH_SIZE = int(os.getenv("FEATURE_BATCH_SIZE", 32))
+# Threads decoding and resizing images, PIL releases the GIL while it decodes
+FEATURE_DECODE_WORKERS = int(os.getenv("FEATURE_DECODE_WORKERS", os.cpu_count() or 4))
+INPUT_SIZE = (224, 224)
+
+
+def load_image(source, isBytes=False):
+    '''
+    Decode and resize an image to the model input
+    :param source: Path or bytes of the image
+    :return: float32 array (224, 224, 3), None if the image can not be decoded
+    '''
+    try:
+        img = Image.open(io.BytesIO(source) if isBytes else source)
+        # Resize the image and convert the image color space
+        img = img.resize(INPUT_SIZE).convert('RGB')
+        return numpy.asarray(img, dtype=numpy.float32)
+    except Exception:
+        return None
+
 class Index:
 
     sqlEngine = None
 
-    def __init__(self):
+    def __init__(self, threads=None):
         # self.metaData = MetaData()
-        self.FE = FeatureExtractor()
+        self.FE = FeatureExtractor(threads)
 
     def extract_single_feature(self, imgPath, isBytes):
         return self.FE.get_single_feature(imgPath, isBytes)
 
+    def extract_features(self, images, isBytes):
+        '''
+        Batched extract_single_feature, images that can not be decoded get an empty array
+        '''
+        return [numpy.array([]) if feature is None else feature
+                for feature in self.FE.extract_many(images, isBytes)]
+
     # Bulk extraction function
     def start_feature_extraction(self, analysisFolder, ifExists):
         jsonNew = []
@@ -40,46 +69,72 @@ class Index:
 
 
 class FeatureExtractor:
-    def __init__(self):
+    def __init__(self, threads=None):
+        '''
+        :param threads: Threads of TensorFlow and the decode pool, e.g. the share of the cores of an inference
+                        worker (see inferencePool.py). Only takes effect before TensorFlow ran anything.
+        '''
+        if threads:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+            tf.config.threading.set_inter_op_parallelism_threads(min(threads, 2))
         # Use VGG-16 as the architecture and ImageNet for the weight
         base_model = VGG16(weights='imagenet')
         # Customize the model to return features from fully-connected layer
         self.model = Model(inputs=base_model.input,
                            outputs=base_model.get_layer('fc1').output)
+        # Call the model directly instead of predict, which sets up a data pipeline on every call. Traced once
+        # for any batch size.
+        self._forward = tf.function(lambda x: self.model(x, training=False),
+                                    input_signature=[tf.TensorSpec([None, INPUT_SIZE[0], INPUT_SIZE[1], 3], tf.float32)])
+        self.decodePool = ThreadPoolExecutor(threads or FEATURE_DECODE_WORKERS)
+
+    def extract_batch(self, images):
+        '''
+        Features of a batch of decoded images
+        :param images: float32 array (B, 224, 224, 3)
+        :return: float32 array (B, 4096), every row L2 normalised
+        '''
+        x = preprocess_input(images)
+        features = self._forward(tf.constant(x)).numpy()
+        return features / numpy.linalg.norm(features, axis=1, keepdims=True)
 
     def extract(self, img):
-        # Resize the image
-        img = img.resize((224, 224))
-        # Convert the image color space
-        img = img.convert('RGB')
-        # Reformat the image
-        x = image.img_to_array(img)
-        x = numpy.expand_dims(x, axis=0)
-        x = preprocess_input(x)
-        # Extract Features
-        feature = self.model.predict(x)[0]
-        return feature / numpy.linalg.norm(feature)
+        # Resize the image, convert the image color space and reformat it
+        x = image.img_to_array(img.resize(INPUT_SIZE).convert('RGB'))
+        return self.extract_batch(numpy.expand_dims(x, axis=0))[0]
+
+    def extract_many(self, sources, isBytes=False, batchSize=FEATURE_BATCH_SIZE, progress=None):
+        '''
+        Features of many images: images are decoded in the decode pool, the next batch while the model runs
+        on the current one, and run through the model batchSize at a time
+        :param sources: Paths or bytes of the images
+        :param progress: Optional function(number of images done)
+        :return: List with the feature of every image, None for images that can not be decoded
+        '''
+        features = [None] * len(sources)
+        batches = [range(start, min(start + batchSize, len(sources))) for start in range(0, len(sources), batchSize)]
+        pending = self._decode(sources, batches[0], isBytes) if batches else []
+        for idx, batch in enumerate(batches):
+            images = [future.result() for future in pending]
+            if idx + 1 < len(batches):
+                pending = self._decode(sources, batches[idx + 1], isBytes)
+            decoded = [(item, img) for item, img in zip(batch, images) if img is not None]
+            if decoded:
+                batchFeatures = self.extract_batch(numpy.stack([img for _, img in decoded]))
+                for (item, _), feature in zip(decoded, batchFeatures):
+                    features[item] = feature
+            if progress:
+                progress(len(batch))
+        return features
+
+    def _decode(self, sources, batch, isBytes):
+        return [self.decodePool.submit(load_image, sources[item], isBytes) for item in batch]
 
     def get_single_feature(self, image_data, isBytes=False):
-        try:
-            if isBytes:
-                feature = self.extract(img=Image.open(io.BytesIO(image_data)))
-            else:
-                feature = self.extract(img=Image.open(image_data))
-            return feature
-        except:
-            return numpy.array([])
+        feature = self.extract_many([image_data], isBytes)[0]
+        return numpy.array([]) if feature is None else feature
 
     def get_feature(self, image_data: list):
-        self.image_data = image_data
-        # fe = FeatureExtractor()
-        features = []
-        for img_path in tqdm(self.image_data):  # Iterate through images
-            # Extract Features
-            try:
-                feature = self.extract(img=Image.open(img_path))
-                features.append(feature)
-            except:
-                features.append(None)
-                continue
-        return features
+        self.image_data = list(image_data)
+        with tqdm(total=len(self.image_data)) as pbar:  # Iterate through images
+            return self.extract_many(self.image_data, progress=pbar.update)
@@ -6,6 +6,7 @@ import uuid
 import hashlib
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
+import metrics
 
 def decrypt_file(file_path, fileId):
     # Construct the command
@@ -150,6 +151,7 @@ def uploadFileType(destZipPath, fileType, bucket, gcs_client, fileId, dictPreset
 
     except Exception as e:
          # Handle any unexpected errors at the higher level
+        metrics.count_failure('upload', fileType + '_upload')
         print(f"Unexpected error in uploadFileType: {e}")
 
     #for obj in os.listdir(os.path.join(destZipPath, fileType)):
@@ -205,5 +207,7 @@ def putInGCS(args):
             bucket = gcs_client.get_bucket(bucket)
             blob = bucket.blob(path)
             blob.upload_from_file(ffile)
+        metrics.count_gcs_bytes('out', os.path.getsize(file_path))
+        metrics.count_items('upload', folder.rstrip('/') + '_uploaded')
 
         #return path, None
\ No newline at end of file
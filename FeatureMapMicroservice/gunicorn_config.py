@@ -0,0 +1,20 @@
+# Gunicorn config variables
+loglevel = "info"
+errorlog = "-"  # stderr
+accesslog = "-"  # stdout
+worker_tmp_dir = "/dev/shm"
+graceful_timeout = 120
+timeout = 120
+keepalive = 5
+threads = 2
+bind = "0.0.0.0:8000"
+
+def on_starting(server):
+    # Samples of the previous run must not be summed up into /metrics
+    import metrics
+    metrics.prepare_multiprocess_dir()
+
+def child_exit(server, worker):
+    # Drop the live gauges of an exited worker from /metrics
+    import metrics
+    metrics.mark_process_dead(worker.pid)
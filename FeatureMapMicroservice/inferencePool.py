@@ -0,0 +1,157 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Memory of one inference worker: the VGG16 weights (about 530 MB), TensorFlow and the activations of a batch
+INFERENCE_WORKER_MEMORY_BYTES = int(os.getenv("INFERENCE_WORKER_MEMORY_BYTES", 1536 * 1024 * 1024))
+# Share of the physical memory all inference workers of the node together may take
+INFERENCE_MEMORY_SHARE = float(os.getenv("INFERENCE_MEMORY_SHARE", 0.6))
+# Service processes of the node (gunicorn workers), each starts a pool of its own
+SERVICE_PROCESSES = int(os.getenv("WEB_CONCURRENCY", 1))
+# Longest time every worker may take to load its model when the pool starts
+INFERENCE_LOAD_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_LOAD_TIMEOUT_SECONDS", 600))
+
+# Feature extractor of a worker process and the barrier of its pool, set by the initializer
+_index = None
+_loadedBarrier = None
+
+
+def node_worker_count():
+    '''
+    Inference workers of the whole node: one per core as long as they fit into INFERENCE_MEMORY_SHARE
+    of the physical memory, at least one
+    '''
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * INFERENCE_MEMORY_SHARE
+    except (ValueError, OSError, AttributeError):
+        return 1
+    return max(1, min(os.cpu_count() or 1, int(memory // INFERENCE_WORKER_MEMORY_BYTES)))
+
+
+def default_worker_count():
+    '''
+    INFERENCE_WORKERS if set, otherwise the share of this service process of the workers of the node
+    '''
+    configured = os.getenv("INFERENCE_WORKERS")
+    if configured:
+        return max(1, int(configured))
+    return max(1, node_worker_count() // max(1, SERVICE_PROCESSES))
+
+
+def _init_worker(threads, loadedBarrier):
+    '''
+    Runs once in every worker process. TensorFlow is not fork safe once its runtime started, so the parent
+    never imports it and every worker loads the model itself; the weights file is read from the page cache.
+    '''
+    global _index, _loadedBarrier
+    from featureMap import Index
+    _index = Index(threads)
+    _loadedBarrier = loadedBarrier
+
+
+def _loaded():
+    '''
+    Warm-up task: a worker runs one task at a time, so all of them only pass the barrier once every worker
+    has loaded its model and taken one of these tasks
+    '''
+    _loadedBarrier.wait(INFERENCE_LOAD_TIMEOUT_SECONDS)
+    return os.getpid()
+
+
+def _extract(images, isBytes):
+    return _index.extract_features(images, isBytes)
+
+
+class InferencePool:
+    '''
+    Fixed number of worker processes, each holding one VGG16 feature extractor loaded once. Packages of images
+    are sent to a free worker and their features come back, so the model is never loaded per package and the
+    memory of the service is bounded by the worker count. Offers the extraction methods of featureMap.Index.
+    '''
+
+    def __init__(self, workers=None):
+        self.workers = workers or default_worker_count()
+        # The cores of the node are split between the workers of all service processes instead of every
+        # TensorFlow runtime using all of them
+        self.threads = max(1, (os.cpu_count() or 1) // (self.workers * max(1, SERVICE_PROCESSES)))
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.executor = self._start()
+
+    def _start(self):
+        context = multiprocessing.get_context('fork')
+        loadedBarrier = context.Barrier(self.workers)
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                       initializer=_init_worker, initargs=(self.threads, loadedBarrier))
+        futures = []
+        try:
+            # Every worker loads its model now instead of while the first packages wait
+            futures = [executor.submit(_loaded) for _ in range(self.workers)]
+            pids = {future.result() for future in futures}
+            if len(pids) != self.workers:
+                raise RuntimeError(f'Only {len(pids)} of {self.workers} inference workers loaded their model')
+        except BaseException:
+            # The pool is created again on the next request, workers left running here would each keep a model
+            loadedBarrier.abort()
+            self._cancel(futures)
+            executor.shutdown(wait=False)
+            raise
+        print(f'Inference pool of {self.workers} workers with {self.threads} threads each')
+        return executor
+
+    def _submit(self, executor, *args):
+        future = executor.submit(*args)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _cancel_pending(self):
+        with self._lock:
+            pending = list(self._pending)
+        self._cancel(pending)
+
+    @staticmethod
+    def _cancel(futures):
+        # shutdown(cancel_futures=True) needs Python 3.9, the services run on 3.8
+        for future in futures:
+            future.cancel()
+
+    def _restart(self, broken):
+        with self._lock:
+            # Another thread may have restarted the pool already
+            if self.executor is not broken:
+                return
+        self._cancel_pending()
+        broken.shutdown(wait=False)
+        with self._lock:
+            if self.executor is broken:
+                self.executor = self._start()
+
+    def extract_features(self, images, isBytes):
+        '''
+        Features of a package of images, see featureMap.Index.extract_features. A pool broken by a killed
+        worker (e.g. out of memory) is restarted and the package sent once more.
+        '''
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                return self._submit(executor, _extract, images, isBytes).result()
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+                print('Inference pool broken, restarting it')
+                self._restart(executor)
+
+    def extract_single_feature(self, image, isBytes):
+        return self.extract_features([image], isBytes)[0]
+
+    def shutdown(self):
+        self._cancel_pending()
+        self.executor.shutdown(wait=True)
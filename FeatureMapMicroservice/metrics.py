@@ -0,0 +1,118 @@
+import os
+import time
+import shutil
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess
+
+# With several gunicorn workers or build processes every process writes its samples into this folder and
+# /metrics sums them up. Must be set in the environment before the service starts and emptied on every start.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Stages take from milliseconds (one inference) to hours (a large index build)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float('inf'))
+
+STAGE_SECONDS = Histogram('stage_duration_seconds', 'Duration of the stages of a pipeline',
+                          ['pipeline', 'stage'], buckets=STAGE_BUCKETS)
+STAGE_FAILURES = Counter('stage_failures', 'Stages of a pipeline that failed', ['pipeline', 'stage'])
+STAGES_IN_FLIGHT = Gauge('stages_in_flight', 'Stages of a pipeline running right now', ['pipeline', 'stage'],
+                         multiprocess_mode='livesum')
+GCS_BYTES = Counter('gcs_bytes', 'Bytes downloaded from (in) and uploaded to (out) GCS', ['direction'])
+ITEMS_PROCESSED = Counter('items_processed', 'Items processed by a pipeline, rate() gives items per second',
+                          ['pipeline', 'item'])
+
+
+@contextmanager
+def timed(pipeline, stage):
+    '''
+    Time a block as stage of a pipeline. Exceptions leaving the block count as failure of the stage.
+    '''
+    STAGES_IN_FLIGHT.labels(pipeline, stage).inc()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_FAILURES.labels(pipeline, stage).inc()
+        raise
+    finally:
+        STAGES_IN_FLIGHT.labels(pipeline, stage).dec()
+        STAGE_SECONDS.labels(pipeline, stage).observe(time.perf_counter() - start)
+
+
+class StageTimer:
+    '''
+    Times the consecutive stages of one run of a pipeline: entering a stage ends the previous one
+    '''
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.stage = None
+        self.start = None
+
+    def enter(self, stage):
+        if stage == self.stage:
+            return
+        self.finish()
+        self.stage = stage
+        self.start = time.perf_counter()
+        STAGES_IN_FLIGHT.labels(self.pipeline, stage).inc()
+
+    def finish(self):
+        if self.stage is None:
+            return
+        STAGES_IN_FLIGHT.labels(self.pipeline, self.stage).dec()
+        STAGE_SECONDS.labels(self.pipeline, self.stage).observe(time.perf_counter() - self.start)
+        self.stage = None
+
+    def fail(self):
+        '''
+        End the current stage and count it as failed
+        '''
+        if self.stage is not None:
+            STAGE_FAILURES.labels(self.pipeline, self.stage).inc()
+        self.finish()
+
+
+def count_failure(pipeline, stage):
+    STAGE_FAILURES.labels(pipeline, stage).inc()
+
+
+def count_gcs_bytes(direction, count):
+    '''
+    :param direction: "in" for downloads, "out" for uploads
+    '''
+    GCS_BYTES.labels(direction).inc(count)
+
+
+def count_items(pipeline, item, count=1):
+    ITEMS_PROCESSED.labels(pipeline, item).inc(count)
+
+
+def metrics_response():
+    '''
+    :return: Flask response with all metrics in the Prometheus text format
+    '''
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
+def prepare_multiprocess_dir():
+    '''
+    Empty PROMETHEUS_MULTIPROC_DIR before any worker starts, samples of an earlier run would be summed up
+    otherwise. Called from the gunicorn on_starting hook.
+    '''
+    if PROMETHEUS_MULTIPROC_DIR:
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR)
+
+
+def mark_process_dead(pid):
+    '''
+    Drop the live gauges of an exited process, called from the gunicorn child_exit hook
+    '''
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
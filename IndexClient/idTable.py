@@ -0,0 +1,99 @@
+import os
+import struct
+import functools
+
+# Names per independently encrypted chunk of an id table
+ID_TABLE_CHUNK_SIZE = int(os.getenv("ID_TABLE_CHUNK_SIZE", 1024))
+# Decrypted chunks an open id table keeps
+ID_TABLE_CACHE_CHUNKS = int(os.getenv("ID_TABLE_CACHE_CHUNKS", 64))
+
+ID_TABLE_FILE_SUFFIX = "_ids.bin"
+
+MAGIC = b'SIDT'
+VERSION = 1
+# Magic, version, reserved, name count, names per chunk, chunk count
+HEADER = struct.Struct('<4sHHIII')
+# Offset of the encrypted chunk in the file, its length
+CHUNK_ENTRY = struct.Struct('<QI')
+
+
+def encode_chunk(names):
+    '''
+    Plain chunk: name count, count + 1 offsets into the name bytes, the UTF-8 names back to back
+    '''
+    encoded = [name.encode('utf-8') for name in names]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    return struct.pack(f'<I{len(offsets)}I', len(encoded), *offsets) + b''.join(encoded)
+
+
+def decode_chunk(data):
+    count = struct.unpack_from('<I', data)[0]
+    offsets = struct.unpack_from(f'<{count + 1}I', data, 4)
+    start = 4 * (count + 2)
+    return [data[start + offsets[i]:start + offsets[i + 1]].decode('utf-8') for i in range(count)]
+
+
+def write_id_table(path, names, cipher, chunkSize=ID_TABLE_CHUNK_SIZE):
+    '''
+    Write the id -> name table of an index, name i is item id i. Every chunk of chunkSize names is a Fernet
+    token of its own, so a reader only decrypts the chunks of the ids it looks up. Chunks are encrypted and
+    written one after the other, only one is held in memory.
+    :param cipher: Fernet handler of the encryption key
+    :return: Description for _info.json
+    '''
+    count = len(names)
+    chunkCount = -(-count // chunkSize)
+    entries = []
+    with open(path, 'wb') as outfile:
+        outfile.write(HEADER.pack(MAGIC, VERSION, 0, count, chunkSize, chunkCount))
+        # The chunk index is filled in once the sizes of the tokens are known
+        outfile.write(b'\0' * CHUNK_ENTRY.size * chunkCount)
+        for start in range(0, count, chunkSize):
+            token = cipher.encrypt(encode_chunk(names[start:start + chunkSize]))
+            entries.append(CHUNK_ENTRY.pack(outfile.tell(), len(token)))
+            outfile.write(token)
+        outfile.seek(HEADER.size)
+        outfile.write(b''.join(entries))
+    return {'file': os.path.basename(path), 'count': count, 'chunk_size': chunkSize, 'format': VERSION}
+
+
+class IdTable:
+    '''
+    Random access to the names of an id table, decrypting chunks on first use
+    '''
+
+    def __init__(self, path, cipher):
+        self.path = path
+        self.cipher = cipher
+        with open(path, 'rb') as infile:
+            magic, version, _, self.count, self.chunkSize, chunkCount = HEADER.unpack(infile.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{path} is no id table of version {VERSION}')
+            index = infile.read(CHUNK_ENTRY.size * chunkCount)
+        self.entries = [CHUNK_ENTRY.unpack_from(index, i * CHUNK_ENTRY.size) for i in range(chunkCount)]
+        self._chunk = functools.lru_cache(maxsize=ID_TABLE_CACHE_CHUNKS)(self._read_chunk)
+
+    def __len__(self):
+        return self.count
+
+    def _read_chunk(self, chunk):
+        offset, length = self.entries[chunk]
+        with open(self.path, 'rb') as infile:
+            infile.seek(offset)
+            return decode_chunk(self.cipher.decrypt(infile.read(length)))
+
+    def name(self, item_id):
+        if not 0 <= item_id < self.count:
+            raise IndexError(f'Item id {item_id} out of range')
+        return self._chunk(item_id // self.chunkSize)[item_id % self.chunkSize]
+
+    def names(self, item_ids):
+        return [self.name(item_id) for item_id in item_ids]
+
+    def all_names(self):
+        names = []
+        for chunk in range(len(self.entries)):
+            names.extend(self._read_chunk(chunk))
+        return names
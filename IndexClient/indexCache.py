@@ -0,0 +1,113 @@
+import os
+import json
+import shutil
+import time
+
+CURRENT_FILE_NAME = 'current.json'
+PARTIAL_FILE_NAME = 'download.part'
+PARTIAL_META_NAME = 'download.json'
+PART_METADATA_FILE_NAME = 'parts.json'
+
+
+class IndexCache:
+    '''
+    Versioned local cache of index archives. Every vendor/category has a folder with one extracted folder per
+    archive generation and current.json naming the generation (and ETag) in use. A new version is extracted
+    next to the current one and only becomes current once it is complete, so readers never see half an index.
+    '''
+
+    def __init__(self, rootPath, keepVersions=1):
+        self.rootPath = rootPath
+        self.keepVersions = max(1, keepVersions)
+
+    def folder(self, identifier):
+        return os.path.join(self.rootPath, identifier)
+
+    def version_path(self, identifier, generation):
+        return os.path.join(self.folder(identifier), f'g{generation}')
+
+    def _read_json(self, path):
+        try:
+            with open(path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_json(self, path, value):
+        # Written to a temporary file and renamed, a crash leaves the old or the new content
+        with open(path + '.tmp', 'w') as outfile:
+            json.dump(value, outfile)
+        os.replace(path + '.tmp', path)
+
+    def current(self, identifier):
+        '''
+        :return: {"generation", "etag", "path", "fetched_at"} of the version in use, None if there is none
+        '''
+        current = self._read_json(os.path.join(self.folder(identifier), CURRENT_FILE_NAME))
+        if current is None or not os.path.isdir(current.get('path', '')):
+            return None
+        return current
+
+    def is_current(self, identifier, generation):
+        current = self.current(identifier)
+        return current is not None and generation is not None and str(current['generation']) == str(generation)
+
+    def partial(self, identifier):
+        '''
+        :return: (path of the partial download, its meta {"generation", "etag"} or None)
+        '''
+        folder = self.folder(identifier)
+        os.makedirs(folder, exist_ok=True)
+        partPath = os.path.join(folder, PARTIAL_FILE_NAME)
+        meta = self._read_json(os.path.join(folder, PARTIAL_META_NAME))
+        if meta is None or not os.path.exists(partPath):
+            return partPath, None
+        return partPath, meta
+
+    def start_partial(self, identifier, generation, etag):
+        folder = self.folder(identifier)
+        os.makedirs(folder, exist_ok=True)
+        self._write_json(os.path.join(folder, PARTIAL_META_NAME), {'generation': generation, 'etag': etag})
+        return open(os.path.join(folder, PARTIAL_FILE_NAME), 'wb')
+
+    def part_metadata(self, identifier):
+        '''
+        :return: {"etag", "parts", "fetched_at"} of the cached part documents, None if there are none
+        '''
+        return self._read_json(os.path.join(self.folder(identifier), PART_METADATA_FILE_NAME))
+
+    def store_part_metadata(self, identifier, etag, parts):
+        folder = self.folder(identifier)
+        os.makedirs(folder, exist_ok=True)
+        self._write_json(os.path.join(folder, PART_METADATA_FILE_NAME),
+                         {'etag': etag, 'parts': parts, 'fetched_at': time.time()})
+
+    def staging_path(self, identifier, generation):
+        path = self.version_path(identifier, generation) + '.tmp'
+        shutil.rmtree(path, ignore_errors=True)
+        return path
+
+    def commit(self, identifier, generation, etag, stagingPath):
+        '''
+        Make an extracted version current and drop the partial download and older versions
+        :return: Path of the version
+        '''
+        folder = self.folder(identifier)
+        path = self.version_path(identifier, generation)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(stagingPath, path)
+        self._write_json(os.path.join(folder, CURRENT_FILE_NAME),
+                         {'generation': generation, 'etag': etag, 'path': path, 'fetched_at': time.time()})
+        for name in (PARTIAL_FILE_NAME, PARTIAL_META_NAME):
+            if os.path.exists(os.path.join(folder, name)):
+                os.remove(os.path.join(folder, name))
+        self._prune(identifier, path)
+        return path
+
+    def _prune(self, identifier, currentPath):
+        folder = self.folder(identifier)
+        versions = [os.path.join(folder, name) for name in os.listdir(folder)
+                    if name.startswith('g') and not name.endswith('.tmp') and os.path.isdir(os.path.join(folder, name))]
+        versions = sorted((path for path in versions if path != currentPath), key=os.path.getmtime, reverse=True)
+        for path in versions[self.keepVersions - 1:]:
+            shutil.rmtree(path, ignore_errors=True)
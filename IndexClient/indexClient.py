@@ -0,0 +1,244 @@
+import os
+import time
+import random
+import zipfile
+import requests
+from indexCache import IndexCache
+from streamingZip import StreamingZipExtractor, StreamingNotSupported
+
+SERVER_URI = os.getenv("INDEX_SERVER_URI", "http://127.0.0.1:5000")
+INDEX_CACHE_PATH = os.getenv("INDEX_CACHE_PATH", os.path.join(os.path.expanduser('~'), '.solid_index_cache'))
+# Bytes read from the network (and the partial file) at once, a read cut off by a dropped connection is lost
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Attempts of a download, every retry resumes where the last one stopped
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_BACKOFF_SECONDS = 0.5
+REQUEST_TIMEOUT_SECONDS = 60
+# Status requests are long-polls held by the server until the job changed or this many seconds passed
+LONG_POLL_SECONDS = 25
+# Servers without long-polls (or without a free waiter slot) answer right away, the status is then polled
+# fast at first and slower while a build makes no progress
+POLL_MIN_SECONDS = 0.25
+POLL_MAX_SECONDS = 5.0
+JOB_TIMEOUT_SECONDS = 3 * 3600
+
+
+class IndexClientError(Exception):
+    pass
+
+
+class IndexClient:
+    '''
+    Client of the indexer: starts index builds, waits for them and keeps their archives in a versioned local
+    cache. An archive is only downloaded if its GCS generation (or ETag) changed, interrupted downloads resume
+    with HTTP Range requests, and archives are extracted while they are downloaded.
+    '''
+
+    def __init__(self, serverUri=SERVER_URI, cachePath=INDEX_CACHE_PATH, keepVersions=1, session=None):
+        self.serverUri = serverUri.rstrip('/')
+        self.cache = IndexCache(cachePath, keepVersions)
+        # One session, so polls and downloads reuse their connections
+        self.session = session or requests.Session()
+
+    def request_build(self, vendor, category):
+        '''
+        Start the build of a vendor/category, or join the one already running
+        :return: Job id
+        '''
+        r = self.session.get(f'{self.serverUri}/annoy-indexer-setup/{vendor}/{category}', timeout=REQUEST_TIMEOUT_SECONDS)
+        r.raise_for_status()
+        jobId = r.json().get('id')
+        if jobId is None:
+            raise IndexClientError('Could not get a valid task id from the server')
+        return jobId
+
+    def job_status(self, jobId, wait=0, since=None):
+        '''
+        :param wait: Seconds the server may hold the request until the job changed from the version "since"
+        :param since: "updated_at" of the last status
+        '''
+        params = {'wait': wait, 'since': since} if wait else {}
+        r = self.session.get(f'{self.serverUri}/get-annoy-indexer/{jobId}', params=params,
+                             timeout=REQUEST_TIMEOUT_SECONDS + wait)
+        r.raise_for_status()
+        return r.json()
+
+    def wait_for_job(self, jobId, timeout=JOB_TIMEOUT_SECONDS, progress=None):
+        '''
+        Wait until a job is done. Every status request is a long-poll answered when the job changed. If the server
+        answered right away without a change the status is polled with a doubling delay (up to POLL_MAX_SECONDS).
+        :param progress: Optional function(status dict) called with every status
+        :return: Status of the finished job with "fileUrl" and "generation"
+        '''
+        deadline = time.monotonic() + timeout
+        delay = POLL_MIN_SECONDS
+        lastProgress = None
+        since = None
+        while True:
+            wait = max(0, min(LONG_POLL_SECONDS, int(deadline - time.monotonic())))
+            started = time.monotonic()
+            status = self.job_status(jobId, wait, since)
+            since = status.get('updated_at')
+            result = status.get('result')
+            if result == 'done':
+                return status
+            if result not in ('running', 'not started yet'):
+                raise IndexClientError(f"Job {jobId} {result}: {status.get('error', '')}")
+            if progress:
+                progress(status)
+            current = (status.get('stage'), status.get('progress'))
+            if current != lastProgress:
+                delay = POLL_MIN_SECONDS
+            elif time.monotonic() - started < wait / 2:
+                delay = min(POLL_MAX_SECONDS, delay * 2)
+            else:
+                # The server held the request, ask again right away
+                delay = 0
+            lastProgress = current
+            if time.monotonic() + delay > deadline:
+                raise IndexClientError(f'Job {jobId} did not finish within {timeout} seconds')
+            time.sleep(delay)
+
+    def fetch_index(self, vendor, category, timeout=JOB_TIMEOUT_SECONDS, progress=None, downloadProgress=None):
+        '''
+        Build (if needed) and download the index of a vendor/category
+        :param downloadProgress: Optional function(bytes done, bytes total)
+        :return: Folder of the extracted archive in the local cache
+        '''
+        jobId = self.request_build(vendor, category)
+        status = self.wait_for_job(jobId, timeout, progress)
+        return self.download(jobId, status['fileUrl'], status.get('generation'), downloadProgress)
+
+    def fetch_part_metadata(self, vendor, category):
+        '''
+        Part documents of a vendor/category for offline matching, kept in the cache next to the index and
+        revalidated with If-None-Match. The cached documents are used if the server can not be reached.
+        :return: List of part documents
+        '''
+        identifier = f'{vendor}_{category}'
+        cached = self.cache.part_metadata(identifier)
+        headers = {'If-None-Match': cached['etag']} if cached and cached.get('etag') else {}
+        try:
+            r = self.session.get(f'{self.serverUri}/part-metadata/{vendor}/{category}', headers=headers,
+                                 timeout=REQUEST_TIMEOUT_SECONDS)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if cached is None:
+                raise IndexClientError(f'Part metadata of {identifier} not available: {error}')
+            return cached['parts']
+        if r.status_code == 304:
+            return cached['parts']
+        r.raise_for_status()
+        parts = r.json()['parts']
+        self.cache.store_part_metadata(identifier, r.headers.get('ETag'), parts)
+        return parts
+
+    def cached_part_metadata(self, identifier):
+        '''
+        :return: Cached part documents of an index, None if there are none
+        '''
+        cached = self.cache.part_metadata(identifier)
+        return cached['parts'] if cached else None
+
+    def cached_path(self, identifier):
+        '''
+        :return: Folder of the version of an index in the local cache, None if there is none
+        '''
+        current = self.cache.current(identifier)
+        return current['path'] if current else None
+
+    def download(self, identifier, fileUrl, generation=None, progress=None):
+        '''
+        Download and extract an archive into the cache unless the cached version is the same generation.
+        Connection errors are retried with backoff, resuming the partial download.
+        :param generation: GCS generation of the archive, if known. Without it the cached version is
+                           validated with its ETag (If-None-Match).
+        :return: Folder of the extracted archive
+        '''
+        if self.cache.is_current(identifier, generation):
+            return self.cached_path(identifier)
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            try:
+                return self._download_once(identifier, fileUrl, generation, progress)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as error:
+                if attempt + 1 >= DOWNLOAD_ATTEMPTS:
+                    raise IndexClientError(f'Download of {identifier} failed: {error}')
+                time.sleep(random.uniform(0, DOWNLOAD_BACKOFF_SECONDS * 2 ** attempt))
+
+    def _download_once(self, identifier, fileUrl, generation, progress):
+        current = self.cache.current(identifier)
+        partPath, partial = self.cache.partial(identifier)
+        resumable = partial is not None and (generation is None or str(partial['generation']) == str(generation))
+        offset = os.path.getsize(partPath) if resumable else 0
+
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            if partial.get('etag'):
+                # The server sends the whole archive instead of the range if it changed meanwhile
+                headers['If-Range'] = partial['etag']
+        elif generation is None and current and current.get('etag'):
+            headers['If-None-Match'] = current['etag']
+
+        with self.session.get(fileUrl, headers=headers, stream=True, timeout=REQUEST_TIMEOUT_SECONDS) as r:
+            if r.status_code == 304:
+                return current['path']
+            r.raise_for_status()
+            etag = r.headers.get('ETag')
+            generation = generation or r.headers.get('x-goog-generation') or (etag or '').strip('"') \
+                or str(int(time.time()))
+            if self.cache.is_current(identifier, generation):
+                return current['path']
+
+            stagingPath = self.cache.staging_path(identifier, generation)
+            extractor = _Extraction(stagingPath)
+            length = int(r.headers.get('Content-Length', 0))
+            if r.status_code == 206:
+                # Extract the bytes of the earlier attempts again from the partial file
+                with open(partPath, 'rb') as partFile:
+                    for chunk in iter(lambda: partFile.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        extractor.feed(chunk)
+                outfile = open(partPath, 'ab')
+                total = offset + length
+            else:
+                outfile = self.cache.start_partial(identifier, generation, etag)
+                offset = 0
+                total = length
+
+            done = offset
+            with outfile:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    outfile.write(chunk)
+                    extractor.feed(chunk)
+                    done += len(chunk)
+                    if progress:
+                        progress(done, total)
+
+        extractor.finish(partPath)
+        return self.cache.commit(identifier, generation, etag, stagingPath)
+
+
+class _Extraction:
+    '''
+    Streaming extraction that falls back to extracting the complete partial file, for archives that can not
+    be extracted before they are complete
+    '''
+
+    def __init__(self, targetPath):
+        self.targetPath = targetPath
+        self.extractor = StreamingZipExtractor(targetPath)
+
+    def feed(self, chunk):
+        if self.extractor is None:
+            return
+        try:
+            self.extractor.feed(chunk)
+        except StreamingNotSupported:
+            self.extractor.close()
+            self.extractor = None
+
+    def finish(self, partPath):
+        if self.extractor is not None:
+            self.extractor.finish()
+            return
+        with zipfile.ZipFile(partPath, 'r') as zip_archive:
+            zip_archive.extractall(self.targetPath)
@@ -0,0 +1,188 @@
+import os
+import json
+import glob
+import heapq
+import base64
+import hashlib
+import functools
+import numpy
+from cryptography.fernet import Fernet
+from idTable import IdTable
+
+# Queries the exact engine scores at once, a batch needs an (items, queries) float matrix
+EXACT_QUERY_BATCH_SIZE = 64
+
+
+@functools.lru_cache(maxsize=8)
+def fernet_handler(key):
+    '''
+    Fernet handler of the ENCRYPTION_KEY of the indexer, derived the way the indexer derives it
+    '''
+    hlib = hashlib.md5()
+    hlib.update(key.encode('utf-8'))
+    return Fernet(base64.urlsafe_b64encode(hlib.hexdigest().encode('latin-1')))
+
+
+class AnnoyFile:
+    def __init__(self, path, dimension, metric):
+        from annoy import AnnoyIndex
+        self.index = AnnoyIndex(dimension, metric)
+        self.index.load(path, prefault=False)
+
+    def query(self, vector, k, search_k=-1):
+        return self.index.get_nns_by_vector(vector, k, search_k=search_k, include_distances=True)
+
+    def query_batch(self, vectors, k, search_k=-1):
+        # Annoy has no batch query, the file is memory mapped so every query only touches the pages it needs
+        return [self.query(vector, k, search_k) for vector in vectors]
+
+
+class ExactFile:
+    def __init__(self, path, dimension, metric):
+        self.vectors = numpy.load(path, mmap_mode='r')
+        self.metric = metric
+        self.squaredNorms = numpy.einsum('ij,ij->i', self.vectors, self.vectors)
+
+    def query(self, vector, k, search_k=-1):
+        return self.query_batch(numpy.asarray(vector)[None, :], k, search_k)[0]
+
+    def query_batch(self, vectors, k, search_k=-1):
+        '''
+        One matrix product for up to EXACT_QUERY_BATCH_SIZE query vectors
+        '''
+        if len(vectors) > EXACT_QUERY_BATCH_SIZE:
+            return [result for start in range(0, len(vectors), EXACT_QUERY_BATCH_SIZE)
+                    for result in self.query_batch(vectors[start:start + EXACT_QUERY_BATCH_SIZE], k, search_k)]
+        products = self.vectors @ vectors.T
+        if self.metric == 'dot':
+            scores, distances = -products, products
+        elif self.metric == 'angular':
+            cosines = products / numpy.maximum(numpy.sqrt(self.squaredNorms)[:, None]
+                                               * numpy.linalg.norm(vectors, axis=1)[None, :], 1e-12)
+            scores = distances = numpy.sqrt(numpy.maximum(2.0 - 2.0 * cosines, 0))
+        else:
+            scores = distances = numpy.sqrt(numpy.maximum(self.squaredNorms[:, None] - 2.0 * products
+                                                          + numpy.einsum('ij,ij->i', vectors, vectors)[None, :], 0))
+        k = min(k, scores.shape[0])
+        if k <= 0:
+            return [([], []) for _ in range(len(vectors))]
+        top = numpy.argpartition(scores, k - 1, axis=0)[:k]
+        top = numpy.take_along_axis(top, numpy.argsort(numpy.take_along_axis(scores, top, axis=0), axis=0), axis=0)
+        topDistances = numpy.take_along_axis(distances, top, axis=0)
+        return [(top[:, column].tolist(), topDistances[:, column].tolist()) for column in range(top.shape[1])]
+
+
+class HnswFile:
+    spaces = {'euclidean': 'l2', 'angular': 'cosine', 'dot': 'ip'}
+
+    def __init__(self, path, dimension, metric, ef):
+        import hnswlib
+        self.metric = metric
+        self.index = hnswlib.Index(space=self.spaces[metric], dim=dimension)
+        self.index.load_index(path)
+        self.index.set_ef(ef)
+
+    def query(self, vector, k, search_k=-1):
+        return self.query_batch(numpy.asarray(vector)[None, :], k, search_k)[0]
+
+    def query_batch(self, vectors, k, search_k=-1):
+        k = min(k, self.index.get_current_count())
+        if k <= 0:
+            return [([], []) for _ in range(len(vectors))]
+        # hnswlib answers a batch with its own threads
+        labels, distances = self.index.knn_query(vectors, k=k)
+        # hnswlib reports squared L2, 1 - cosine and 1 - dot, convert to what Annoy reports
+        if self.metric == 'dot':
+            distances = 1.0 - distances
+        elif self.metric == 'angular':
+            distances = numpy.sqrt(numpy.maximum(2.0 * distances, 0))
+        else:
+            distances = numpy.sqrt(numpy.maximum(distances, 0))
+        return [(row.tolist(), rowDistances.tolist()) for row, rowDistances in zip(labels, distances)]
+
+
+class LocalIndex:
+    '''
+    An extracted index archive: the decrypted _info.json, the id -> name table, the index file or its shards
+    with their engine, and the projection query vectors are reduced with
+    '''
+
+    def __init__(self, path, encryptionKey):
+        infoFiles = glob.glob(os.path.join(path, '*_info.json'))
+        if not infoFiles:
+            raise FileNotFoundError(f'No _info.json in {path}')
+        cipher = fernet_handler(encryptionKey)
+        with open(infoFiles[0], 'rb') as file:
+            self.info = json.loads(cipher.decrypt(file.read()))
+
+        if 'image_file_names' in self.info:
+            self.names = self.info['image_file_names']
+        else:
+            self.names = IdTable(os.path.join(path, self.info['id_table']['file']), cipher)
+
+        self.metric = self.info.get('metric', 'euclidean')
+        self.search_k = self.info.get('search_k', -1)
+        # Annoy reports the dot product itself for "dot", larger is closer
+        self.sign = -1.0 if self.metric == 'dot' else 1.0
+        self.engine = self.info.get('engine', 'annoy')
+        dimension = self.info['length']
+        shards = self.info.get('shards') or [{'file': self.info.get('index_file', os.path.basename(infoFiles[0])
+                                                                   .replace('_info.json', '_fvecs.ann')),
+                                              'offset': 0}]
+        self.shards = [(self._open(os.path.join(path, shard['file']), dimension), shard['offset']) for shard in shards]
+
+        self.projection = None
+        projection = self.info.get('projection')
+        if projection:
+            with numpy.load(os.path.join(path, projection['file'])) as data:
+                self.projection = (data['mean'], data['components'], bool(data['normalise']))
+
+    def load_names(self):
+        '''
+        Decrypt the whole id table once and keep the names in memory, for clients that query many vectors
+        '''
+        if isinstance(self.names, IdTable):
+            self.names = self.names.all_names()
+
+    def _open(self, filePath, dimension):
+        if self.engine == 'exact':
+            return ExactFile(filePath, dimension, self.metric)
+        if self.engine == 'hnsw':
+            return HnswFile(filePath, dimension, self.metric, self.info.get('index_settings', {}).get('ef', 64))
+        return AnnoyFile(filePath, dimension, self.metric)
+
+    def reduce(self, vectors):
+        '''
+        Map feature vectors (one or a matrix with one per row) into the space of the index,
+        (vectors - mean) @ components, normalised
+        '''
+        vectors = numpy.asarray(vectors, dtype=numpy.float32)
+        if self.projection is None or vectors.shape[-1] != self.projection[1].shape[0]:
+            return vectors
+        mean, components, normalise = self.projection
+        reduced = (vectors - mean) @ components
+        if normalise:
+            reduced /= numpy.maximum(numpy.linalg.norm(reduced, axis=-1, keepdims=True), 1e-12)
+        return reduced.astype(numpy.float32)
+
+    def query(self, vector, k=10, search_k=None):
+        '''
+        :return: List of (image file name, distance), closest first, over all shards
+        '''
+        return self.query_batch([vector], k, search_k)[0]
+
+    def query_batch(self, vectors, k=10, search_k=None):
+        '''
+        Top k of many feature vectors, every shard is queried once with the whole batch
+        :return: One list of (image file name, distance) per vector, closest first
+        '''
+        vectors = self.reduce(numpy.asarray(vectors, dtype=numpy.float32).reshape(len(vectors), -1))
+        search_k = self.search_k if search_k is None else search_k
+        candidates = [[] for _ in range(len(vectors))]
+        for searcher, offset in self.shards:
+            for found, (ids, distances) in zip(candidates, searcher.query_batch(vectors, k, search_k)):
+                found.extend((self.sign * distance, offset + i, distance) for i, distance in zip(ids, distances))
+        tops = [heapq.nsmallest(k, found) for found in candidates]
+        ids = [obj[1] for top in tops for obj in top]
+        names = iter(self.names.names(ids) if isinstance(self.names, IdTable) else [self.names[i] for i in ids])
+        return [[(next(names), obj[2]) for obj in top] for top in tops]
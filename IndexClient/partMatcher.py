@@ -0,0 +1,92 @@
+import numpy
+from localIndex import LocalIndex
+
+# Views per part, histograms are normalised by it like the ones of /find-matching-part
+AMOUNT_PARTS = 7.0
+# Views queried at once
+MATCH_BATCH_SIZE = 256
+
+
+class PartMatcher:
+    '''
+    Offline replacement of /find-matching-part: the nearest images of every view of a part are looked up in a
+    downloaded index and counted per part with the part documents of the vendor/category, all in-process.
+    '''
+
+    def __init__(self, index, parts):
+        '''
+        :param index: LocalIndex of the vendor/category
+        :param parts: Part documents of the vendor/category (IndexClient.fetch_part_metadata)
+        '''
+        self.index = index
+        # Names are resolved for every view, the id table is decrypted once instead of per query
+        self.index.load_names()
+        self.partsByName = {name: part for part in parts for name in part.get('image_file_names', [])}
+
+    def histogram(self, views):
+        '''
+        Count how many of the views belong to each part, normalised by AMOUNT_PARTS
+        :param views: Image file names
+        :return: Dictionary of universal_uuid + file_name -> part document with "histo", as /find-matching-part
+        '''
+        dictToReturn = {}
+        for obj in views:
+            res = self.partsByName.get(obj)
+            if res is None:
+                continue
+            id = res['universal_uuid'] + res['file_name']
+            if id not in dictToReturn:
+                dictToReturn[id] = dict(res, histo=1)
+            else:
+                dictToReturn[id]['histo'] += 1
+        for obj in dictToReturn:
+            dictToReturn[obj]['histo'] = float(dictToReturn[obj]['histo']) / AMOUNT_PARTS
+        return dictToReturn
+
+    def nearest_views(self, vectors, k=1):
+        '''
+        :param vectors: Feature vectors of views
+        :return: Names of the k nearest images of every view, one list per view
+        '''
+        names = []
+        for start in range(0, len(vectors), MATCH_BATCH_SIZE):
+            results = self.index.query_batch(vectors[start:start + MATCH_BATCH_SIZE], k)
+            names.extend([name for name, _ in result] for result in results)
+        return names
+
+    def match_part(self, viewVectors, k=1):
+        return self.match_parts([viewVectors], k)[0]
+
+    def match_parts(self, parts, k=1):
+        '''
+        Histograms of many parts, the views of all parts are queried together in batches
+        :param parts: One list (or matrix) of view feature vectors per part
+        :return: One histogram per part
+        '''
+        counts = [len(views) for views in parts]
+        vectors = numpy.concatenate([numpy.asarray(views, dtype=numpy.float32).reshape(len(views), -1)
+                                     for views in parts if len(views)]) if sum(counts) else []
+        nearest = self.nearest_views(vectors, k)
+        histograms = []
+        start = 0
+        for count in counts:
+            histograms.append(self.histogram([name for names in nearest[start:start + count] for name in names]))
+            start += count
+        return histograms
+
+
+def open_matcher(client, vendor, category, encryptionKey, refresh=False):
+    '''
+    Open a matcher on the cached index and part documents of a vendor/category. The server is only asked
+    (to build and download the index and fetch the part documents) with refresh or if nothing is cached yet.
+    Open it once per vendor/category and match all parts with match_parts.
+    :param client: IndexClient
+    '''
+    identifier = f'{vendor}_{category}'
+    path = None if refresh else client.cached_path(identifier)
+    parts = None if refresh else client.cached_part_metadata(identifier)
+    if path is None:
+        path = client.fetch_index(vendor, category)
+    if parts is None:
+        parts = client.fetch_part_metadata(vendor, category)
+    return PartMatcher(LocalIndex(path, encryptionKey), parts)
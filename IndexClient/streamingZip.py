@@ -0,0 +1,158 @@
+import os
+import zlib
+import struct
+
+LOCAL_FILE_SIGNATURE = 0x04034b50
+CENTRAL_DIRECTORY_SIGNATURE = 0x02014b50
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06054b50
+# Signature, version, flags, method, time, date, CRC-32, compressed size, size, name length, extra length
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+FLAG_DATA_DESCRIPTOR = 0x08
+# Extra field with the 64 bit sizes of entries of 4 GiB and more, whose header sizes are then 0xFFFFFFFF
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_SIZE_MARKER = 0xFFFFFFFF
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+
+class StreamingNotSupported(Exception):
+    '''
+    The archive can not be extracted before it is complete, e.g. entries without sizes in their local headers
+    '''
+
+
+def zip64_sizes(extra, size, compressedSize):
+    '''
+    Read the sizes marked with 0xFFFFFFFF in a local header from its zip64 extra field, which holds the
+    marked ones in this order
+    :return: Size and compressed size
+    '''
+    offset = 0
+    while offset + 4 <= len(extra):
+        headerId, length = struct.unpack_from('<HH', extra, offset)
+        offset += 4
+        if offset + length > len(extra):
+            break
+        if headerId == ZIP64_EXTRA_ID:
+            values = iter(struct.unpack_from(f'<{length // 8}Q', extra, offset))
+            try:
+                if size == ZIP64_SIZE_MARKER:
+                    size = next(values)
+                if compressedSize == ZIP64_SIZE_MARKER:
+                    compressedSize = next(values)
+            except StopIteration:
+                break
+            return size, compressedSize
+        offset += length
+    raise StreamingNotSupported('Entry sizes are missing from the zip64 extra field')
+
+
+class StreamingZipExtractor:
+    '''
+    Extract a zip archive while it is downloaded: chunks are fed in order and every entry is written to the
+    target folder as soon as its bytes arrive, reading the local file headers instead of the central directory
+    at the end of the archive. Stored and deflated entries are supported, CRC-32 and sizes are checked.
+    '''
+
+    def __init__(self, targetPath):
+        self.targetPath = targetPath
+        self.buffer = bytearray()
+        self.done = False
+        self.names = []
+        self._entry = None
+        os.makedirs(targetPath, exist_ok=True)
+
+    def feed(self, data):
+        if self.done:
+            return
+        self.buffer += data
+        while self._step():
+            pass
+
+    def _step(self):
+        '''
+        Consume as much of the buffer as possible for the current state
+        :return: True if the state moved on and the buffer should be looked at again
+        '''
+        if self._entry is None:
+            return self._read_header()
+        entry = self._entry
+        chunk = bytes(self.buffer[:entry['remaining']])
+        del self.buffer[:len(chunk)]
+        entry['remaining'] -= len(chunk)
+        data = entry['decompressor'].decompress(chunk) if entry['decompressor'] else chunk
+        entry['crc'] = zlib.crc32(data, entry['crc'])
+        entry['size'] += len(data)
+        entry['file'].write(data)
+        if entry['remaining'] > 0:
+            return False
+        self._close_entry()
+        return True
+
+    def _read_header(self):
+        if len(self.buffer) < 4:
+            return False
+        signature = struct.unpack_from('<I', self.buffer)[0]
+        if signature in (CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_SIGNATURE):
+            # All entries are extracted, the central directory only repeats them
+            self.done = True
+            self.buffer = bytearray()
+            return False
+        if signature != LOCAL_FILE_SIGNATURE:
+            raise ValueError('Not a zip archive or a corrupt entry header')
+        if len(self.buffer) < LOCAL_HEADER.size:
+            return False
+        _, _, flags, method, _, _, crc, compressedSize, size, nameLength, extraLength = \
+            LOCAL_HEADER.unpack_from(self.buffer)
+        headerSize = LOCAL_HEADER.size + nameLength + extraLength
+        if len(self.buffer) < headerSize:
+            return False
+        if flags & FLAG_DATA_DESCRIPTOR:
+            raise StreamingNotSupported('Entry sizes are only known after the entry data')
+        if method not in (METHOD_STORED, METHOD_DEFLATED):
+            raise StreamingNotSupported(f'Compression method {method}')
+        name = bytes(self.buffer[LOCAL_HEADER.size:LOCAL_HEADER.size + nameLength]).decode('utf-8')
+        if ZIP64_SIZE_MARKER in (size, compressedSize):
+            extra = bytes(self.buffer[LOCAL_HEADER.size + nameLength:headerSize])
+            size, compressedSize = zip64_sizes(extra, size, compressedSize)
+        del self.buffer[:headerSize]
+        self._entry = {'name': name, 'crc': 0, 'size': 0, 'remaining': compressedSize, 'expected_crc': crc,
+                       'expected_size': size, 'file': open(self._target(name), 'wb'),
+                       'decompressor': zlib.decompressobj(-zlib.MAX_WBITS) if method == METHOD_DEFLATED else None}
+        if compressedSize == 0:
+            self._close_entry()
+        return True
+
+    def _target(self, name):
+        path = os.path.realpath(os.path.join(self.targetPath, name))
+        if not path.startswith(os.path.realpath(self.targetPath) + os.sep):
+            raise ValueError(f'Entry {name} is outside of the archive folder')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _close_entry(self):
+        entry = self._entry
+        self._entry = None
+        if entry['decompressor']:
+            rest = entry['decompressor'].flush()
+            entry['crc'] = zlib.crc32(rest, entry['crc'])
+            entry['size'] += len(rest)
+            entry['file'].write(rest)
+        entry['file'].close()
+        if entry['crc'] != entry['expected_crc'] or entry['size'] != entry['expected_size']:
+            raise ValueError(f"Entry {entry['name']} is corrupt")
+        self.names.append(entry['name'])
+
+    def close(self):
+        if self._entry is not None:
+            self._entry['file'].close()
+            self._entry = None
+
+    def finish(self):
+        '''
+        :return: Names of the extracted entries
+        '''
+        if not self.done:
+            self.close()
+            raise ValueError('The archive ended before its central directory')
+        return self.names
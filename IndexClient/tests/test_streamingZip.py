@@ -0,0 +1,70 @@
+import os
+import sys
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from streamingZip import StreamingZipExtractor, StreamingNotSupported, zip64_sizes  # noqa: E402
+
+
+def extract(archive, targetPath, chunkSize=1000):
+    extractor = StreamingZipExtractor(targetPath)
+    for start in range(0, len(archive), chunkSize):
+        extractor.feed(archive[start:start + chunkSize])
+    return extractor.finish()
+
+
+class StreamingZipExtractorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.zipPath = os.path.join(self.directory.name, 'index.zip')
+        self.target = os.path.join(self.directory.name, 'extracted')
+        self.files = {'index.ann': os.urandom(5000), 'info.json': b'{"dimension": 512}'}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, compression=zipfile.ZIP_STORED):
+        with zipfile.ZipFile(self.zipPath, 'w', compression) as archive:
+            for name, data in self.files.items():
+                zinfo = zipfile.ZipInfo(name)
+                zinfo.compress_type = compression
+                zinfo.file_size = len(data)
+                with archive.open(zinfo, 'w') as entry:
+                    entry.write(data)
+        with open(self.zipPath, 'rb') as file:
+            return file.read()
+
+    def assertExtracted(self, names):
+        self.assertEqual(sorted(names), sorted(self.files))
+        for name, data in self.files.items():
+            with open(os.path.join(self.target, name), 'rb') as file:
+                self.assertEqual(file.read(), data)
+
+    def test_stored_and_deflated(self):
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            self.assertExtracted(extract(self.write(compression), self.target))
+
+    def test_zip64_entries(self):
+        # Entries of 4 GiB take minutes to write, lowering the limit writes the same zip64 headers
+        with mock.patch.object(zipfile, 'ZIP64_LIMIT', 4096):
+            archive = self.write()
+        with zipfile.ZipFile(self.zipPath) as written:
+            self.assertEqual(written.getinfo('index.ann').file_size, 5000)
+        self.assertIn(b'\xff\xff\xff\xff\xff\xff\xff\xff', archive[:100])
+        self.assertExtracted(extract(archive, self.target, chunkSize=7))
+
+    def test_zip64_marker_without_extra_field(self):
+        with self.assertRaises(StreamingNotSupported):
+            zip64_sizes(b'', 0xFFFFFFFF, 0xFFFFFFFF)
+
+    def test_zip64_sizes_in_order(self):
+        extra = (0x0001).to_bytes(2, 'little') + (8).to_bytes(2, 'little') + (5 << 32).to_bytes(8, 'little')
+        self.assertEqual(zip64_sizes(extra, 10, 0xFFFFFFFF), (10, 5 << 32))
+
+
+if __name__ == '__main__':
+    unittest.main()
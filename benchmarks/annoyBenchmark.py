@@ -0,0 +1,116 @@
+'''
+Benchmark Annoy index builds and queries on feature vectors and auto-tune trees, search_k and metric.
+
+For every metric, tree count and build thread count an index is built and queried with every search_k.
+Reported are build time, index size, query latency percentiles and recall@k against exact brute force.
+
+Vectors come from synthetic data (unit length like the VGG16 fc1 vectors, optionally clustered) or from
+the local vector store of a vendor/category that was built before (VECTOR_CACHE_PATH):
+
+    python benchmarks/annoyBenchmark.py --synthetic 20000 --clusters 200
+    python benchmarks/annoyBenchmark.py --vector-store AnnoyIndexerMicroservice/VectorCache --category vendor_cat
+    python benchmarks/annoyBenchmark.py --vector-store AnnoyIndexerMicroservice/VectorCache --auto-tune
+
+--auto-tune prints the configuration the builds would pick (ANNOY_AUTO_TUNE=1 records it in the manifest).
+'''
+import os
+import sys
+import json
+import argparse
+import numpy
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'AnnoyIndexerMicroservice'))
+
+import indexTuning  # noqa: E402
+
+
+def synthetic_vectors(count, dimension, clusters, seed):
+    '''
+    Unit length vectors. With clusters, the vectors are spread around random centres like views of similar parts.
+    '''
+    rng = numpy.random.default_rng(seed)
+    if clusters:
+        centres = rng.normal(size=(clusters, dimension)).astype(numpy.float32)
+        vectors = centres[rng.integers(0, clusters, size=count)] + \
+            rng.normal(0, 0.5, size=(count, dimension)).astype(numpy.float32)
+    else:
+        vectors = rng.normal(size=(count, dimension)).astype(numpy.float32)
+    # fc1 activations are non negative after the ReLU
+    vectors = numpy.maximum(vectors, 0)
+    return vectors / numpy.maximum(numpy.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def stored_vectors(storePath, limit, seed):
+    '''
+    Sample the vectors of a vendor/category from its local vector store
+    '''
+    with open(os.path.join(storePath, 'index.json'), 'r') as file:
+        index = json.load(file)
+    matrix = numpy.load(os.path.join(storePath, 'vectors.npy'), mmap_mode='r')
+    rows = sorted(row for row, _ in index['rows'].values())
+    if len(rows) > limit:
+        rows = sorted(numpy.random.default_rng(seed).choice(rows, size=limit, replace=False))
+    return numpy.ascontiguousarray(matrix[rows], dtype=numpy.float32)
+
+
+def datasets(args):
+    if args.vector_store:
+        categories = args.category or sorted(name for name in os.listdir(args.vector_store)
+                                             if os.path.isfile(os.path.join(args.vector_store, name, 'index.json')))
+        for category in categories:
+            yield category, stored_vectors(os.path.join(args.vector_store, category), args.limit, args.seed)
+    else:
+        yield f'synthetic-{args.synthetic}', synthetic_vectors(args.synthetic, args.dimension, args.clusters, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--synthetic', type=int, default=10000, help='Amount of synthetic vectors')
+    parser.add_argument('--dimension', type=int, default=4096)
+    parser.add_argument('--clusters', type=int, default=0)
+    parser.add_argument('--vector-store', help='Vector cache folder with one sub folder per vendor/category')
+    parser.add_argument('--category', nargs='+', help='Vendor/category folders of the vector store')
+    parser.add_argument('--limit', type=int, default=indexTuning.ANNOY_TUNE_SAMPLE_SIZE,
+                        help='Upper bound of vectors sampled per vendor/category')
+    parser.add_argument('--queries', type=int, default=indexTuning.ANNOY_TUNE_QUERIES)
+    parser.add_argument('--k', type=int, default=indexTuning.ANNOY_TUNE_K)
+    parser.add_argument('--metrics', nargs='+', default=indexTuning.METRICS)
+    parser.add_argument('--trees', nargs='+', type=int, default=indexTuning.TREE_CANDIDATES)
+    parser.add_argument('--search-k-factors', nargs='+', type=int, default=indexTuning.SEARCH_K_FACTORS,
+                        help='search_k values as multiples of trees * k')
+    parser.add_argument('--build-jobs', nargs='+', type=int, default=[1, -1])
+    parser.add_argument('--auto-tune', action='store_true')
+    parser.add_argument('--target-recall', type=float, default=indexTuning.ANNOY_TARGET_RECALL)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write all results to this file')
+    args = parser.parse_args()
+
+    allResults = {}
+    for name, vectors in datasets(args):
+        print(f'\n{name}: {vectors.shape[0]} vectors of {vectors.shape[1]} dimensions, '
+              f'unit length: {indexTuning.is_normalised(vectors)}')
+        if args.auto_tune:
+            settings = indexTuning.auto_tune(vectors, args.target_recall, args.k, args.limit, args.queries, args.seed)
+            print(json.dumps(settings, indent=2))
+            allResults[name] = settings
+            continue
+
+        queries = indexTuning.sample_queries(vectors, args.queries, args.seed)
+        results = indexTuning.benchmark(vectors, queries, args.k, args.metrics, args.trees,
+                                        args.search_k_factors, args.build_jobs)
+        print(f"{'metric':<10}{'trees':>6}{'jobs':>6}{'search_k':>10}{'build (s)':>11}{'size (MB)':>11}"
+              f"{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'recall':>8}")
+        for obj in results:
+            print(f"{obj['metric']:<10}{obj['trees']:>6}{obj['build_jobs']:>6}{obj['search_k']:>10}"
+                  f"{obj['build_seconds']:>11.2f}{obj['index_bytes'] / 1024 ** 2:>11.1f}{obj['p50_ms']:>10.3f}"
+                  f"{obj['p95_ms']:>10.3f}{obj['p99_ms']:>10.3f}{obj['recall']:>8.3f}")
+        allResults[name] = results
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(allResults, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
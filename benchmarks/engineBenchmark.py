@@ -0,0 +1,92 @@
+'''
+Compare the index engines of the indexer (exact NumPy scan, Annoy, HNSW graph) on the same vectors.
+
+Every engine is built with the settings a build would use (defaults, or auto-tuned with --auto-tune) and
+opened the way the service opens it. Reported are build time, index size, load time, query latency
+percentiles and recall@k against exact brute force, next to the engine "auto" would choose.
+
+    python benchmarks/engineBenchmark.py --synthetic 50000 --clusters 500 --dimension 256
+    python benchmarks/engineBenchmark.py --vector-store AnnoyIndexerMicroservice/VectorCache --category vendor_cat
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'AnnoyIndexerMicroservice'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import indexEngines  # noqa: E402
+import indexTuning  # noqa: E402
+from annoyBenchmark import datasets  # noqa: E402
+
+
+def engine_settings(engine, vectors, autoTune, targetRecall):
+    if autoTune and engine == 'annoy':
+        return indexTuning.auto_tune(vectors, targetRecall)
+    if autoTune and engine == 'hnsw':
+        return indexTuning.auto_tune_hnsw(vectors, targetRecall)
+    return indexTuning.default_settings(engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--synthetic', type=int, default=10000, help='Amount of synthetic vectors')
+    parser.add_argument('--dimension', type=int, default=4096)
+    parser.add_argument('--clusters', type=int, default=0)
+    parser.add_argument('--vector-store', help='Vector cache folder with one sub folder per vendor/category')
+    parser.add_argument('--category', nargs='+', help='Vendor/category folders of the vector store')
+    parser.add_argument('--limit', type=int, default=100000, help='Upper bound of vectors per vendor/category')
+    parser.add_argument('--queries', type=int, default=indexTuning.ANNOY_TUNE_QUERIES)
+    parser.add_argument('--k', type=int, default=indexTuning.ANNOY_TUNE_K)
+    parser.add_argument('--engines', nargs='+', default=list(indexEngines.ENGINES))
+    parser.add_argument('--auto-tune', action='store_true', help='Tune Annoy and HNSW before measuring')
+    parser.add_argument('--target-recall', type=float, default=indexTuning.ANNOY_TARGET_RECALL)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write all results to this file')
+    args = parser.parse_args()
+
+    engines = [engine for engine in args.engines if engine != 'hnsw' or indexEngines.hnsw_available()]
+    if len(engines) != len(args.engines):
+        print('hnswlib is not installed, skipping the hnsw engine')
+
+    allResults = {}
+    for name, vectors in datasets(args):
+        queries = indexTuning.sample_queries(vectors, args.queries, args.seed)
+        truth = indexTuning.exact_neighbours(vectors, queries, args.k)
+        chosen = indexEngines.choose_engine(vectors.shape[0], vectors.shape[1], 'auto')
+        print(f'\n{name}: {vectors.shape[0]} vectors of {vectors.shape[1]} dimensions, "auto" chooses {chosen}')
+        print(f"{'engine':<8}{'build (s)':>11}{'size (MB)':>11}{'load (ms)':>11}"
+              f"{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'recall':>8}  settings")
+        results = []
+        with tempfile.TemporaryDirectory() as tempDir:
+            for engine in engines:
+                settings = engine_settings(engine, vectors, args.auto_tune, args.target_recall)
+                searcher, buildSeconds, size = indexTuning.build_and_load(vectors, settings, tempDir)
+                searcher.unload()
+                start = time.perf_counter()
+                searcher = indexEngines.get_engine(engine).load(
+                    os.path.join(tempDir, indexEngines.index_file_name('fvecs', engine)), vectors.shape[1], settings)
+                loadMs = (time.perf_counter() - start) * 1000
+                search_k = settings.get('search_k', -1)
+                result = {'engine': engine, 'build_seconds': buildSeconds, 'index_bytes': size, 'load_ms': loadMs,
+                          'settings': indexEngines.content_settings(settings)}
+                result.update(indexTuning.measure_queries(lambda query, count: searcher.query(query, count, search_k)[0],
+                                                          queries, truth, args.k))
+                searcher.unload()
+                results.append(result)
+                print(f"{engine:<8}{buildSeconds:>11.2f}{size / 1024 ** 2:>11.1f}{loadMs:>11.1f}"
+                      f"{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+                      f"{result['recall']:>8.3f}  {json.dumps(result['settings'])}")
+        allResults[name] = results
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(allResults, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+'''
+Measure feature map downloads against a local fake object store, without GCS.
+
+The fake bucket answers download_as_bytes like a GCS blob: after a random latency, with a bandwidth limit per
+request, and failing with a configurable rate of transient errors (503) and throttling (429). Compared are the
+shared bounded fetcher of the indexer (gcsFetcher.BlobFetcher, with retries) and the previous pattern of one
+thread pool per package of 100 names inside another thread pool (no retries). Reported are objects and MB per
+second, failed objects, retries, the peak of concurrent requests the store saw and the peak thread count.
+
+    python benchmarks/fetchBenchmark.py --objects 5000 --latency-ms 20 --error-rate 0.02
+    python benchmarks/fetchBenchmark.py --concurrency 8 16 32 64
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'AnnoyIndexerMicroservice'))
+
+from gcsFetcher import BlobFetcher  # noqa: E402
+
+
+class FakeStoreError(Exception):
+    def __init__(self, code):
+        super().__init__(f'{code} from the fake store')
+        self.code = code
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def download_as_bytes(self, timeout=None):
+        return self.bucket.download(self.name)
+
+
+class FakeBucket:
+    def __init__(self, objectBytes, latencyMs, mbPerSecond, errorRate, throttleRate, seed=0):
+        self.payload = bytes(objectBytes)
+        self.latency = latencyMs / 1000.0
+        self.mbPerSecond = mbPerSecond
+        self.errorRate = errorRate
+        self.throttleRate = throttleRate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peakActive = 0
+        self.requests = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def download(self, name):
+        with self.lock:
+            self.active += 1
+            self.peakActive = max(self.peakActive, self.active)
+            self.requests += 1
+            draw = self.rng.random()
+        try:
+            time.sleep(self.latency * (0.5 + self.rng.random()))
+            if draw < self.errorRate:
+                raise FakeStoreError(503)
+            if draw < self.errorRate + self.throttleRate:
+                raise FakeStoreError(429)
+            if self.mbPerSecond > 0:
+                time.sleep(len(self.payload) / (self.mbPerSecond * 1024 ** 2))
+            return self.payload
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class ThreadSampler:
+    def __init__(self):
+        self.peak = threading.active_count()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, threading.active_count())
+            time.sleep(0.005)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.peak
+
+
+def nested_pools(bucket, names):
+    '''
+    The download pattern before the shared fetcher: packages of 100 names, each with its own thread pool
+    '''
+    failed = []
+
+    def download_package(package):
+        def download_single_object(name):
+            try:
+                bucket.blob(name).download_as_bytes()
+                return True
+            except Exception:
+                return False
+
+        with ThreadPoolExecutor() as executor:
+            return [name for name, success in zip(package, executor.map(download_single_object, package))
+                    if not success]
+
+    with ThreadPoolExecutor() as executor:
+        for result in executor.map(download_package, [names[i:i + 100] for i in range(0, len(names), 100)]):
+            failed.extend(result)
+    return failed, 0
+
+
+def shared_fetcher(concurrency):
+    fetcher = BlobFetcher(concurrency=concurrency)
+
+    def fetch(bucket, names):
+        report = fetcher.fetch_many(bucket, names, lambda name, data: True)
+        return list(report.failed), report.retries
+
+    return fetch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=2000)
+    parser.add_argument('--object-bytes', type=int, default=4096 * 4, help='A 4096-d float32 feature map')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--mb-per-second', type=float, default=50, help='Bandwidth per request, 0 for unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='Share of requests failing with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.01, help='Share of requests failing with 429')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[16, 32, 64])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    names = [f'featuremap/{i}.bin' for i in range(args.objects)]
+    runs = [('nested pools', nested_pools)] + [(f'fetcher x{c}', shared_fetcher(c)) for c in args.concurrency]
+    print(f"{'mode':<16}{'objects/s':>11}{'MB/s':>9}{'failed':>8}{'retries':>9}{'peak requests':>15}{'peak threads':>14}")
+    for label, fetch in runs:
+        bucket = FakeBucket(args.object_bytes, args.latency_ms, args.mb_per_second, args.error_rate,
+                            args.throttle_rate, args.seed)
+        sampler = ThreadSampler()
+        start = time.perf_counter()
+        failed, retries = fetch(bucket, names)
+        seconds = time.perf_counter() - start
+        peakThreads = sampler.stop()
+        loaded = len(names) - len(failed)
+        print(f"{label:<16}{loaded / seconds:>11.1f}{loaded * args.object_bytes / 1024 ** 2 / seconds:>9.1f}"
+              f"{len(failed):>8}{retries:>9}{bucket.peakActive:>15}{peakThreads:>14}")
+
+
+if __name__ == '__main__':
+    main()
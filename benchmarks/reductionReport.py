@@ -0,0 +1,88 @@
+'''
+Recall versus dimension report for the optional PCA / random projection stage of the indexer.
+
+For every method and target dimension the projection is fitted on the vectors of a vendor/category (or on
+synthetic vectors), and the exact top k in the reduced space is compared with the exact top k of the full
+4096-d vectors. The recall of an Annoy index on the reduced vectors (trees and search_k as configured for
+builds) and the bytes per indexed item are reported as well.
+
+    python benchmarks/reductionReport.py --synthetic 20000 --clusters 200
+    python benchmarks/reductionReport.py --vector-store AnnoyIndexerMicroservice/VectorCache --category vendor_cat
+'''
+import os
+import sys
+import json
+import time
+import argparse
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'AnnoyIndexerMicroservice'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import indexTuning  # noqa: E402
+import vectorReduction  # noqa: E402
+from annoyBenchmark import datasets  # noqa: E402
+
+
+def recall(found, truth):
+    hits = sum(len(set(int(i) for i in row) & set(expected.tolist())) for row, expected in zip(found, truth))
+    return hits / float(truth.size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--synthetic', type=int, default=10000, help='Amount of synthetic vectors')
+    parser.add_argument('--dimension', type=int, default=4096)
+    parser.add_argument('--clusters', type=int, default=0)
+    parser.add_argument('--vector-store', help='Vector cache folder with one sub folder per vendor/category')
+    parser.add_argument('--category', nargs='+', help='Vendor/category folders of the vector store')
+    parser.add_argument('--limit', type=int, default=vectorReduction.REDUCTION_SAMPLE_SIZE,
+                        help='Upper bound of vectors sampled per vendor/category')
+    parser.add_argument('--queries', type=int, default=indexTuning.ANNOY_TUNE_QUERIES)
+    parser.add_argument('--k', type=int, default=indexTuning.ANNOY_TUNE_K)
+    parser.add_argument('--methods', nargs='+', default=['pca', 'random'])
+    parser.add_argument('--dimensions', nargs='+', type=int, default=[64, 128, 256, 512, 1024])
+    parser.add_argument('--no-annoy', action='store_true', help='Only report the exact recall')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write all results to this file')
+    args = parser.parse_args()
+
+    allResults = {}
+    for name, vectors in datasets(args):
+        queries = indexTuning.sample_queries(vectors, args.queries, args.seed)
+        truth = indexTuning.exact_neighbours(vectors, queries, args.k)
+        print(f'\n{name}: {vectors.shape[0]} vectors of {vectors.shape[1]} dimensions, recall@{args.k}')
+        print(f"{'method':<8}{'dims':>6}{'bytes/item':>12}{'fit (s)':>9}{'exact recall':>14}{'annoy recall':>14}")
+        results = []
+        for method in args.methods:
+            for dimension in args.dimensions:
+                if dimension >= vectors.shape[1]:
+                    continue
+                start = time.perf_counter()
+                projection = vectorReduction.fit_projection(vectors, method, dimension)
+                fitSeconds = time.perf_counter() - start
+                reduced = projection.transform(vectors)
+                reducedQueries = projection.transform(queries)
+                result = {'method': method, 'dimension': dimension, 'bytes_per_item': dimension * 4,
+                          'fit_seconds': fitSeconds,
+                          'exact_recall': recall(indexTuning.exact_neighbours(reduced, reducedQueries, args.k), truth)}
+                if not args.no_annoy:
+                    settings = indexTuning.default_settings()
+                    index = indexTuning.build_annoy_index(reduced, settings['metric'], settings['trees'])
+                    found = [index.get_nns_by_vector(query, args.k, search_k=settings['search_k'])
+                             for query in reducedQueries]
+                    result['annoy_recall'] = recall(found, truth)
+                    index.unload()
+                results.append(result)
+                annoyRecall = f"{result['annoy_recall']:>14.3f}" if 'annoy_recall' in result else f"{'-':>14}"
+                print(f"{method:<8}{dimension:>6}{dimension * 4:>12}{fitSeconds:>9.2f}"
+                      f"{result['exact_recall']:>14.3f}{annoyRecall}")
+        allResults[name] = results
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(allResults, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
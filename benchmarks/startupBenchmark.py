@@ -0,0 +1,56 @@
+'''
+Measure the cold start of both Flask services with and without lazy initialisation.
+
+Every run starts a fresh interpreter inside the service folder, imports application.py (what gunicorn does
+for every worker) and reports the import time. In lazy mode the time until all resources are warmed is
+reported as well. Needs the same environment as the services (.env, GCP credentials, MongoDB, Redis).
+
+    python benchmarks/startupBenchmark.py --runs 5
+'''
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ['AnnoyIndexerMicroservice', 'FeatureMapMicroservice']
+
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import application
+imported = time.perf_counter()
+from lazyResource import warm
+warm(application.LAZY_RESOURCES)
+warmed = time.perf_counter()
+print(json.dumps({"import": imported - start, "ready": warmed - start}))
+'''
+
+
+def run_probe(serviceDir, eager):
+    env = dict(os.environ, EAGER_INIT='1' if eager else '0', WARM_ON_START='0', BUILD_QUEUE_WORKER='0')
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=serviceDir, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--services', nargs='+', default=SERVICES)
+    args = parser.parse_args()
+
+    print(f"{'service':<28}{'mode':<8}{'import (s)':>12}{'ready (s)':>12}")
+    for service in args.services:
+        serviceDir = os.path.join(REPO_ROOT, service)
+        for eager in (True, False):
+            runs = [run_probe(serviceDir, eager) for _ in range(args.runs)]
+            importTime = statistics.median(obj['import'] for obj in runs)
+            readyTime = statistics.median(obj['ready'] for obj in runs)
+            print(f"{service:<28}{'eager' if eager else 'lazy':<8}{importTime:>12.3f}{readyTime:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()